@@ -0,0 +1,273 @@
+# FAULT INJECTION: HOW FAST ARE LOGIN FAILURES DETECTED AND RECOVERED FROM
+# run from the totp root directory with the totp environment's python (plus asyncssh, see benchmarks/fake_sshd.py):
+#   python -m benchmarks.chaos
+#
+# runs ensure_ssh_tunnel against benchmarks/fake_sshd.py in a throwaway HOME, injecting one fault per scenario:
+#   slow_prompts     the server waits --slow-seconds before each prompt (login should still work)
+#   stalled_prompts  the server waits longer than PEXPECT_TIMEOUT_SECONDS before each prompt
+#   dropped_password the server closes the connection instead of asking for the password
+#   dropped_code     the server closes the connection instead of asking for the verification code
+#   rejected_code    the server refuses the (right) verification code once
+#   unknown_prompt   the server asks something no dialog rule knows before the password
+#   account_locked   the server says the account is locked before the login
+#   killed_master    the master is killed with SIGKILL, leaving its socket file behind
+#   stale_socket     a dead socket file is in the way of a new master
+#   server_drop      the server closes the connection of an open master
+#   dropped_code_retry   dropped_code once, left to the retries of src/retry.py
+#   rejected_code_retry  rejected_code once, left to the retries of src/retry.py
+#   rotate_twice     src/monitor.py replaces the master twice in a row (the second time a replaced one).
+#                    recovered only if the last master answers on the socket and no other master is left
+#
+# time_to_detect_ms: from the start of the login (or from the fault, for an open master) until start-ssh
+# reports the failure (or notices the master is gone). time_to_recover_ms: from then until the tunnel is
+# open again, retrying once right away with the fault removed. for the *_retry scenarios the fault stays
+# and time_to_recover_ms is the whole ensure_with_retry call (a rejected code waits for the next totp step).
+# results are printed as one json line (and appended to --output) so they can be compared across commits
+
+import argparse
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_sshd import FAKE_HOST_ALIAS, FakeSshd, FakeSshdError, prepare_home
+from benchmarks.login import close_master
+from benchmarks.startup import git_revision
+from src.constants import DEFAULT_LOG_FORMAT, PEXPECT_TIMEOUT_SECONDS
+from src.inventory import get_host
+from src.monitor import rotate_master
+from src.retry import ensure_with_retry
+from src.start_ssh import TunnelError, ensure_ssh_tunnel
+from src.test_connection import (
+    control_socket_path,
+    is_controlmaster_open,
+    mux_alive_check,
+)
+from src.totp_steps import forget_sent_steps
+
+SCENARIOS = [
+    "slow_prompts",
+    "stalled_prompts",
+    "dropped_password",
+    "dropped_code",
+    "rejected_code",
+    "unknown_prompt",
+    "account_locked",
+    "killed_master",
+    "stale_socket",
+    "server_drop",
+    "dropped_code_retry",
+    "rejected_code_retry",
+    "rotate_twice",
+]
+
+
+def elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
+
+
+def try_login(host):
+    """(ms, name of the TunnelError or None) of one ensure_ssh_tunnel"""
+    start = time.perf_counter()
+    try:
+        ensure_ssh_tunnel(host)
+        return elapsed_ms(start), None
+    except TunnelError as e:
+        return elapsed_ms(start), type(e).__name__
+
+
+def try_login_with_retry(host):
+    """(ms, name of the TunnelError or None) of one ensure_with_retry"""
+    start = time.perf_counter()
+    try:
+        ensure_with_retry(host)
+        return elapsed_ms(start), None
+    except TunnelError as e:
+        return elapsed_ms(start), type(e).__name__
+
+
+def wait_until_closed(host, timeout):
+    """ms until is_controlmaster_open turns False (None if it doesn't within timeout)"""
+    start = time.perf_counter()
+    while elapsed_ms(start) < timeout * 1000:
+        if not is_open(host):
+            return elapsed_ms(start)
+        time.sleep(0.005)
+    return None
+
+
+def is_open(host):
+    return is_controlmaster_open(
+        ssh_dest=f"{host.user}@{host.hostname}", ssh_port=host.port
+    )
+
+
+def make_stale_socket(path):
+    """A socket file that nothing listens on, like the one a killed master leaves behind"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+
+
+def masters_on(socket_path):
+    """pids of the ssh masters started with socket_path (or a path starting with it) as ControlPath"""
+    completed = subprocess.run(
+        ["pgrep", "-f", f"ControlPath={re.escape(socket_path)}"],
+        capture_output=True,
+        text=True,
+    )
+    return sorted(int(pid) for pid in completed.stdout.split())
+
+
+def run_scenario(name, sshd, host, slow_seconds):
+    socket_path = control_socket_path(
+        f"{host.user}@{host.hostname}", ssh_port=host.port
+    )
+    close_master(sshd)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    sshd.clear_faults()
+    # the fake sshd accepts a code twice. only a retry within a scenario must wait for a new totp step
+    forget_sent_steps()
+    logins_before = sshd.stats["logins"]
+    connections_before = sshd.stats["connections"]
+    result = {"scenario": name}
+
+    if name.endswith("_retry"):
+        # the fault hits the first attempt only, the retries have to get past it on their own
+        if name == "dropped_code_retry":
+            sshd.drop_at, sshd.drops_left = "code", 1
+        else:
+            sshd.reject_next_codes = 1
+        result["time_to_detect_ms"] = None
+        result["detected_as"] = None
+        result["time_to_recover_ms"], result["recover_error"] = try_login_with_retry(
+            host
+        )
+        result["attempts"] = sshd.stats["connections"] - connections_before
+        sshd.clear_faults()
+    elif name in ("killed_master", "server_drop"):
+        # fault on an open master: detection is noticing it is gone
+        try_login(host)
+        if name == "killed_master":
+            os.kill(mux_alive_check(socket_path), signal.SIGKILL)
+        else:
+            sshd.drop_connections()
+        result["time_to_detect_ms"] = wait_until_closed(host, timeout=30)
+        result["detected_as"] = "closed"
+    elif name == "rotate_twice":
+        try_login(host)
+        pids = [mux_alive_check(socket_path)]
+        result["time_to_detect_ms"] = None
+        result["detected_as"] = None
+        result["recover_error"] = None
+        start = time.perf_counter()
+        try:
+            for _ in range(2):
+                forget_sent_steps()
+                pids.append(rotate_master(host, pids[-1], drain_seconds=5))
+        except (TunnelError, OSError) as e:
+            result["recover_error"] = type(e).__name__
+        result["time_to_recover_ms"] = elapsed_ms(start)
+        result["masters_left"] = masters_on(socket_path)
+        result["recovered"] = (
+            result["recover_error"] is None
+            and mux_alive_check(socket_path) == pids[-1]
+            and result["masters_left"] == [pids[-1]]
+        )
+    else:
+        match name:
+            case "slow_prompts":
+                sshd.prompt_delay = slow_seconds
+            case "stalled_prompts":
+                sshd.prompt_delay = PEXPECT_TIMEOUT_SECONDS + 1
+            case "dropped_password":
+                sshd.drop_at = "password"
+            case "dropped_code":
+                sshd.drop_at = "code"
+            case "rejected_code":
+                sshd.reject_next_codes = 1
+            case "unknown_prompt":
+                sshd.extra_prompt = "Passcode or option (1-3): "
+            case "account_locked":
+                sshd.banner = "Your account is locked. Contact the admins\n"
+            case "stale_socket":
+                make_stale_socket(socket_path)
+        result["time_to_detect_ms"], result["detected_as"] = try_login(host)
+        sshd.clear_faults()
+
+    if "time_to_recover_ms" not in result:
+        if result["detected_as"] is None:
+            # the login worked despite the fault
+            result["time_to_recover_ms"] = 0.0
+        else:
+            recover_ms, error = try_login(host)
+            result["time_to_recover_ms"] = recover_ms
+            result["recover_error"] = error
+    result.setdefault("recovered", is_open(host))
+    result["logins"] = sshd.stats["logins"] - logins_before
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help="run only this scenario (can be repeated). default: all",
+    )
+    parser.add_argument(
+        "--slow-seconds",
+        type=float,
+        default=2,
+        help="delay before each prompt in the slow_prompts scenario",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("-o", "--output", help="append the json result to this file")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+    )
+
+    try:
+        sshd = FakeSshd()
+    except FakeSshdError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with sshd, tempfile.TemporaryDirectory(prefix="totp-chaos-") as home:
+        os.environ.update(prepare_home(home, sshd))
+        host = get_host(FAKE_HOST_ALIAS)
+        try:
+            results = [
+                run_scenario(name, sshd, host, args.slow_seconds)
+                for name in args.scenario or SCENARIOS
+            ]
+        finally:
+            close_master(sshd)
+
+    result = {
+        "benchmark": "chaos",
+        "time": time.time(),
+        "git_revision": git_revision(),
+        "pexpect_timeout_seconds": PEXPECT_TIMEOUT_SECONDS,
+        "scenarios": results,
+    }
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "at") as f:
+            f.write(line + "\n")
+
+    not_recovered = [r["scenario"] for r in results if not r["recovered"]]
+    if not_recovered:
+        print(f"FAIL: not recovered after one retry: {not_recovered}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,368 @@
+# LOCAL STAND-IN FOR THE FASRC LOGIN SERVER
+# run from the totp root directory with the totp environment's python:
+#   python -m benchmarks.fake_sshd --port 2222
+#
+# needs asyncssh (not a dependency of totp itself): pip install asyncssh
+#
+# serves the same keyboard-interactive dialog as the login nodes ("Password: " then "VerificationCode: "),
+# checks the password and the totp code against a test secret, and runs commands locally for sessions.
+# multiplexing is done by the ssh client, so ControlMaster/ControlPersist work against it like against the
+# real server. used by the end-to-end benchmarks in benchmarks/login.py. prepare_home() writes a throwaway
+# HOME (inventory, secrets file, clock skew cache) so start-ssh can log in to it without touching your own,
+# prepare_ssh_client() lets plain `ssh <alias>` and `scp -O` (no sftp here) use the master it opens.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import signal
+import threading
+import time
+from pathlib import Path
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+import pyotp
+
+from src.constants import (
+    DEFAULT_LOG_FORMAT,
+    PASSWORD_SERVICE_NAME,
+    SECRET_TOKEN_SERVICE_NAME,
+    SECRETS_FILE_ENV_VAR,
+    SSH_USER_SERVICE_NAME,
+)
+from src.test_connection import control_socket_path
+
+FAKE_USER = "alice"
+FAKE_PASSWORD = "correct horse"
+FAKE_TOTP_SECRET = "JBSWY3DPEHPK3PXP"
+FAKE_HOST_ALIAS = "fake"
+
+
+class FakeSshdError(Exception):
+    pass
+
+
+class _Connection(asyncssh.SSHServer if asyncssh else object):
+    """One client connection: the password + verification code dialog"""
+
+    def __init__(self, sshd):
+        self.sshd = sshd
+        self.conn = None
+        self.stage = None
+
+    def connection_made(self, conn):
+        self.conn = conn
+        self.sshd._connection_made(conn)
+
+    def connection_lost(self, exc):
+        self.sshd._connection_lost(self.conn)
+
+    def begin_auth(self, username):
+        if self.sshd.banner:
+            self.conn.send_auth_banner(self.sshd.banner)
+        return True
+
+    def password_auth_supported(self):
+        return False
+
+    def public_key_auth_supported(self):
+        return False
+
+    def kbdint_auth_supported(self):
+        return True
+
+    async def _prompt(self, stage, prompt):
+        """The challenge for stage, after the injected delay (or nothing if the connection is dropped)"""
+        await asyncio.sleep(self.sshd.prompt_delay)
+        if self.sshd.drop_at == stage and self.sshd.drops_left != 0:
+            if self.sshd.drops_left is not None:
+                self.sshd.drops_left -= 1
+            self.sshd.stats["dropped"] += 1
+            self.conn.abort()
+            return False
+        self.stage = stage
+        return "", "", "", [(prompt, False)]
+
+    async def get_kbdint_challenge(self, username, lang, submethods):
+        if self.sshd.extra_prompt:
+            return await self._prompt("extra", self.sshd.extra_prompt)
+        return await self._prompt("password", "Password: ")
+
+    async def validate_kbdint_response(self, username, responses):
+        if self.stage == "extra":
+            return await self._prompt("password", "Password: ")
+        if self.stage == "password":
+            if username != self.sshd.user or list(responses) != [self.sshd.password]:
+                self.sshd.stats["rejected_passwords"] += 1
+                return False
+            return await self._prompt("code", "VerificationCode: ")
+
+        accepted = len(responses) == 1 and self.sshd.check_code(responses[0])
+        self.sshd.stats["logins" if accepted else "rejected_codes"] += 1
+        return accepted
+
+    def connection_requested(self, dest_host, dest_port, orig_host, orig_port):
+        # -L port forwards
+        return True
+
+
+class FakeSshd:
+    """A keyboard-interactive ssh server running in a background thread
+
+    reject_reused_codes: like most totp servers, refuse a code that was already used for a login
+
+    faults to inject (can be changed while it runs, see benchmarks/chaos.py):
+    prompt_delay: seconds to wait before each prompt
+    drop_at: "password" or "code": close the connection instead of sending that prompt
+    drops_left: only do that this many times (None: every time)
+    reject_next_codes: refuse this many verification codes, even if they are right
+    extra_prompt: ask this (e.g. a menu) before the password, and accept any answer
+    banner: show this message before the login (e.g. "Your account is locked")
+    """
+
+    def __init__(
+        self,
+        user=FAKE_USER,
+        password=FAKE_PASSWORD,
+        totp_secret=FAKE_TOTP_SECRET,
+        host="127.0.0.1",
+        port=0,
+        reject_reused_codes=False,
+    ):
+        if asyncssh is None:
+            raise FakeSshdError(
+                "The fake sshd needs asyncssh. Install it with: pip install asyncssh"
+            )
+        self.user = user
+        self.password = password
+        self.totp = pyotp.TOTP(totp_secret)
+        self.host = host
+        self.port = port
+        self.reject_reused_codes = reject_reused_codes
+        self.used_codes = set()
+        self.connections = set()
+        self.prompt_delay = 0
+        self.drop_at = None
+        self.drops_left = None
+        self.reject_next_codes = 0
+        self.extra_prompt = None
+        self.banner = None
+        self.stats = {
+            "connections": 0,
+            "sessions": 0,
+            "logins": 0,
+            "rejected_passwords": 0,
+            "rejected_codes": 0,
+            "dropped": 0,
+        }
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def check_code(self, code):
+        if self.reject_next_codes > 0:
+            self.reject_next_codes -= 1
+            return False
+        if not self.totp.verify(code, valid_window=1):
+            return False
+        if self.reject_reused_codes and code in self.used_codes:
+            return False
+        self.used_codes.add(code)
+        return True
+
+    def _connection_made(self, conn):
+        self.stats["connections"] += 1
+        self.connections.add(conn)
+
+    def _connection_lost(self, conn):
+        self.connections.discard(conn)
+
+    async def _run_process(self, process):
+        """Run the session's command (or a shell) locally"""
+        self.stats["sessions"] += 1
+        local = await asyncio.create_subprocess_shell(
+            process.command or "sh",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+
+        async def hang_up():
+            # like sshd: when the client goes away, the command and everything it started get a SIGHUP
+            await process.channel.wait_closed()
+            if local.returncode is None:
+                os.killpg(local.pid, signal.SIGHUP)
+
+        async def copy(reader, writer, close):
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            close()
+
+        stdin = asyncio.ensure_future(
+            copy(process.stdin, local.stdin, local.stdin.close)
+        )
+        hangup = asyncio.ensure_future(hang_up())
+        await asyncio.gather(
+            copy(local.stdout, process.stdout, lambda: None),
+            copy(local.stderr, process.stderr, lambda: None),
+        )
+        stdin.cancel()
+        hangup.cancel()
+        process.exit(await local.wait())
+
+    async def _start_server(self):
+        self._server = await asyncssh.create_server(
+            lambda: _Connection(self),
+            self.host,
+            self.port,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            process_factory=self._run_process,
+            encoding=None,
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Start listening (port 0 picks a free port). Return the port"""
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_server(), self._loop).result()
+        logging.info(f"Fake sshd listening on {self.host}:{self.port}")
+        return self.port
+
+    def call(self, function, *args):
+        """Run function(*args) in the server's thread and return its result"""
+
+        async def wrapper():
+            return function(*args)
+
+        return asyncio.run_coroutine_threadsafe(wrapper(), self._loop).result()
+
+    def clear_faults(self):
+        self.prompt_delay = 0
+        self.drop_at = None
+        self.drops_left = None
+        self.reject_next_codes = 0
+        self.extra_prompt = None
+        self.banner = None
+
+    def drop_connections(self):
+        """Close every client connection (like the server or the network going away)"""
+        self.call(lambda: [conn.abort() for conn in list(self.connections)])
+
+    def stop(self):
+        if self._loop is None:
+            return
+        self.drop_connections()
+        self.call(self._server.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def prepare_home(home, sshd, alias=FAKE_HOST_ALIAS):
+    """Write a throwaway HOME for start-ssh to log in to sshd as host `alias`.
+    Return the environment variables to run totp commands with"""
+    home = Path(home)
+    (home / ".ssh" / "controlmasters").mkdir(parents=True, exist_ok=True)
+    (home / ".config" / "totp").mkdir(parents=True, exist_ok=True)
+    # ssh expands ~ from the passwd entry, not $HOME, so spell out the paths that must stay in home.
+    # (start-ssh already passes ssh the full ControlPath, see control_socket_path)
+    options = {"UserKnownHostsFile": f"{home}/.ssh/known_hosts"}
+    (home / ".config" / "totp" / "hosts.toml").write_text(
+        f'[hosts.{alias}]\nhostname = "{sshd.host}"\nport = {sshd.port}\nuser = "{sshd.user}"\n'
+        + f"options = {{ {', '.join(f'{k} = {json.dumps(v)}' for k, v in options.items())} }}\n"
+    )
+    secrets_file = home / "secrets.json"
+    secrets_file.write_text(
+        json.dumps(
+            {
+                SECRET_TOKEN_SERVICE_NAME: sshd.totp.secret,
+                PASSWORD_SERVICE_NAME: sshd.password,
+                SSH_USER_SERVICE_NAME: sshd.user,
+            }
+        )
+    )
+    # a fresh clock skew measurement, so start-ssh doesn't query the ntp server
+    state = home / ".local" / "state" / "totp"
+    state.mkdir(parents=True, exist_ok=True)
+    (state / "clock_skew.json").write_text(
+        json.dumps(
+            [{"measured_at": time.time(), "server": "fake", "offset": 0, "delay": 0}]
+        )
+    )
+    return {
+        **os.environ,
+        "HOME": str(home),
+        SECRETS_FILE_ENV_VAR: str(secrets_file),
+    }
+
+
+def prepare_ssh_client(home, sshd, alias=FAKE_HOST_ALIAS):
+    """Let `ssh alias` and `scp -O ... alias:path` (from this process and the commands the fake server runs)
+    use the master start-ssh opened. ssh reads its config from the passwd home, not $HOME, so this puts an
+    ssh and an scp first on the PATH that add -F with a config for alias"""
+    home = Path(home)
+    config = home / ".ssh" / "config"
+    config.write_text(
+        f"Host {alias}\n  HostName {sshd.host}\n  Port {sshd.port}\n  User {sshd.user}\n"
+        f"  ControlPath {control_socket_path(f'{sshd.user}@{sshd.host}', ssh_port=sshd.port)}\n"
+        f"  UserKnownHostsFile {home}/.ssh/known_hosts\n"
+    )
+    bin_dir = home / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    for tool in ("ssh", "scp"):
+        (bin_dir / tool).write_text(
+            f'#!/bin/sh\nexec {shutil.which(tool)} -F {config} "$@"\n'
+        )
+        (bin_dir / tool).chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}:{os.environ['PATH']}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--user", default=FAKE_USER)
+    parser.add_argument("--password", default=FAKE_PASSWORD)
+    parser.add_argument("--secret", default=FAKE_TOTP_SECRET)
+    parser.add_argument("--reject-reused-codes", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=logging.INFO)
+
+    try:
+        sshd = FakeSshd(
+            user=args.user,
+            password=args.password,
+            totp_secret=args.secret,
+            port=args.port,
+            reject_reused_codes=args.reject_reused_codes,
+        )
+    except FakeSshdError as e:
+        logging.error(str(e))
+        raise SystemExit(1)
+    with sshd:
+        print(
+            f"ssh -p {sshd.port} {sshd.user}@{sshd.host}  (password: {sshd.password})"
+        )
+        try:
+            while True:
+                time.sleep(60)
+                print(json.dumps(sshd.stats))
+        except KeyboardInterrupt:
+            pass
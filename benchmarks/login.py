@@ -0,0 +1,241 @@
+# END-TO-END LOGIN BENCHMARK AGAINST A LOCAL FAKE SSHD
+# run from the totp root directory with the totp environment's python (plus asyncssh, see benchmarks/fake_sshd.py):
+#   python -m benchmarks.login
+#
+# starts benchmarks/fake_sshd.py on a free local port and runs the real start-ssh (and the real ssh client)
+# against it in a throwaway HOME. measures:
+#   - cold login: start-ssh with no master open, p50/max wall time and p50 per phase (from --record-timings)
+#   - check latency with the master open: is_controlmaster_open() in-process, the start-ssh command, and the
+#     totp-<tool> wrapper (src/launcher.py) with `true` as the tool, next to running `true` directly
+#   - N concurrent start-ssh callers with no master open: wall time per caller, and how many logins the
+#     server saw (should be 1, the others wait on the tunnel lock and reuse the master)
+#   - start-ssh --pool N: wall time, logins, whether the main master opened (it starts closed) and how many
+#     member masters answer on their own sockets (should be N). the server refuses reused codes here, so each
+#     master needs its own totp window: expect about 30s per master after the first
+#   - start-ssh --fastest: wall time of a login through the probed login node, and whether the master answers
+# results are printed as one json line (and appended to --output) so they can be compared across commits
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_sshd import FAKE_HOST_ALIAS, FakeSshd, FakeSshdError, prepare_home
+from benchmarks.startup import PROJECT_DIR, git_revision
+from src.inventory import get_host
+from src.launcher import template_wrapper
+from src.pool import live_pool_members
+from src.test_connection import control_socket_path, is_controlmaster_open
+from src.timings import load_timings, percentile
+from src.totp_steps import forget_sent_steps
+
+START_SSH = [sys.executable, "-m", "src.start_ssh", "--host", FAKE_HOST_ALIAS]
+
+
+def close_master(sshd):
+    socket_path = control_socket_path(f"{sshd.user}@{sshd.host}", ssh_port=sshd.port)
+    subprocess.run(
+        ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "fake"],
+        capture_output=True,
+    )
+    # the master removes its socket on the way out
+    deadline = time.monotonic() + 5
+    while os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def run_start_ssh(extra_args=()):
+    """Wall time (ms) of one start-ssh run. Raises if it fails"""
+    start = time.perf_counter()
+    subprocess.run([*START_SSH, *extra_args], cwd=PROJECT_DIR, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def summarize(times_ms):
+    return {
+        "p50_ms": statistics.median(times_ms),
+        "p95_ms": percentile(times_ms, 95),
+        "max_ms": max(times_ms),
+    }
+
+
+def bench_cold_login(sshd, repeat):
+    times = []
+    for _ in range(repeat):
+        close_master(sshd)
+        # the fake sshd accepts a code twice, don't wait for a new totp step before each login
+        forget_sent_steps()
+        times.append(run_start_ssh(["--record-timings"]))
+    records = [r for r in load_timings()[-repeat:] if r["result"] == "open"]
+    phases = {
+        phase: statistics.median(r["phases"].get(phase, 0) * 1000 for r in records)
+        for phase in records[-1]["phases"]
+    }
+    return {**summarize(times), "phases_p50_ms": phases}
+
+
+def time_command(command, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def bench_check(sshd, repeat, home):
+    """With the master open"""
+    run_start_ssh()
+    ssh_dest = f"{sshd.user}@{sshd.host}"
+    in_process = []
+    for _ in range(repeat * 10):
+        start = time.perf_counter()
+        assert is_controlmaster_open(ssh_dest=ssh_dest, ssh_port=sshd.port)
+        in_process.append((time.perf_counter() - start) * 1000)
+    command = [run_start_ssh() for _ in range(repeat)]
+    # the hot path of the wrappers: `true` instead of ssh, so only the wrapper itself is measured
+    wrapper = os.path.join(home, "totp-true")
+    with open(wrapper, "wt") as f:
+        f.write(template_wrapper("true", [get_host(FAKE_HOST_ALIAS)], "false"))
+    os.chmod(wrapper, 0o755)
+    return {
+        "is_controlmaster_open": summarize(in_process),
+        "start_ssh_command": summarize(command),
+        "wrapper_hot_path": summarize(
+            time_command([wrapper, FAKE_HOST_ALIAS], repeat * 10)
+        ),
+        "true_command": summarize(time_command(["true"], repeat * 10)),
+    }
+
+
+def bench_concurrent(sshd, callers):
+    close_master(sshd)
+    forget_sent_steps()
+    logins_before = sshd.stats["logins"]
+    start = time.perf_counter()
+    processes = [subprocess.Popen(START_SSH, cwd=PROJECT_DIR) for _ in range(callers)]
+    times, failed = [], 0
+    for process in processes:
+        failed += process.wait() != 0
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "callers": callers,
+        **summarize(times),
+        "failed": failed,
+        "logins": sshd.stats["logins"] - logins_before,
+    }
+
+
+def bench_pool(sshd, size):
+    host = get_host(FAKE_HOST_ALIAS)
+    # --pool opens the main master too
+    close_master(sshd)
+    logins_before = sshd.stats["logins"]
+    sshd.used_codes.clear()
+    sshd.reject_reused_codes = True
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run([*START_SSH, "--pool", str(size)], cwd=PROJECT_DIR)
+    finally:
+        sshd.reject_reused_codes = False
+    wall_ms = (time.perf_counter() - start) * 1000
+    members = live_pool_members(host, sshd.user)
+    main_open = is_controlmaster_open(
+        ssh_dest=f"{sshd.user}@{sshd.host}", ssh_port=sshd.port
+    )
+    for socket_path in members.values():
+        subprocess.run(
+            ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "fake"],
+            capture_output=True,
+        )
+    return {
+        "size": size,
+        "wall_ms": wall_ms,
+        "failed": completed.returncode != 0,
+        "logins": sshd.stats["logins"] - logins_before,
+        "open_members": len(members),
+        "main_open": main_open,
+    }
+
+
+def bench_fastest(sshd):
+    close_master(sshd)
+    forget_sent_steps()
+    wall_ms = run_start_ssh(["--fastest"])
+    is_open = is_controlmaster_open(
+        ssh_dest=f"{sshd.user}@{sshd.host}", ssh_port=sshd.port
+    )
+    return {"wall_ms": wall_ms, "open": is_open}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument(
+        "--callers",
+        default="1,4,16",
+        help="comma separated numbers of concurrent callers",
+    )
+    parser.add_argument(
+        "--pool",
+        type=int,
+        default=2,
+        help="size of the start-ssh --pool run (0 to skip it, it takes ~30s per extra member)",
+    )
+    parser.add_argument("-o", "--output", help="append the json result to this file")
+    args = parser.parse_args()
+
+    try:
+        sshd = FakeSshd()
+    except FakeSshdError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with sshd, tempfile.TemporaryDirectory(prefix="totp-login-bench-") as home:
+        # this process (is_controlmaster_open) and the start-ssh processes both use the throwaway HOME
+        os.environ.update(prepare_home(home, sshd))
+        try:
+            result = {
+                "benchmark": "login",
+                "time": time.time(),
+                "git_revision": git_revision(),
+                "python": sys.version.split()[0],
+                "cold_login": bench_cold_login(sshd, args.repeat),
+                "check": bench_check(sshd, args.repeat, home),
+                "concurrent": [
+                    bench_concurrent(sshd, int(n)) for n in args.callers.split(",")
+                ],
+                "pool": bench_pool(sshd, args.pool) if args.pool else None,
+                "fastest": bench_fastest(sshd),
+                "server": sshd.stats,
+            }
+        finally:
+            close_master(sshd)
+
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "at") as f:
+            f.write(line + "\n")
+
+    failures = []
+    failed = sum(run["failed"] for run in result["concurrent"])
+    if failed:
+        failures.append(f"{failed} concurrent start-ssh runs failed")
+    extra_logins = [run for run in result["concurrent"] if run["logins"] != 1]
+    if extra_logins:
+        failures.append(f"concurrent runs with more than one login: {extra_logins}")
+    pool = result["pool"]
+    if pool and (
+        pool["failed"] or pool["open_members"] != pool["size"] or not pool["main_open"]
+    ):
+        failures.append(f"pool members or the main master didn't all open: {pool}")
+    if not result["fastest"]["open"]:
+        failures.append("start-ssh --fastest didn't open the tunnel")
+    if failures:
+        print(f"FAIL: {'; '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
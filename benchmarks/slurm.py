@@ -0,0 +1,200 @@
+# SLURM CLIENT BENCHMARK AGAINST THE FAKE SSHD AND THE FAKE SLURM COMMANDS
+# run from the totp root directory with the totp environment's python (plus asyncssh, see benchmarks/fake_sshd.py):
+#   python -m benchmarks.slurm
+#
+# logs in to benchmarks/fake_sshd.py with the real start-ssh (like benchmarks/login.py) and puts the fake
+# sbatch/squeue/sacct from benchmarks/fake_slurm on the PATH of the shells it runs. measures:
+#   - submitting --jobs jobs with SlurmClient (batched) next to one `ssh fake sbatch` per job, and how many
+#     sessions each opened on the server; then waiting for the batched jobs to finish
+#   - slow_sbatch: every sbatch takes 0.5s, so a batch runs out of time and leaves the rest unsubmitted
+#   - hung_sbatch: one sbatch never returns, the batch times out and the jobs it submitted before are found
+#     again with squeue (by their --comment)
+# in the last two every job that reached the fake cluster must have reached its caller too (otherwise
+# submitting the failed ones again duplicates it).
+#   - unknown_job: waiting on a job id the fake cluster never had ends with UNKNOWN
+# the shells reach the fake server through `ssh fake` (see prepare_ssh_client in benchmarks/fake_sshd.py).
+# results are printed as one json line (and appended to --output) so they can be compared across commits
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.fake_sshd import (
+    FAKE_HOST_ALIAS,
+    FakeSshd,
+    FakeSshdError,
+    prepare_home,
+    prepare_ssh_client,
+)
+from benchmarks.login import close_master, run_start_ssh
+from benchmarks.startup import PROJECT_DIR, git_revision
+from src.inventory import get_host
+from src.slurm import SlurmClient
+
+FAKE_SLURM_BIN = PROJECT_DIR / "benchmarks" / "fake_slurm"
+JOB_SCRIPT = "#!/bin/sh\necho {i}\n"
+
+
+def prepare_slurm(home, sshd):
+    """Fake slurm commands on the remote PATH (login and plain shells), and an ssh that knows the alias.
+    Return the folder the fake jobs are kept in"""
+    home = Path(home)
+    jobs_dir = home / "slurm-jobs"
+    # src.remote_shell runs `bash -l`, and /etc/profile resets the PATH
+    (home / ".bash_profile").write_text(f'export PATH="{FAKE_SLURM_BIN}:$PATH"\n')
+    os.environ["PATH"] = f"{FAKE_SLURM_BIN}:{os.environ['PATH']}"
+    prepare_ssh_client(home, sshd)
+    os.environ["FAKE_SLURM_DIR"] = str(jobs_dir)
+    return jobs_dir
+
+
+def count_jobs(jobs_dir):
+    if not jobs_dir.exists():
+        return 0
+    return sum(path.name.isdigit() for path in jobs_dir.iterdir())
+
+
+def bench_submit(sshd, host, jobs, sequential):
+    sessions = sshd.stats["sessions"]
+    start = time.perf_counter()
+    with SlurmClient(host, poll_interval=0.5) as slurm:
+        futures = slurm.submit_many([JOB_SCRIPT.format(i=i) for i in range(jobs)])
+        job_ids = [future.result() for future in futures]
+        submit_ms = (time.perf_counter() - start) * 1000
+        submit_sessions = sshd.stats["sessions"] - sessions
+        start = time.perf_counter()
+        states = slurm.wait(job_ids, timeout=60)
+        wait_ms = (time.perf_counter() - start) * 1000
+
+    sessions = sshd.stats["sessions"]
+    start = time.perf_counter()
+    for i in range(sequential):
+        subprocess.run(
+            ["ssh", FAKE_HOST_ALIAS, "sbatch --parsable"],
+            input=JOB_SCRIPT.format(i=i),
+            text=True,
+            capture_output=True,
+            check=True,
+        )
+    sequential_ms = (time.perf_counter() - start) * 1000
+    return {
+        "batched": {
+            "jobs": jobs,
+            "submit_ms": submit_ms,
+            "jobs_per_s": jobs / submit_ms * 1000,
+            "sessions": submit_sessions,
+            "wait_ms": wait_ms,
+            "states": Counter(states.values()),
+        },
+        "one_ssh_per_job": {
+            "jobs": sequential,
+            "submit_ms": sequential_ms,
+            "jobs_per_s": sequential / sequential_ms * 1000,
+            "sessions": sshd.stats["sessions"] - sessions,
+        },
+    }
+
+
+def bench_unknown_job(host):
+    start = time.perf_counter()
+    with SlurmClient(host, poll_interval=0.5) as slurm:
+        states = slurm.wait(["999999"], timeout=30)
+    return {"seconds": time.perf_counter() - start, "state": states["999999"]}
+
+
+def bench_failed_batch(host, jobs_dir, scripts, remote_env, **client_args):
+    """Submit scripts in one batch. Count the jobs that got an id and the jobs the fake cluster has"""
+    os.environ.update(remote_env)
+    before = count_jobs(jobs_dir)
+    start = time.perf_counter()
+    slurm = SlurmClient(host, **client_args)
+    try:
+        futures = slurm.submit_many(scripts)
+        slurm.flush()
+    finally:
+        slurm.close()
+        for name in remote_env:
+            del os.environ[name]
+    submitted = sum(future.exception() is None for future in futures)
+    return {
+        "jobs": len(scripts),
+        "seconds": time.perf_counter() - start,
+        "submitted": submitted,
+        "failed": len(scripts) - submitted,
+        "jobs_on_server": count_jobs(jobs_dir) - before,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--jobs", type=int, default=100)
+    parser.add_argument(
+        "--sequential", type=int, default=10, help="jobs to submit one ssh at a time"
+    )
+    parser.add_argument("-o", "--output", help="append the json result to this file")
+    args = parser.parse_args()
+
+    try:
+        sshd = FakeSshd()
+    except FakeSshdError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with sshd, tempfile.TemporaryDirectory(prefix="totp-slurm-bench-") as home:
+        os.environ.update(prepare_home(home, sshd))
+        jobs_dir = prepare_slurm(home, sshd)
+        try:
+            run_start_ssh()
+            host = get_host(FAKE_HOST_ALIAS)
+            scripts = [JOB_SCRIPT.format(i=i) for i in range(8)]
+            result = {
+                "benchmark": "slurm",
+                "time": time.time(),
+                "git_revision": git_revision(),
+                "python": sys.version.split()[0],
+                **bench_submit(sshd, host, args.jobs, args.sequential),
+                "slow_sbatch": bench_failed_batch(
+                    host,
+                    jobs_dir,
+                    scripts,
+                    {"FAKE_SLURM_SUBMIT_SECONDS": "0.5"},
+                    submit_seconds_per_job=0.25,
+                ),
+                "hung_sbatch": bench_failed_batch(
+                    host,
+                    jobs_dir,
+                    scripts[:3] + ["FAKE_SLURM_HANG"] + scripts[3:],
+                    # long enough that the jobs are still queued when they're looked for
+                    {"FAKE_SLURM_RUN_SECONDS": "60"},
+                    submit_timeout=2,
+                    submit_seconds_per_job=0.1,
+                ),
+                "unknown_job": bench_unknown_job(host),
+            }
+        finally:
+            close_master(sshd)
+
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "at") as f:
+            f.write(line + "\n")
+
+    failures = []
+    if result["batched"]["states"] != {"COMPLETED": args.jobs}:
+        failures.append(f"batched jobs didn't all complete: {result['batched']}")
+    for scenario in ("slow_sbatch", "hung_sbatch"):
+        run = result[scenario]
+        if not run["failed"] or run["submitted"] != run["jobs_on_server"]:
+            failures.append(f"{scenario}: {run}")
+    if result["unknown_job"]["state"] != "UNKNOWN":
+        failures.append(f"unknown_job: {result['unknown_job']}")
+    if failures:
+        print(f"FAIL: {'; '.join(failures)}", file=sys.stderr)
+        sys.exit(1)
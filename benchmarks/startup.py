@@ -0,0 +1,126 @@
+# STARTUP-TIME REGRESSION BENCHMARK FOR START-SSH
+# run from the totp root directory with the totp environment's python: python -m benchmarks.startup
+#
+# measures:
+#   - import time of src.start_ssh (python -X importtime), and which heavy modules it pulls in
+#   - wall time to launch start-ssh (--help) through the generated launcher, scripts/start-ssh, and plain python
+# results are printed as one json line (and appended to --output) so they can be compared across commits
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# modules that must not be imported when the tunnel is already open
+HEAVY_MODULES = ["keyring", "pexpect", "pyotp"]
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_import(module="src.start_ssh", repeat=5):
+    """Median total import time (ms) of `module` from python -X importtime, and heavy modules it loads"""
+    totals = []
+    loaded = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"import sys, {module}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+            ],
+            cwd=PROJECT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # "import time: self [us] | cumulative | imported package", the module itself is the last match
+        cumulative = [
+            int(m.group(1))
+            for m in re.finditer(
+                rf"^import time:\s+\d+ \|\s+(\d+) \| {re.escape(module)}$",
+                completed.stderr,
+                re.MULTILINE,
+            )
+        ]
+        totals.append(cumulative[-1] / 1000)
+        loaded = completed.stdout.split()
+    return statistics.median(totals), loaded
+
+
+def measure_launch(command, repeat=10):
+    """Median wall time (ms) to run command to completion"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=PROJECT_DIR, capture_output=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=10)
+    parser.add_argument("-o", "--output", help="append the json result to this file")
+    parser.add_argument(
+        "--max-import-ms",
+        type=float,
+        help="exit with an error if importing src.start_ssh takes longer than this",
+    )
+    args = parser.parse_args()
+
+    import_ms, heavy_loaded = measure_import(repeat=max(1, args.repeat // 2))
+    result = {
+        "benchmark": "startup",
+        "time": time.time(),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "import_start_ssh_ms": import_ms,
+        "heavy_modules_imported": heavy_loaded,
+        "launch_python_ms": measure_launch(
+            [sys.executable, "-m", "src.start_ssh", "--help"], args.repeat
+        ),
+    }
+    for name, script in [
+        ("launch_launcher_ms", PROJECT_DIR / "bin" / "start-ssh"),
+        ("launch_script_ms", PROJECT_DIR / "scripts" / "start-ssh"),
+    ]:
+        if os.access(script, os.X_OK):
+            result[name] = measure_launch([str(script), "--help"], args.repeat)
+
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "at") as f:
+            f.write(line + "\n")
+
+    failed = False
+    if heavy_loaded:
+        print(f"FAIL: importing src.start_ssh loads {heavy_loaded}", file=sys.stderr)
+        failed = True
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(
+            f"FAIL: importing src.start_ssh took {import_ms:.1f}ms (max {args.max_import_ms}ms)",
+            file=sys.stderr,
+        )
+        failed = True
+    sys.exit(1 if failed else 0)
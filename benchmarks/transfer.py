@@ -0,0 +1,187 @@
+# THROUGHPUT BENCHMARK FOR THE PARALLEL TRANSFER ENGINE
+# run from the totp root directory with the totp environment's python (plus asyncssh, see benchmarks/fake_sshd.py):
+#   python -m benchmarks.transfer
+#   python -m benchmarks.transfer --host localhost-test
+#
+# by default logs in to benchmarks/fake_sshd.py with the real start-ssh (like benchmarks/login.py) in a
+# throwaway HOME, and the "remote" side is a folder in that HOME. with --host it uses a host alias that ssh
+# can reach without prompting instead, e.g. a local sshd with key auth added to the inventory
+# (~/.config/totp/hosts.toml) and to the ssh config, with a master opened (ssh -fNM localhost-test).
+# uploads then downloads a random file tree with src.transfer at several channel counts, and a plain
+# `scp -r` over the same alias for comparison. results are printed as one json line (and appended to --output)
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_sshd import (
+    FAKE_HOST_ALIAS,
+    FakeSshd,
+    FakeSshdError,
+    prepare_home,
+    prepare_ssh_client,
+)
+from benchmarks.login import close_master, run_start_ssh
+from benchmarks.startup import git_revision
+from src.inventory import get_host
+from src.transfer import transfer
+
+
+def make_tree(root, big_files, big_mb, small_files):
+    """Random test data: a few big files and many small ones"""
+    for i in range(big_files):
+        Path(root, f"big-{i}").write_bytes(os.urandom(big_mb * 1024 * 1024))
+    small_dir = Path(root, "small")
+    small_dir.mkdir()
+    for i in range(small_files):
+        Path(small_dir, f"small-{i}").write_bytes(os.urandom(4096))
+
+
+def tree_size(root):
+    return sum(p.stat().st_size for p in Path(root).rglob("*") if p.is_file())
+
+
+def time_scp(alias, local_root, remote_root, scp_args=()):
+    start = time.monotonic()
+    subprocess.run(
+        [
+            "scp",
+            *scp_args,
+            "-q",
+            "-r",
+            "-o",
+            "BatchMode=yes",
+            str(local_root),
+            f"{alias}:{remote_root}",
+        ],
+        check=True,
+    )
+    return time.monotonic() - start
+
+
+def bench_transfers(
+    alias, source, workdir, remote_dir, job_counts, chunk_mb, scp_args=()
+):
+    """src.transfer up and down at each channel count, then scp. Return (runs, scp MB/s)"""
+    host = get_host(alias)
+    total_mb = tree_size(source) / 1024 / 1024
+    runs = []
+    for jobs in job_counts:
+        remote = f"{remote_dir}/j{jobs}"
+        subprocess.run(
+            ["ssh", "-o", "BatchMode=yes", alias, f"rm -rf {remote}"], check=True
+        )
+        up = transfer("upload", str(source), remote, host, jobs, chunk_mb, restart=True)
+        down = transfer(
+            "download",
+            remote,
+            str(workdir / f"back-{jobs}"),
+            host,
+            jobs,
+            chunk_mb,
+            restart=True,
+        )
+        runs.append(
+            {
+                "jobs": jobs,
+                "upload_mb_per_second": up["mb_per_second"],
+                "download_mb_per_second": down["mb_per_second"],
+                "failed_chunks": up["chunks_failed"] + down["chunks_failed"],
+            }
+        )
+    remote = f"{remote_dir}/scp"
+    subprocess.run(
+        ["ssh", "-o", "BatchMode=yes", alias, f"rm -rf {remote}"], check=True
+    )
+    scp_mb_per_second = total_mb / time_scp(alias, source, remote, scp_args)
+    subprocess.run(["ssh", "-o", "BatchMode=yes", alias, f"rm -rf {remote_dir}"])
+    return runs, scp_mb_per_second
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        help="inventory alias of a test server (default: the fake server in benchmarks/fake_sshd.py)",
+    )
+    parser.add_argument(
+        "--remote-dir",
+        help="folder on the server (default: /tmp/totp-transfer-bench, or in the throwaway HOME for the fake server)",
+    )
+    parser.add_argument(
+        "--jobs", default="1,4,8", help="comma separated channel counts to try"
+    )
+    parser.add_argument("--chunk-mb", type=int, default=8)
+    parser.add_argument("--big-files", type=int, default=2)
+    parser.add_argument("--big-mb", type=int, default=64)
+    parser.add_argument("--small-files", type=int, default=200)
+    parser.add_argument("-o", "--output", help="append the json result to this file")
+    args = parser.parse_args()
+    job_counts = [int(j) for j in args.jobs.split(",")]
+
+    workdir = Path(tempfile.mkdtemp(prefix="totp-transfer-bench-"))
+    source = workdir / "source"
+    source.mkdir()
+    make_tree(source, args.big_files, args.big_mb, args.small_files)
+    result = {
+        "benchmark": "transfer",
+        "time": time.time(),
+        "git_revision": git_revision(),
+        "host": args.host or FAKE_HOST_ALIAS,
+        "total_mb": tree_size(source) / 1024 / 1024,
+        "chunk_mb": args.chunk_mb,
+    }
+    try:
+        if args.host:
+            result["runs"], result["scp_mb_per_second"] = bench_transfers(
+                args.host,
+                source,
+                workdir,
+                args.remote_dir or "/tmp/totp-transfer-bench",
+                job_counts,
+                args.chunk_mb,
+            )
+        else:
+            try:
+                sshd = FakeSshd()
+            except FakeSshdError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            with sshd:
+                home = workdir / "home"
+                home.mkdir()
+                os.environ.update(prepare_home(home, sshd))
+                prepare_ssh_client(home, sshd)
+                try:
+                    run_start_ssh()
+                    result["runs"], result["scp_mb_per_second"] = bench_transfers(
+                        FAKE_HOST_ALIAS,
+                        source,
+                        workdir,
+                        args.remote_dir or f"{home}/remote",
+                        job_counts,
+                        args.chunk_mb,
+                        # the fake server has no sftp, scp's default protocol since OpenSSH 9
+                        scp_args=("-O",),
+                    )
+                finally:
+                    close_master(sshd)
+    finally:
+        shutil.rmtree(workdir)
+
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, "at") as f:
+            f.write(line + "\n")
+
+    failed = [run for run in result["runs"] if run["failed_chunks"]]
+    if failed:
+        print(f"FAIL: chunks failed: {failed}", file=sys.stderr)
+        sys.exit(1)
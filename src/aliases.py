@@ -14,6 +14,13 @@ from src.constants import (
     LOGIN_HOST_ALIAS,
     DEFAULT_LOG_FORMAT,
 )
+from src.launcher import (
+    LAUNCHER_DIR,
+    create_launcher,
+    create_wrappers,
+    launcher_file,
+    wrapper_file,
+)
 
 
 # aliases useful for f-strings (left, right brace)
@@ -22,10 +29,14 @@ RBRACE = "}"
 
 
 def make_totp_block(totp_project_dir):
+    start_ssh_path = launcher_file(totp_project_dir)
+    totp_ssh_path = wrapper_file(totp_project_dir, "ssh")
+    # totp-ssh, totp-rsync and totp-scp on the PATH, so scripts started from the shell find them too
     return rf"""{TOTP_BLOCK_START}
 # auto-generated by totp app: to remove, run "uninstall-totp-app"
-alias start-ssh="{totp_project_dir}/scripts/start-ssh"
-alias fasrc="{totp_project_dir}/scripts/start-ssh && ssh {LOGIN_HOST_ALIAS}"
+export PATH="{Path(totp_project_dir, LAUNCHER_DIR)}:$PATH"
+alias start-ssh="{start_ssh_path}"
+alias fasrc="{totp_ssh_path} {LOGIN_HOST_ALIAS}"
 alias stop-ssh="ssh -O stop {LOGIN_HOST_ALIAS}"
 alias uninstall-totp-app="{totp_project_dir}/scripts/uninstall"
 {TOTP_BLOCK_END}
@@ -77,6 +88,10 @@ If this is an error, remove text from your config file including and between: {T
 Exiting without making changes\n""")
             raise Exception("Aliases already exist")
 
+    # the aliases point to the launcher and the wrappers, so make sure they exist
+    create_launcher(totp_project_dir)
+    create_wrappers(totp_project_dir)
+
     totp_block = make_totp_block(totp_project_dir)
     new_rc_text = f"{rc_text}{totp_block}"
 
@@ -0,0 +1,105 @@
+# LOGIN DIALOG RULES: WHICH PROMPTS AND MESSAGES THE SERVER SHOWS DURING LOGIN, AND WHAT TO DO ABOUT EACH
+#
+# the default rules fit the FASRC login nodes ("Password: " then "VerificationCode: "). other hosts can add
+# their own in the inventory file (~/.config/totp/hosts.toml). they are checked before the default rules:
+#
+#   [[hosts.otherlab.dialog]]
+#   prompt = "Passcode or option \\(1-3\\):"   # regex
+#   action = "send"                           # password | totp | send | ignore | reject | fail
+#   text = "1"                                # for send: what to answer
+#
+#   [[hosts.otherlab.dialog]]
+#   prompt = "Your account has been suspended"
+#   action = "fail"
+#   message = "Account suspended. Contact the otherlab admins"   # optional
+#
+# prompts for input (password, totp, send) only match at the very end of the ssh output, where ssh waits for
+# the answer, so don't add "$". messages (ignore, reject, fail) match anywhere. reject means the answers were
+# refused: after the code was sent the login may be retried once with a new code (see src/retry.py), before it
+# only the password can be wrong and it isn't retried. fail stops for good. each prompt is answered at most
+# once: being asked again means the answer was rejected. any other line that looks like a prompt fails the
+# login right away instead of waiting for the timeout (see src/start_ssh.py login_dialog)
+
+import re
+from dataclasses import dataclass
+
+# answer with the password / a fresh totp code / fixed text, skip the message, or stop the login
+PROMPT_ACTIONS = ("password", "totp", "send")
+MESSAGE_ACTIONS = ("ignore", "reject", "fail")
+
+# a prompt-like line nobody has a rule for: the output ends in ":", "?" or ">" (+ spaces) and ssh waits for input
+UNKNOWN_PROMPT = re.compile(r"[:?>][ \t]*\Z")
+
+
+@dataclass
+class DialogRule:
+    prompt: str
+    action: str
+    text: str | None = None
+    message: str | None = None
+
+    def __post_init__(self):
+        if self.action not in PROMPT_ACTIONS + MESSAGE_ACTIONS:
+            raise ValueError(
+                f"Unknown dialog action {self.action!r}. Use one of: {', '.join(PROMPT_ACTIONS + MESSAGE_ACTIONS)}"
+            )
+        if self.action == "send" and self.text is None:
+            raise ValueError(f"Dialog rule for {self.prompt!r} needs a text to send")
+        try:
+            # keep inline flags like (?i) in front of the group, so the anchor applies to all alternatives
+            flags, prompt = re.match(
+                r"(\(\?[aiLmsux]+\))?(.*)", self.prompt, re.DOTALL
+            ).groups()
+            anchor = r"[ \t]*\Z" if self.is_prompt else ""
+            self.pattern = re.compile(f"{flags or ''}(?:{prompt}){anchor}")
+        except re.error as e:
+            raise ValueError(f"Invalid dialog prompt pattern {self.prompt!r}: {e}")
+
+    @property
+    def is_prompt(self):
+        return self.action in PROMPT_ACTIONS
+
+
+DEFAULT_DIALOG = [
+    DialogRule("Password:", "password"),
+    DialogRule("VerificationCode:", "totp"),
+    DialogRule(
+        "Permission denied",
+        "reject",
+        message="Permission denied by ssh server. Double check passwords and try again. Run ./scripts/install to update passwords.",
+    ),
+    DialogRule(
+        r"(?i)account (is |has been )?(locked|disabled)",
+        "fail",
+        message="The server says your account is locked. Contact the admins of the server",
+    ),
+    DialogRule(
+        r"(?i)password (has )?expired|must change your password",
+        "fail",
+        message="The server says your password has expired. Log in by hand to change it, then run ./scripts/install to update it",
+    ),
+    DialogRule(
+        "Host key verification failed",
+        "fail",
+        message="The server's host key changed. Check with the admins of the server before removing the old key from ~/.ssh/known_hosts",
+    ),
+]
+
+
+def parse_dialog(entries):
+    """DialogRules from the `dialog` entries (dicts) of a host in the inventory. Raises ValueError"""
+    rules = []
+    for entry in entries:
+        if isinstance(entry, DialogRule):
+            rules.append(entry)
+            continue
+        try:
+            rules.append(DialogRule(**entry))
+        except TypeError as e:
+            raise ValueError(f"Invalid dialog rule {entry}: {e}")
+    return rules
+
+
+def host_dialog(host):
+    """All rules for host: its own first, then the defaults"""
+    return parse_dialog(host.dialog) + DEFAULT_DIALOG
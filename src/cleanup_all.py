@@ -1,5 +1,6 @@
 import argparse
 import logging
+import os
 import sys
 
 from src.aliases import remove_aliases
@@ -9,10 +10,20 @@ from src.constants import (
     SSH_CONFIG_FILE,
     SSH_CONTROLMASTERS_FOLDER,
 )
+from src.inventory import load_inventory
+from src.launcher import remove_launcher
 from src.passwords import remove_passwords
 from src.ssh_config import remove_ssh_config_section
 
 
+def remove_all_passwords():
+    """Remove the passwords of every credential namespace used in the inventory"""
+    for keychain_prefix in sorted(
+        {host.keychain_prefix for host in load_inventory().values()}
+    ):
+        remove_passwords(keychain_prefix=keychain_prefix)
+
+
 def cleanup_all():
     logging.warning(
         "This script will remove all setup steps of the TOTP app (assuming the user did not modify the installation)"
@@ -31,7 +42,7 @@ def cleanup_all():
     logging.warning("Beginning removal")
     logging.warning("1. Removing Keychain passwords")
 
-    remove_passwords()
+    remove_all_passwords()
 
     logging.warning(f"2. Removing aliases in {RC_FILE}")
 
@@ -41,6 +52,10 @@ def cleanup_all():
 
     remove_ssh_config_section()
 
+    logging.warning("4. Removing start-ssh launcher and totp-ssh/rsync/scp wrappers")
+
+    remove_launcher(totp_project_dir=os.getcwd())
+
     logging.warning(
         f"You can optionally delete the ssh controlmasters folder at :{SSH_CONTROLMASTERS_FOLDER}"
     )
@@ -60,7 +75,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-t",
         "--target",
-        help='remove a specific component set by the totp app e.g. "all" [DEFAULT], "password", "alias", or "ssh"',
+        help='remove a specific component set by the totp app e.g. "all" [DEFAULT], "password", "alias", "ssh", or "launcher"',
         default="all",
     )
     args = parser.parse_args()
@@ -70,10 +85,13 @@ if __name__ == "__main__":
             cleanup_all()
         case "password":
             logging.info("Removing saved passwords for totp app")
-            remove_passwords()
+            remove_all_passwords()
         case "ssh":
             logging.info("Removing ssh config sections created for totp app")
             remove_ssh_config_section()
         case "alias":
             logging.info("Removing aliases created for totp app")
             remove_aliases()
+        case "launcher":
+            logging.info("Removing launcher created for totp app")
+            remove_launcher(totp_project_dir=os.getcwd())
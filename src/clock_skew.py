@@ -0,0 +1,188 @@
+# MEASURE HOW FAR THE LOCAL CLOCK IS OFF SO TOTP CODES ARE GENERATED FOR THE SERVER'S TIME
+
+import argparse
+import json
+import logging
+import socket
+import struct
+import time
+from datetime import datetime
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    CLOCK_SKEW_HISTORY_LENGTH,
+    CLOCK_SKEW_MAX_AGE_SECONDS,
+    CLOCK_SKEW_NTP_SERVER,
+    CLOCK_SKEW_TIMEOUT_SECONDS,
+    CLOCK_SKEW_WARN_SECONDS,
+    DEFAULT_LOG_FORMAT,
+)
+
+# seconds between the ntp epoch (1900) and the unix epoch (1970)
+NTP_EPOCH_OFFSET = 2208988800
+
+CLOCK_SKEW_FILE = f"{APP_STATE_FOLDER}/clock_skew.json"
+
+
+def _ntp_to_unix(packet, index):
+    seconds, fraction = struct.unpack("!II", packet[index : index + 8])
+    return seconds - NTP_EPOCH_OFFSET + fraction / 2**32
+
+
+def sntp_query(server=CLOCK_SKEW_NTP_SERVER, timeout=CLOCK_SKEW_TIMEOUT_SECONDS):
+    """Ask an ntp server for the time. Return (offset, delay) in seconds.
+
+    offset is how far the local clock is *behind* the server: server_time ~= time.time() + offset
+    """
+    host, _, port = server.partition(":")
+    port = int(port) if port else 123
+
+    # LI=0, version=3, mode=3 (client). the transmit timestamp is echoed back by the server
+    request = bytearray(48)
+    request[0] = 0x1B
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        t1 = time.time()
+        sock.sendto(request, (host, port))
+        response, _ = sock.recvfrom(48)
+        t4 = time.time()
+
+    if len(response) < 48 or response[0] & 0x07 != 4 or response[1] == 0:
+        raise ValueError(f"Invalid ntp response from {server}")
+
+    t2 = _ntp_to_unix(response, 32)  # server receive time
+    t3 = _ntp_to_unix(response, 40)  # server transmit time
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay = (t4 - t1) - (t3 - t2)
+    return offset, delay
+
+
+def load_skew_history(skew_file=CLOCK_SKEW_FILE):
+    try:
+        return json.loads(Path(skew_file).expanduser().read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+def save_skew_history(history, skew_file=CLOCK_SKEW_FILE):
+    skew_file_full = Path(skew_file).expanduser()
+    skew_file_full.parent.mkdir(parents=True, exist_ok=True)
+    skew_file_full.write_text(
+        json.dumps(history[-CLOCK_SKEW_HISTORY_LENGTH:], indent=1)
+    )
+
+
+def measure_clock_offset(server=CLOCK_SKEW_NTP_SERVER, skew_file=CLOCK_SKEW_FILE):
+    """Measure the clock offset, add it to the history file, and return it (None if it failed).
+    Failed attempts are saved too (offset None), so a blocked ntp port isn't queried again on every login
+    """
+    history = load_skew_history(skew_file)
+    try:
+        offset, delay = sntp_query(server=server)
+    except (OSError, ValueError) as e:
+        logging.info(f"Unable to measure clock skew using {server}: {e}")
+        history.append(
+            {
+                "measured_at": time.time(),
+                "server": server,
+                "offset": None,
+                "delay": None,
+                "error": str(e),
+            }
+        )
+        save_skew_history(history, skew_file)
+        return None
+
+    logging.info(
+        f"Measured clock skew using {server}: {offset:+.3f}s (delay {delay:.3f}s)"
+    )
+    if abs(offset) > CLOCK_SKEW_WARN_SECONDS:
+        logging.warning(
+            f"Local clock is off by {offset:+.1f}s. Totp codes are corrected for this, but you should fix your clock."
+        )
+
+    history.append(
+        {"measured_at": time.time(), "server": server, "offset": offset, "delay": delay}
+    )
+    save_skew_history(history, skew_file)
+    return offset
+
+
+def refresh_clock_offset(
+    server=CLOCK_SKEW_NTP_SERVER,
+    max_age=CLOCK_SKEW_MAX_AGE_SECONDS,
+    skew_file=CLOCK_SKEW_FILE,
+):
+    """Re-measure the clock offset if the last attempt (failed or not) is missing or older than max_age seconds"""
+    if server is None:
+        return
+    history = load_skew_history(skew_file)
+    if history and time.time() - history[-1]["measured_at"] < max_age:
+        return
+    measure_clock_offset(server=server, skew_file=skew_file)
+
+
+def measured_offsets(history):
+    """Offsets of the successful measurements in history, oldest first"""
+    return [entry["offset"] for entry in history if entry["offset"] is not None]
+
+
+def get_clock_offset(skew_file=CLOCK_SKEW_FILE):
+    """Return the last successfully measured clock offset in seconds (0 if never measured). Does no network i/o"""
+    if CLOCK_SKEW_NTP_SERVER is None:
+        return 0.0
+    offsets = measured_offsets(load_skew_history(skew_file))
+    if not offsets:
+        return 0.0
+    return offsets[-1]
+
+
+def print_skew_report(skew_file=CLOCK_SKEW_FILE):
+    history = load_skew_history(skew_file)
+    if not history:
+        print("No clock skew measurements yet")
+        return
+    print(f"{'measured at':<20} {'offset (s)':>11} {'delay (s)':>10}  server")
+    for entry in history:
+        measured_at = datetime.fromtimestamp(entry["measured_at"]).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        if entry["offset"] is None:
+            print(
+                f"{measured_at:<20} {'failed':>11} {'':>10}  {entry['server']}: {entry.get('error')}"
+            )
+            continue
+        print(
+            f"{measured_at:<20} {entry['offset']:>+11.3f} {entry['delay']:>10.3f}  {entry['server']}"
+        )
+    offsets = measured_offsets(history)
+    if not offsets:
+        print("\nno successful measurements yet")
+        return
+    print(
+        f"\nlatest: {offsets[-1]:+.3f}s  min: {min(offsets):+.3f}s  max: {max(offsets):+.3f}s  ({len(offsets)} measurements)"
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--server",
+        help=f'ntp server to query ("host" or "host:port"). default: {CLOCK_SKEW_NTP_SERVER}',
+        default=CLOCK_SKEW_NTP_SERVER,
+    )
+    parser.add_argument(
+        "--no-measure",
+        help="only show the saved history, don't measure the skew now",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    if not args.no_measure and args.server is not None:
+        measure_clock_offset(server=args.server)
+    print_skew_report()
@@ -1,6 +1,5 @@
 import logging
 
-
 # service names to be stored in keychain
 APP_KEYCHAIN_PREFIX = "python-totp-ssh.app"
 
@@ -37,3 +36,134 @@ SSH_CONFIG_FILE = f"{SSH_FOLDER}/config"
 
 # ssh contorlmasters folder
 SSH_CONTROLMASTERS_FOLDER = f"{SSH_FOLDER}/controlmasters"
+
+# max time in seconds a start-ssh process waits for another one that is already creating the same tunnel
+LOCK_WAIT_TIMEOUT_SECONDS = 60
+
+# how often (in seconds) a waiting start-ssh process retries the tunnel lock
+LOCK_POLL_SECONDS = 0.1
+
+# start-ssh --daemon: how often (in seconds) to check that the tunnel is still open
+SUPERVISOR_POLL_SECONDS = 5
+
+# start-ssh --daemon: wait time after a failed login, doubled after every failure up to the max.
+# should be at least one totp window (30s) so a retry never re-sends the code that just failed
+SUPERVISOR_BACKOFF_INITIAL_SECONDS = 30
+SUPERVISOR_BACKOFF_MAX_SECONDS = 600
+
+# if fewer than this many seconds are left in the current totp window when the server asks for the code,
+# don't send the current code (it may expire in flight). wait for the next window instead
+TOTP_MIN_REMAINING_SECONDS = 3
+
+# the totp window is reserved (and waited for) before ssh starts, not at the code prompt where the server's
+# LoginGraceTime runs. about how long it takes from starting ssh to the code prompt, so the window isn't
+# almost over by then
+TOTP_PROMPT_DELAY_SECONDS = 3
+
+# instead of waiting for the next window, immediately send the code for the next window
+# (only use this if the server accepts codes from the adjacent window)
+TOTP_SEND_NEXT_WINDOW = False
+
+# folder for small state files written by the app (clock skew history, etc.)
+APP_STATE_FOLDER = "~/.local/state/totp"
+
+# ntp server ("host" or "host:port") used to measure how far the local clock is off. set to None to disable
+CLOCK_SKEW_NTP_SERVER = "pool.ntp.org"
+
+# max time in seconds to wait for the ntp server to answer
+CLOCK_SKEW_TIMEOUT_SECONDS = 1
+
+# re-measure the clock skew if the last measurement is older than this many seconds
+CLOCK_SKEW_MAX_AGE_SECONDS = 6 * 60 * 60
+
+# warn if the local clock is off by more than this many seconds
+CLOCK_SKEW_WARN_SECONDS = 5
+
+# number of clock skew measurements to keep in the history file
+CLOCK_SKEW_HISTORY_LENGTH = 50
+
+# set this environment variable to 1 to record phase timings of every start-ssh run (same as start-ssh --record-timings)
+RECORD_TIMINGS_ENV_VAR = "TOTP_RECORD_TIMINGS"
+
+# unix socket of the optional secrets agent (python -m src.secrets_agent start)
+SECRETS_AGENT_SOCKET = f"{APP_STATE_FOLDER}/agent/agent.sock"
+
+# number of seconds the secrets agent keeps the passwords in memory before exiting
+SECRETS_AGENT_TTL_SECONDS = 8 * 60 * 60
+
+# point this environment variable at a json file of {service name: secret} to read secrets from it instead of
+# the keyring (for testing only: the file is not encrypted)
+SECRETS_FILE_ENV_VAR = "TOTP_SECRETS_FILE"
+
+# optional inventory of hosts to keep tunnels open to (see README). if it doesn't exist, only
+# LOGIN_HOST_ALIAS / LOGIN_SSH_HOST is used
+INVENTORY_FILE = "~/.config/totp/hosts.toml"
+
+# login node selection (start-ssh --fastest): max time in seconds to wait for a login node to answer a probe
+NODE_PROBE_TIMEOUT_SECONDS = 3
+
+# login node selection: reuse probe results younger than this many seconds instead of probing again
+NODE_PROBE_CACHE_SECONDS = 10 * 60
+
+# transfer: default number of parallel ssh channels and chunk size (MiB) used to split large files
+TRANSFER_DEFAULT_JOBS = 8
+TRANSFER_DEFAULT_CHUNK_MB = 32
+
+# remote shell pool: shell started on the cluster for each channel, number of channels, per-command timeout
+REMOTE_SHELL_COMMAND = "bash -l"
+REMOTE_SHELL_DEFAULT_SIZE = 4
+REMOTE_SHELL_TIMEOUT_SECONDS = 60
+
+# slurm client: seconds between status polls, seconds to wait for more submissions before sending a batch, max jobs per batch
+SLURM_POLL_SECONDS = 10
+SLURM_BATCH_WINDOW_SECONDS = 0.2
+SLURM_BATCH_MAX_JOBS = 200
+
+# slurm client: seconds a batch may spend per job on sbatch calls (it stops starting new ones after that, and
+# the batch times out REMOTE_SHELL_TIMEOUT_SECONDS later)
+SLURM_SUBMIT_SECONDS_PER_JOB = 2
+
+# jump tunnels: ssh Host patterns of the compute nodes reached through the main login host, the key used
+# to log into them (compute nodes accept keys from the shared home folder), and how long node masters stay open
+JUMP_HOST_PATTERNS = ["holy*", "!holylogin*"]
+JUMP_KEY_FILE = "~/.ssh/totp_jump_ed25519"
+JUMP_CONTROL_PERSIST = "10m"
+
+# length of a totp window (seconds, see src/totp_steps.py)
+TOTP_INTERVAL_SECONDS = 30
+
+# connection profiles: size (MiB) of the file copied to measure throughput
+PROFILE_BENCH_TRANSFER_MB = 32
+
+# link monitor: seconds between round trip probes, probes kept in the rolling window, seconds before a probe counts as failed
+MONITOR_INTERVAL_SECONDS = 5
+MONITOR_WINDOW = 12
+MONITOR_PROBE_TIMEOUT_SECONDS = 5
+
+# link monitor: replace the master when the median round trip in the window is above this many seconds,
+# or when at least this fraction of probes failed. at most one replacement per MONITOR_MIN_ROTATION_SECONDS (each one is a login)
+MONITOR_RTT_THRESHOLD_SECONDS = 1.0
+MONITOR_FAILURE_RATE_THRESHOLD = 0.5
+MONITOR_MIN_ROTATION_SECONDS = 5 * 60
+
+# link monitor: seconds to wait for a replaced master to finish its sessions and exit before restoring the
+# forwards on the new one (it keeps running in the background after that, until its last session ends)
+MONITOR_DRAIN_SECONDS = 10
+
+# network watcher: seconds between reads of /proc/net/route when netlink isn't available, seconds of quiet
+# after a network change before checking the tunnel, and seconds a session may take to open before the master counts as dead
+NETWATCH_POLL_SECONDS = 2
+NETWATCH_SETTLE_SECONDS = 1
+NETWATCH_CHECK_TIMEOUT_SECONDS = 3
+
+# login dialog: how many characters at the end of the ssh output are searched for prompts, and how long the
+# output must stay quiet after an unrecognised prompt-like line (ending in ":", "?" or ">") before the login fails
+AUTH_DIALOG_SEARCH_WINDOW = 512
+AUTH_DIALOG_QUIET_SECONDS = 0.25
+
+# login retries (src/retry.py): max logins per start-ssh, max logins started in one totp window, and how many
+# times to retry after the server rejected the password/code once the code was sent (a wrong password would be rejected again, and
+# too many rejections can lock the account)
+RETRY_MAX_ATTEMPTS = 4
+RETRY_MAX_ATTEMPTS_PER_STEP = 2
+RETRY_MAX_REJECTED = 1
@@ -0,0 +1,251 @@
+# PORT FORWARDS ON THE RUNNING MASTER (ssh -O forward / -O cancel)
+#
+# adds and removes local port forwards on the open master, so reaching e.g. a jupyter server on a
+# compute node needs no new connection or login. forwards are kept in a registry and re-added
+# when start-ssh opens a new master. one that can't be re-added stays registered (marked with its
+# error) and is tried again with the next master.
+#
+#   start-ssh forward add holy7c1234:8888        (prints the local port)
+#   start-ssh forward list
+#   start-ssh forward remove 8888
+
+import argparse
+import json
+import logging
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from src.constants import APP_STATE_FOLDER, DEFAULT_LOG_FORMAT, MAX_TIMEOUT_CHECK_TUNNEL
+from src.inventory import get_host
+from src.ssh_config import read_ssh_user_from_config
+from src.test_connection import control_socket_path
+
+FORWARDS_FOLDER = f"{APP_STATE_FOLDER}/forwards"
+
+# local end of every forward (only reachable from this machine)
+FORWARD_BIND_ADDRESS = "127.0.0.1"
+
+
+class ForwardError(Exception):
+    pass
+
+
+def forwards_file(host):
+    return Path(FORWARDS_FOLDER).expanduser() / f"{host.name}.json"
+
+
+def load_forwards(host):
+    """[{"local_port", "remote_host", "remote_port", "added"}] registered for host. A forward the last
+    restore couldn't add also has "error"
+    """
+    try:
+        with open(forwards_file(host), "rt") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return []
+
+
+def save_forwards(host, forwards):
+    path = forwards_file(host)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(forwards, indent=2))
+    tmp_path.replace(path)
+
+
+def free_local_port():
+    """A local port nobody listens on right now"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((FORWARD_BIND_ADDRESS, 0))
+        return sock.getsockname()[1]
+
+
+def is_port_listening(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(0.2)
+        return sock.connect_ex((FORWARD_BIND_ADDRESS, port)) == 0
+
+
+def parse_remote(remote):
+    """ "node:port" or "port" (on the login node itself) -> (host, port)"""
+    remote_host, _, remote_port = remote.rpartition(":")
+    if not remote_port.isdigit():
+        raise ForwardError(f"Expected [remote host:]port, got: {remote}")
+    return remote_host or "localhost", int(remote_port)
+
+
+def _master_socket(host, ssh_user=None):
+    ssh_user = ssh_user or host.user or read_ssh_user_from_config(alias=host.alias)
+    if ssh_user is None:
+        raise ForwardError(
+            f"Unknown ssh username for {host.name}. Run ./scripts/install to set up totp app"
+        )
+    return control_socket_path(
+        f"{ssh_user}@{host.hostname}",
+        ssh_port=host.port,
+        socket_suffix=host.control_suffix,
+    )
+
+
+def _mux_command(socket_path, operation, forward):
+    spec = f"{FORWARD_BIND_ADDRESS}:{forward['local_port']}:{forward['remote_host']}:{forward['remote_port']}"
+    completed = subprocess.run(
+        [
+            "ssh",
+            "-o",
+            f"ControlPath={socket_path}",
+            "-O",
+            operation,
+            "-L",
+            spec,
+            "dummy_arg",
+        ],
+        capture_output=True,
+        text=True,
+        timeout=MAX_TIMEOUT_CHECK_TUNNEL,
+    )
+    if completed.returncode != 0:
+        raise ForwardError(
+            f"ssh -O {operation} -L {spec} failed: {completed.stderr.strip()}"
+        )
+
+
+def add_forward(host, remote, local_port=None):
+    """Forward local_port (default: a free one) to remote ("node:port") over the master. Return the forward"""
+    remote_host, remote_port = parse_remote(remote)
+    forward = {
+        "local_port": local_port or free_local_port(),
+        "remote_host": remote_host,
+        "remote_port": remote_port,
+        "added": time.time(),
+    }
+    forwards = load_forwards(host)
+    if any(f["local_port"] == forward["local_port"] for f in forwards):
+        raise ForwardError(f"Local port {forward['local_port']} is already forwarded")
+    _mux_command(_master_socket(host), "forward", forward)
+    save_forwards(host, forwards + [forward])
+    logging.info(
+        f"Forwarding localhost:{forward['local_port']} to {remote_host}:{remote_port}"
+    )
+    return forward
+
+
+def remove_forward(host, local_port):
+    """Stop the forward on local_port and drop it from the registry"""
+    forwards = load_forwards(host)
+    matching = [f for f in forwards if f["local_port"] == local_port]
+    if not matching:
+        raise ForwardError(f"No forward registered on local port {local_port}")
+    try:
+        _mux_command(_master_socket(host), "cancel", matching[0])
+    except ForwardError as e:
+        # the master may be gone, in which case the forward is too
+        logging.warning(str(e))
+    save_forwards(host, [f for f in forwards if f["local_port"] != local_port])
+
+
+def cancel_forwards(host, socket_path):
+    """Cancel the registered forwards on the master at socket_path (one that is being replaced), so
+    their local ports are free for the new master"""
+    for forward in load_forwards(host):
+        try:
+            _mux_command(socket_path, "cancel", forward)
+        except ForwardError as e:
+            logging.info(str(e))
+
+
+def restore_forwards(host, ssh_user=None):
+    """Add the registered forwards to a freshly opened master. A local port that got taken
+    in the meantime is swapped for a free one (and the registry updated). Forwards that fail stay
+    registered with their error, so the next restore tries them again. Return the restored ones
+    """
+    forwards = load_forwards(host)
+    if not forwards:
+        return []
+    try:
+        socket_path = _master_socket(host, ssh_user)
+    except ForwardError as e:
+        logging.warning(f"Unable to restore port forwards: {e}")
+        return []
+    restored = []
+    registered = []
+    for registered_forward in forwards:
+        forward = {k: v for k, v in registered_forward.items() if k != "error"}
+        if is_port_listening(forward["local_port"]):
+            new_port = free_local_port()
+            logging.warning(
+                f"Local port {forward['local_port']} is taken. Forwarding {forward['remote_host']}:{forward['remote_port']} on {new_port} instead"
+            )
+            forward = {**forward, "local_port": new_port}
+        try:
+            _mux_command(socket_path, "forward", forward)
+        except ForwardError as e:
+            logging.warning(
+                f"Unable to restore forward, will try again with the next master: {e}"
+            )
+            registered.append({**registered_forward, "error": str(e)})
+            continue
+        restored.append(forward)
+        registered.append(forward)
+    save_forwards(host, registered)
+    logging.info(
+        f"Restored {len(restored)} of {len(forwards)} port forward(s) for {host.name}"
+    )
+    return restored
+
+
+def forward_cli(argv):
+    """`start-ssh forward ...`. Return the exit code"""
+    parser = argparse.ArgumentParser(prog="start-ssh forward")
+    parser.add_argument("action", help='"add", "remove" or "list"')
+    parser.add_argument(
+        "target",
+        nargs="?",
+        help="add: [remote host:]port (default host: the login node). remove: local port",
+    )
+    parser.add_argument(
+        "-l", "--local-port", type=int, help="local port (default: pick a free one)"
+    )
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    host = get_host(args.host)
+    try:
+        match args.action.lower():
+            case "add":
+                if args.target is None:
+                    raise ForwardError("Missing [remote host:]port to forward to")
+                forward = add_forward(host, args.target, args.local_port)
+                print(forward["local_port"])
+            case "remove":
+                if args.target is None or not args.target.isdigit():
+                    raise ForwardError("Missing local port of the forward to remove")
+                remove_forward(host, int(args.target))
+            case "list":
+                for forward in load_forwards(host):
+                    state = "up" if is_port_listening(forward["local_port"]) else "down"
+                    if state == "down" and "error" in forward:
+                        state = f"down ({forward['error']})"
+                    print(
+                        f"localhost:{forward['local_port']}\t{forward['remote_host']}:{forward['remote_port']}\t{state}"
+                    )
+            case _:
+                raise ForwardError(f"Action arg is not defined: {args.action}")
+    except ForwardError as e:
+        logging.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(forward_cli(sys.argv[1:]))
@@ -6,13 +6,18 @@ import sys
 
 from src.aliases import create_aliases, make_rc_file
 from src.constants import (
+    APP_KEYCHAIN_PREFIX,
     RC_FILE,
     SSH_CONFIG_FILE,
     SSH_CONTROLMASTERS_FOLDER,
     SSH_FOLDER,
 )
+from src.inventory import get_host, load_inventory
+from src.jump import JumpError, authorize_jump_key
+from src.launcher import create_launcher, create_wrappers
 from src.passwords import prompt_and_store_passwords, are_all_passwords_set
 from src.ssh_config import (
+    SshConfigError,
     add_ssh_config_section,
     make_controlmasters_folder,
     make_ssh_config_file,
@@ -156,6 +161,36 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    ## set up passwords for hosts in the inventory file that use their own credentials
+    ## OPTIONAL
+    other_keychain_prefixes = {
+        host.keychain_prefix for host in load_inventory().values()
+    } - {APP_KEYCHAIN_PREFIX}
+    for keychain_prefix in sorted(other_keychain_prefixes):
+        aliases = [
+            host.alias
+            for host in load_inventory().values()
+            if host.keychain_prefix == keychain_prefix
+        ]
+        logging.warning(
+            "---\n"
+            + f"Host(s) {', '.join(aliases)} use separate passwords ({keychain_prefix})."
+        )
+        if are_all_passwords_set(keychain_prefix):
+            user_input = input("Would you like to update them? (Y/N): ").lower()
+        else:
+            user_input = input(
+                "Would you like to initialize these passwords? (Y/N): "
+            ).lower()
+        if user_input == "y" or user_input == "yes":
+            prompt_and_store_passwords(keychain_prefix=keychain_prefix)
+
+    ## create launcher for start-ssh that uses this environment's python directly (faster than conda run)
+    ## and the totp-ssh, totp-rsync and totp-scp wrappers (see src/launcher.py)
+    ## ALWAYS (only writes inside the totp folder)
+    create_launcher(totp_project_dir=base_repo_dir)
+    create_wrappers(totp_project_dir=base_repo_dir)
+
     ## set up aliases
     ## OPTIONAL (not possible if shell config file is not set)
     if not rc_file_exists:
@@ -180,12 +215,30 @@ if __name__ == "__main__":
         f"Would you like to set up the ssh config file {SSH_CONFIG_FILE}? (Y/N): "
     ).lower()
     if user_input == "y" or user_input == "yes":
-        add_ssh_config_section()
+        try:
+            add_ssh_config_section()
+        except SshConfigError as e:
+            logging.error(str(e))
+            sys.exit(1)
     else:
         logging.warning(
             'Did not input "yes". You must manually set up ssh config section for TOTP app scripts to work.'
         )
 
+    ## set up the key for compute nodes reached through the login master
+    ## OPTIONAL
+    logging.warning("---\n")
+    user_input = input(
+        "Would you like to set up ssh to compute nodes through the login node (creates a key and adds it to ~/.ssh/authorized_keys on the cluster, logs in once)? (Y/N): "
+    ).lower()
+    if user_input == "y" or user_input == "yes":
+        try:
+            authorize_jump_key(get_host())
+        except JumpError as e:
+            logging.error(f"{e}. Run `python -m src.jump setup` to try again")
+    else:
+        logging.warning('Did not input "yes". Skipping compute node setup')
+
     ## All done :)
 
     logging.info(
@@ -0,0 +1,126 @@
+# HOST INVENTORY: WHICH HOSTS TO OPEN TUNNELS TO, AND WITH WHICH CREDENTIALS
+#
+# example ~/.config/totp/hosts.toml:
+#
+#   [hosts.cannon]
+#   hostname = "login.rc.fas.harvard.edu"
+#   jump_hosts = ["holy*", "!holylogin*"]      # optional: reach these nodes through this host (see src/jump.py)
+#
+#   [hosts.boslogin]
+#   hostname = "boslogin.rc.fas.harvard.edu"
+#
+#   [hosts.otherlab]
+#   hostname = "login.otherlab.org"
+#   user = "jdoe"                              # optional: default is the ssh username from the keyring
+#   keychain_prefix = "python-totp-ssh.otherlab" # optional: use a separate set of passwords
+#   port = 2222                                # optional
+#   options = { ServerAliveInterval = "30" }   # optional: extra ssh options (not ControlPath)
+#   select_fastest = true                      # optional: connect to the fastest login node (see src/node_selection.py)
+#   nodes = ["holylogin01.rc.fas.harvard.edu", "holylogin02.rc.fas.harvard.edu"]  # optional: nodes to pick from
+#   dialog = [{ prompt = "Passcode:", action = "totp" }]  # optional: login prompts (see src/auth_dialog.py)
+
+import tomllib
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from src.auth_dialog import parse_dialog
+from src.constants import (
+    APP_KEYCHAIN_PREFIX,
+    INVENTORY_FILE,
+    JUMP_HOST_PATTERNS,
+    LOGIN_HOST_ALIAS,
+    LOGIN_SSH_HOST,
+    SSH_CONTROLMASTERS_FOLDER,
+)
+
+
+class InventoryError(Exception):
+    pass
+
+
+@dataclass
+class HostConfig:
+    alias: str
+    hostname: str
+    user: str | None = None
+    keychain_prefix: str = APP_KEYCHAIN_PREFIX
+    port: int = 22
+    options: dict = field(default_factory=dict)
+    select_fastest: bool = False
+    nodes: list = field(default_factory=list)
+    # ssh Host patterns of nodes reached through this host's master (ProxyJump)
+    jump_hosts: list = field(default_factory=list)
+    # extra login dialog rules (DialogRules, see src/auth_dialog.py), checked before the default ones
+    dialog: list = field(default_factory=list)
+    # set by start-ssh --pool (not in the inventory file): index of this master in the pool
+    pool_index: int | None = None
+
+    @property
+    def name(self):
+        """alias, or <alias>-pool-<i> for a pool member (this is also the ssh alias that reaches it)"""
+        if self.pool_index is None:
+            return self.alias
+        return f"{self.alias}-pool-{self.pool_index}"
+
+    @property
+    def control_suffix(self):
+        """added to the control socket name so every pool member has its own socket"""
+        return "" if self.pool_index is None else f".{self.name}"
+
+
+def default_inventory():
+    return {
+        LOGIN_HOST_ALIAS: HostConfig(
+            alias=LOGIN_HOST_ALIAS,
+            hostname=LOGIN_SSH_HOST,
+            jump_hosts=list(JUMP_HOST_PATTERNS),
+        )
+    }
+
+
+def load_inventory(inventory_file=INVENTORY_FILE):
+    """Return {alias: HostConfig} from the inventory file (just the default host if there is no file)"""
+    inventory_file_full = Path(inventory_file).expanduser()
+    if not inventory_file_full.exists():
+        return default_inventory()
+
+    try:
+        with open(inventory_file_full, "rb") as f:
+            hosts_table = tomllib.load(f).get("hosts", {})
+    except tomllib.TOMLDecodeError as e:
+        raise InventoryError(f"Unable to read inventory file {inventory_file}: {e}")
+
+    inventory = {}
+    for alias, host_table in hosts_table.items():
+        try:
+            inventory[alias] = HostConfig(alias=alias, **host_table)
+            inventory[alias].dialog = parse_dialog(inventory[alias].dialog)
+        except (TypeError, ValueError) as e:
+            raise InventoryError(
+                f"Invalid entry for host {alias} in {inventory_file}: {e}"
+            )
+        # ssh option names are case insensitive
+        if any(key.lower() == "controlpath" for key in inventory[alias].options):
+            raise InventoryError(
+                f"Host {alias} in {inventory_file} sets ControlPath in its options. Remove it: the control sockets are always in {SSH_CONTROLMASTERS_FOLDER} (see src/test_connection.py control_socket_path)"
+            )
+    if not inventory:
+        raise InventoryError(f"No [hosts.<alias>] entries in {inventory_file}")
+    return inventory
+
+
+def pool_members(host, pool_size):
+    """HostConfigs of the `pool_size` extra masters to open for host"""
+    return [replace(host, pool_index=i) for i in range(pool_size)]
+
+
+def get_host(alias=None, inventory_file=INVENTORY_FILE):
+    """Get one host from the inventory. Default: LOGIN_HOST_ALIAS if defined, else the first host"""
+    inventory = load_inventory(inventory_file)
+    if alias is None:
+        return inventory.get(LOGIN_HOST_ALIAS, next(iter(inventory.values())))
+    if alias not in inventory:
+        raise InventoryError(
+            f"Host {alias} is not in the inventory. Known hosts: {', '.join(inventory)}"
+        )
+    return inventory[alias]
@@ -0,0 +1,179 @@
+# REACH COMPUTE NODES THROUGH THE AUTHENTICATED LOGIN MASTER
+#
+# nodes matching a host's `jump_hosts` patterns get a ProxyJump block in the generated ssh config, so
+# `ssh holy7c1234` tunnels through the open master instead of asking for password + 2FA again.
+# compute nodes take key logins, so setup makes a key for this and adds it to ~/.ssh/authorized_keys on the cluster
+# (the home folder is shared with the nodes). the key has no passphrase, so its entry only accepts logins from the
+# cluster's internal networks (sshd `from=`): a copy of the key is useless from outside.
+#
+#   python -m src.jump setup              (once)
+#   python -m src.jump setup --from 10.31.0.0/16,10.255.12.0/24   (if the networks aren't found)
+#   python -m src.jump holy7c1234         (opens the login tunnel if needed, then ssh to the node)
+
+import argparse
+import fnmatch
+import ipaddress
+import logging
+import os
+import shlex
+import subprocess
+import sys
+from pathlib import Path
+
+from src.constants import DEFAULT_LOG_FORMAT, JUMP_KEY_FILE
+from src.inventory import get_host, load_inventory
+from src.start_ssh import start_ssh_tunnel
+
+
+class JumpError(Exception):
+    pass
+
+
+def matches_patterns(node, patterns):
+    """Same rules as an ssh `Host` line: some pattern matches and no negated (!) pattern does"""
+    positive = [p for p in patterns if not p.startswith("!")]
+    negative = [p[1:] for p in patterns if p.startswith("!")]
+    return any(fnmatch.fnmatch(node, p) for p in positive) and not any(
+        fnmatch.fnmatch(node, p) for p in negative
+    )
+
+
+def jump_host_for(node, inventory=None):
+    """HostConfig whose master reaches node, or None"""
+    inventory = inventory if inventory is not None else load_inventory()
+    for host in inventory.values():
+        if matches_patterns(node, host.jump_hosts):
+            return host
+    return None
+
+
+def create_jump_key(key_file=JUMP_KEY_FILE):
+    """Make the key used for compute nodes (no passphrase, see authorize_jump_key). Return the public key"""
+    key_path = Path(key_file).expanduser()
+    if not key_path.exists():
+        subprocess.run(
+            [
+                "ssh-keygen",
+                "-q",
+                "-t",
+                "ed25519",
+                "-N",
+                "",
+                "-C",
+                "totp-jump",
+                "-f",
+                str(key_path),
+            ],
+            check=True,
+        )
+        logging.info(f"Created jump key: {key_path}")
+    return Path(f"{key_path}.pub").read_text().strip()
+
+
+def _run_on_host(host, command, what):
+    """Run command on host through its master. Return its stdout"""
+    completed = subprocess.run(
+        ["ssh", "-o", "BatchMode=yes", host.alias, command],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise JumpError(f"Unable to {what} on {host.name}: {completed.stderr.strip()}")
+    return completed.stdout
+
+
+def cluster_networks(host):
+    """Private networks of the login node host, the ones compute nodes see its connections come from"""
+    output = _run_on_host(
+        host, "ip -o addr show scope global | awk '{print $4}'", "list the networks"
+    )
+    networks = []
+    for address in output.split():
+        try:
+            network = ipaddress.ip_interface(address).network
+        except ValueError:
+            continue
+        if network.is_private and str(network) not in networks:
+            networks.append(str(network))
+    return networks
+
+
+def authorize_jump_key(host, key_file=JUMP_KEY_FILE, allowed_from=None):
+    """Add the jump key to ~/.ssh/authorized_keys on host (through its master), replacing an older entry for it
+
+    allowed_from: addresses/networks the key may log in from (sshd `from=` patterns). Default: the
+    private networks of the login node, so the key only works inside the cluster
+    """
+    public_key = create_jump_key(key_file)
+    if not start_ssh_tunnel(host):
+        raise JumpError(f"Unable to open ssh tunnel for {host.name}")
+    if not allowed_from:
+        allowed_from = cluster_networks(host)
+        if not allowed_from:
+            raise JumpError(
+                f"Found no private network on {host.name} to limit the jump key to. Pass the cluster's networks with --from"
+            )
+    entry = f'from="{",".join(allowed_from)}" {public_key}'
+    # the key itself (without type or comment), to find older entries with other options
+    key_blob = public_key.split()[1]
+    authorized_keys = "~/.ssh/authorized_keys"
+    _run_on_host(
+        host,
+        f"umask 077 && mkdir -p ~/.ssh && chmod 700 ~/.ssh && touch {authorized_keys}"
+        f" && (grep -qxF {shlex.quote(entry)} {authorized_keys}"
+        f" || {{ {{ grep -vF {shlex.quote(key_blob)} {authorized_keys}; echo {shlex.quote(entry)}; }} > {authorized_keys}.totp-tmp"
+        f" && mv {authorized_keys}.totp-tmp {authorized_keys}; }})",
+        "authorize jump key",
+    )
+    logging.info(
+        f"Jump key authorized on {host.name} for logins from {', '.join(allowed_from)}"
+    )
+
+
+def exec_on_node(node, command=()):
+    """Make sure the master of the node's jump host is open, then replace this process with ssh to node"""
+    host = jump_host_for(node)
+    if host is None:
+        raise JumpError(
+            f"{node} doesn't match the jump_hosts of any host in the inventory. Add a pattern for it"
+        )
+    if not start_ssh_tunnel(host):
+        raise JumpError(f"Unable to open ssh tunnel for {host.name}")
+    os.execvp("ssh", ["ssh", node, *command])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "node",
+        help='compute node to ssh to, or "setup" to create and authorize the key',
+    )
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER, help="command to run on the node"
+    )
+    parser.add_argument(
+        "--host", help="setup: host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument(
+        "--from",
+        dest="allowed_from",
+        help="setup: comma separated networks the key may log in from (default: the login node's private networks)",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    try:
+        if args.node == "setup":
+            authorize_jump_key(
+                get_host(args.host),
+                allowed_from=args.allowed_from and args.allowed_from.split(","),
+            )
+        else:
+            exec_on_node(args.node, args.command)
+    except JumpError as e:
+        logging.error(str(e))
+        sys.exit(1)
@@ -0,0 +1,205 @@
+# GENERATE A LAUNCHER THAT RUNS START-SSH WITH THE TOTP ENVIRONMENT'S PYTHON DIRECTLY
+# `conda run` takes a long time to start, which dominates start-ssh when the tunnel is already open
+#
+# also generates totp-ssh, totp-rsync and totp-scp: sh wrappers that run the real tool right away (exec) when
+# the master of the host in their arguments is up, and only run start-ssh first when it isn't. the arguments
+# are read like the tool reads them (option values skipped, for ssh only the destination). the check is a
+# `[ -S ]` plus `ssh -O check` on the socket (no python), so a socket file left behind by a killed master
+# goes through start-ssh too instead of ssh asking for the password. with the tunnel open, the wrapper adds a
+# few milliseconds before the tool runs, see benchmarks/login.py
+
+import logging
+import stat
+import sys
+from pathlib import Path
+
+from src.inventory import load_inventory
+from src.test_connection import control_socket_path
+
+# folder (inside the totp project folder) where generated launchers are written
+LAUNCHER_DIR = "bin"
+# tools that get a totp-<tool> wrapper
+WRAPPED_TOOLS = ("ssh", "rsync", "scp")
+# tools whose arguments are all paths (alias:path is remote, a bare word is a local file). for the others
+# (ssh) the first argument that isn't an option is the destination and the rest is the remote command
+PATH_TOOLS = ("rsync", "scp")
+# short options that take a value (the rest of the word, or else the next argument), as each tool parses them
+VALUE_OPTIONS = {
+    "ssh": "BbcDEeFIiJLlmOoPpQRSWw",
+    "scp": "cDFiJloPSX",
+    "rsync": "BefMT@",
+}
+# rsync long options whose value can be the next argument (instead of --option=value)
+RSYNC_VALUE_LONG_OPTIONS = (
+    "--rsh",
+    "--rsync-path",
+    "--exclude",
+    "--include",
+    "--filter",
+    "--exclude-from",
+    "--include-from",
+    "--files-from",
+    "--compare-dest",
+    "--copy-dest",
+    "--link-dest",
+    "--backup-dir",
+    "--partial-dir",
+    "--temp-dir",
+    "--suffix",
+    "--chmod",
+    "--chown",
+    "--usermap",
+    "--groupmap",
+    "--log-file",
+    "--password-file",
+    "--remote-option",
+    "--out-format",
+)
+
+
+def launcher_file(totp_project_dir, name="start-ssh"):
+    return Path(totp_project_dir, LAUNCHER_DIR, name)
+
+
+def template_launcher(totp_project_dir, python_executable, module):
+    return f"""#!/bin/sh
+# auto-generated by totp app install script: runs {module} with the python of the totp environment
+# (no conda run). to remove, run "uninstall-totp-app"
+cd "{totp_project_dir}" && exec "{python_executable}" -m {module} "$@"
+"""
+
+
+def create_launcher(totp_project_dir, python_executable=sys.executable):
+    """Write <totp_project_dir>/bin/start-ssh. Should be run with the python of the totp environment"""
+    launcher_path = launcher_file(totp_project_dir)
+    launcher_path.parent.mkdir(exist_ok=True)
+    launcher_path.write_text(
+        template_launcher(totp_project_dir, python_executable, "src.start_ssh")
+    )
+    launcher_path.chmod(launcher_path.stat().st_mode | stat.S_IXUSR)
+    logging.info(
+        f"Created start-ssh launcher using {python_executable}: {launcher_path}"
+    )
+    return launcher_path
+
+
+def socket_glob(host):
+    """sh glob matching the control socket of host's master (ssh user unknown here, so any user)"""
+    # a placeholder user that can't be in a path, replaced by the glob
+    socket_path = control_socket_path(f"\0@{host.hostname}", ssh_port=host.port)
+    # quote everything but the user
+    return '"' + '"*"'.join(socket_path.split("\0")) + '"'
+
+
+def host_patterns(host, remote_paths_only=False):
+    """(sh case patterns of arguments that reach host, patterns that don't). ssh/scp/rsync destinations
+    look like alias, user@alias, alias:path or user@alias:path. remote_paths_only (scp/rsync): only the
+    last two, a bare alias is a local file for them. nodes in host.jump_hosts go through host
+    """
+    positive = [host.alias] + [p for p in host.jump_hosts if not p.startswith("!")]
+    negative = [p[1:] for p in host.jump_hosts if p.startswith("!")]
+
+    def forms(patterns):
+        return "|".join(
+            form
+            for p in patterns
+            for form in (
+                (f"{p}:*", f"*@{p}:*")
+                if remote_paths_only
+                else (p, f"*@{p}", f"{p}:*", f"*@{p}:*")
+            )
+        )
+
+    return forms(positive), forms(negative)
+
+
+def template_wrapper(tool, hosts, start_ssh_command):
+    """hosts: HostConfigs the wrapper logs in to. start_ssh_command: shell command that runs start-ssh"""
+    path_tool = tool in PATH_TOOLS
+    skip_branches, host_branches, socket_checks = "", "", ""
+    for host in hosts:
+        positive, negative = host_patterns(host, remote_paths_only=path_tool)
+        if negative:
+            skip_branches += f"        {negative}) break ;;\n"
+        host_branches += f"        {positive}) host={host.alias}; break ;;\n"
+        # a socket file of a killed master is still there: ask the master behind it
+        socket_checks += f"""    {host.alias}) for socket in {socket_glob(host)}; do [ -S "$socket" ] && ssh -o ControlPath="$socket" -O check dummy_arg 2>/dev/null && exec {tool} "$@"; done ;;\n"""
+    value_options = VALUE_OPTIONS.get(tool, VALUE_OPTIONS["ssh"])
+    long_value_options = ""
+    if tool == "rsync":
+        long_value_options = (
+            f"            {'|'.join(RSYNC_VALUE_LONG_OPTIONS)}) value=1; continue ;;\n"
+        )
+    # ssh: only the first argument that isn't an option
+    stop = "" if path_tool else "    break\n"
+    return f"""#!/bin/sh
+# auto-generated by totp app install script: runs {tool}, opening the tunnel with start-ssh first if the host
+# in the arguments has no master. to remove, run "uninstall-totp-app"
+host=
+value=
+options=1
+for arg in "$@"; do
+    if [ -n "$value" ]; then
+        value=
+        continue
+    fi
+    if [ -n "$options" ]; then
+        case "$arg" in
+            --) options=; continue ;;
+{long_value_options}            --*) continue ;;
+            -?*)
+                # flags can be grouped (-vp 22): the first one that takes a value ends the group
+                flags=${{arg#-}}
+                while [ -n "$flags" ]; do
+                    case "$flags" in
+                        [{value_options}]) value=1; break ;;
+                        [{value_options}]?*) break ;;
+                    esac
+                    flags=${{flags#?}}
+                done
+                continue ;;
+        esac
+    fi
+    case "$arg" in
+{skip_branches}{host_branches}    esac
+{stop}done
+case "$host" in
+    "") exec {tool} "$@" ;;
+{socket_checks}esac
+{start_ssh_command} --host "$host" || exit $?
+exec {tool} "$@"
+"""
+
+
+def wrapper_file(totp_project_dir, tool):
+    return launcher_file(totp_project_dir, f"totp-{tool}")
+
+
+def create_wrappers(totp_project_dir, hosts=None):
+    """Write <totp_project_dir>/bin/totp-<tool> for every tool in WRAPPED_TOOLS, for hosts (default: the
+    inventory). Re-run after changing the inventory"""
+    if hosts is None:
+        hosts = load_inventory().values()
+    start_ssh_command = f'"{launcher_file(totp_project_dir)}"'
+    paths = []
+    for tool in WRAPPED_TOOLS:
+        wrapper_path = wrapper_file(totp_project_dir, tool)
+        wrapper_path.parent.mkdir(exist_ok=True)
+        wrapper_path.write_text(template_wrapper(tool, hosts, start_ssh_command))
+        wrapper_path.chmod(wrapper_path.stat().st_mode | stat.S_IXUSR)
+        paths.append(wrapper_path)
+    logging.info(f"Created wrappers: {', '.join(str(p) for p in paths)}")
+    return paths
+
+
+def remove_launcher(totp_project_dir):
+    launcher_path = launcher_file(totp_project_dir)
+    launcher_path.unlink(missing_ok=True)
+    logging.info(f"Removed start-ssh launcher: {launcher_path}")
+    for tool in WRAPPED_TOOLS:
+        wrapper_file(totp_project_dir, tool).unlink(missing_ok=True)
+    try:
+        launcher_path.parent.rmdir()
+    except OSError:
+        # folder not empty or already gone
+        pass
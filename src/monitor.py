@@ -0,0 +1,286 @@
+# WATCH THE LINK QUALITY OF A MASTER AND REPLACE IT BEFORE IT HANGS
+#
+# keeps a `cat` session open over the master and times a line going there and back every few seconds.
+# when the round trips in the rolling window get slow, or too many of them fail, a new master is logged
+# in in place of the old one, so new ssh commands get a fast connection instead of a hung one. the old
+# master is told to stop taking sessions (ssh -O stop), and exits by itself once the sessions it still
+# carries are over.
+#
+#   python -m src.monitor [--host cannon]
+
+import argparse
+import logging
+import os
+import selectors
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from collections import deque
+
+from src.constants import (
+    DEFAULT_LOG_FORMAT,
+    MAX_TIMEOUT_CHECK_TUNNEL,
+    MONITOR_DRAIN_SECONDS,
+    MONITOR_FAILURE_RATE_THRESHOLD,
+    MONITOR_INTERVAL_SECONDS,
+    MONITOR_MIN_ROTATION_SECONDS,
+    MONITOR_PROBE_TIMEOUT_SECONDS,
+    MONITOR_RTT_THRESHOLD_SECONDS,
+    MONITOR_WINDOW,
+)
+from src.forwards import cancel_forwards, restore_forwards
+from src.inventory import get_host
+from src.start_ssh import (
+    TunnelBusyError,
+    TunnelError,
+    login_ssh_tunnel,
+    read_credentials,
+    remove_stale_socket,
+    reserve_code,
+    start_ssh_tunnel,
+)
+from src.test_connection import MuxProtocolError, control_socket_path, mux_alive_check
+from src.timings import PhaseTimer
+from src.tunnel_manager import TunnelManager
+from src.tunnel_lock import TunnelLockTimeout, tunnel_lock
+
+
+class EchoProbe:
+    """A `cat` session over the master. probe() times one line going there and back"""
+
+    def __init__(self, socket_path):
+        self.process = subprocess.Popen(
+            [
+                "ssh",
+                "-o",
+                f"ControlPath={socket_path}",
+                "-o",
+                "ControlMaster=no",
+                "-T",
+                "dummy_arg",
+                "cat",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        self.buffer = b""
+        self.counter = 0
+
+    def probe(self, timeout=MONITOR_PROBE_TIMEOUT_SECONDS):
+        """Round trip in seconds, or None if it failed or took longer than timeout"""
+        self.counter += 1
+        line = f"{self.counter}\n".encode()
+        start = time.monotonic()
+        try:
+            self.process.stdin.write(line)
+            self.process.stdin.flush()
+        except OSError:
+            return None
+        while line not in self.buffer:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0 or not self.selector.select(remaining):
+                return None
+            data = os.read(self.process.stdout.fileno(), 4096)
+            if not data:
+                return None
+            self.buffer += data
+        self.buffer = self.buffer.split(line, 1)[1]
+        return time.monotonic() - start
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        self.selector.close()
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+
+
+def link_is_degraded(
+    window,
+    rtt_threshold=MONITOR_RTT_THRESHOLD_SECONDS,
+    failure_rate=MONITOR_FAILURE_RATE_THRESHOLD,
+):
+    """window: recent round trips (None = failed). True if the master should be replaced"""
+    if len(window) < max(2, window.maxlen // 2):
+        # not enough data yet
+        return False
+    failures = sum(1 for rtt in window if rtt is None)
+    if failures / len(window) >= failure_rate:
+        return True
+    rtts = [rtt for rtt in window if rtt is not None]
+    return statistics.median(rtts) > rtt_threshold
+
+
+def master_pid(socket_path):
+    try:
+        return mux_alive_check(socket_path, timeout=MONITOR_PROBE_TIMEOUT_SECONDS)
+    except MuxProtocolError:
+        return None
+
+
+def stop_master(socket_path):
+    """ssh -O stop: the master removes its socket, takes no new sessions and exits once its current
+    sessions end. Return False if it didn't answer"""
+    try:
+        completed = subprocess.run(
+            ["ssh", "-o", f"ControlPath={socket_path}", "-O", "stop", "dummy_arg"],
+            capture_output=True,
+            timeout=MAX_TIMEOUT_CHECK_TUNNEL,
+        )
+    except subprocess.TimeoutExpired:
+        return False
+    return completed.returncode == 0
+
+
+def wait_for_exit(pid, timeout):
+    """True if process pid is gone within timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.1)
+
+
+def rotate_master(host, old_pid, drain_seconds=MONITOR_DRAIN_SECONDS):
+    """Replace the current master with a freshly logged-in one. Return the new master's pid
+
+    Under the tunnel lock: the totp window is reserved (and waited for) first, then the old master gets its
+    forwards cancelled (freeing their local ports) and is stopped with ssh -O stop, which removes its socket,
+    and the new master logs in on the same ControlPath. New ssh commands only go without a master for the
+    few hundred ms of that login. Sessions on the old master keep running until they end, then it exits.
+    Waits up to drain_seconds for that before restoring the forwards on the new master.
+    """
+    ssh_user, SECRET_rc_password = read_credentials(host)
+    ssh_dest = f"{ssh_user}@{host.hostname}"
+    socket_path = control_socket_path(
+        ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+    )
+    timer = PhaseTimer(enabled=False)
+
+    try:
+        with tunnel_lock(
+            ssh_dest=ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+        ):
+            code = reserve_code(host, timer)
+            replacing = old_pid is not None
+            if replacing:
+                cancel_forwards(host, socket_path)
+                if not stop_master(socket_path):
+                    # its sessions are as stuck as its socket
+                    logging.warning(
+                        f"Old master (pid {old_pid}) doesn't answer on its socket. Killing it"
+                    )
+                    try:
+                        os.kill(old_pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            # a killed master leaves its socket behind
+            remove_stale_socket(ssh_dest, host)
+            login_ssh_tunnel(ssh_dest, SECRET_rc_password, timer, host, code=code)
+            new_pid = master_pid(socket_path)
+            if new_pid is None:
+                raise TunnelError(
+                    f"New master for {host.name} is not answering at {socket_path}"
+                )
+    except TunnelLockTimeout as e:
+        raise TunnelBusyError(str(e))
+
+    logging.warning(f"Replaced master for {host.name} (pid {old_pid} -> {new_pid})")
+    if replacing and not wait_for_exit(old_pid, drain_seconds):
+        logging.warning(
+            f"Old master (pid {old_pid}) still has sessions open. It exits when they end"
+        )
+    # forwards lived on the old master
+    restore_forwards(host, ssh_user=ssh_user)
+    return new_pid
+
+
+def monitor_link(
+    host,
+    interval=MONITOR_INTERVAL_SECONDS,
+    window_size=MONITOR_WINDOW,
+    min_rotation_seconds=MONITOR_MIN_ROTATION_SECONDS,
+):
+    """Run forever: probe the master of host and replace it when the link degrades"""
+    socket_path = TunnelManager(host).socket_path
+    window = deque(maxlen=window_size)
+    probe = None
+    pid = None
+    last_rotation = -float("inf")
+    logging.warning(
+        f"Monitoring the link of {host.name} (probing every {interval}s). Press Ctrl-C to stop."
+    )
+    try:
+        while True:
+            if probe is None or not probe.is_alive():
+                if probe is not None:
+                    probe.close()
+                # (re)start on the current master, opening it if it's gone
+                if master_pid(socket_path) is None and not start_ssh_tunnel(host):
+                    time.sleep(interval)
+                    continue
+                pid = master_pid(socket_path)
+                probe = EchoProbe(socket_path)
+
+            rtt = probe.probe()
+            window.append(rtt)
+            logging.info(
+                f"{host.name}: round trip {'failed' if rtt is None else f'{rtt * 1000:.1f} ms'}"
+            )
+
+            if (
+                link_is_degraded(window)
+                and time.monotonic() - last_rotation > min_rotation_seconds
+            ):
+                logging.warning(
+                    f"Link of {host.name} is degraded. Replacing the master"
+                )
+                last_rotation = time.monotonic()
+                # the pid from before the link went bad, in case the master no longer answers
+                pid = master_pid(socket_path) or pid
+                # the probe's session would keep the old master from exiting
+                probe.close()
+                probe = None
+                try:
+                    pid = rotate_master(host, pid)
+                except (TunnelError, OSError) as e:
+                    logging.error(f"Unable to replace master for {host.name}: {e}")
+                else:
+                    window.clear()
+                    probe = EchoProbe(socket_path)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        logging.warning("Stopping link monitor (the tunnel itself is left open)")
+    finally:
+        if probe is not None:
+            probe.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("--interval", type=float, default=MONITOR_INTERVAL_SECONDS)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+    try:
+        monitor_link(get_host(args.host), interval=args.interval)
+    except TunnelError as e:
+        logging.error(str(e))
+        sys.exit(1)
@@ -0,0 +1,282 @@
+# RECONNECT AS SOON AS THE NETWORK CHANGES (LINUX)
+#
+# after suspend/resume or switching between wifi and vpn the master's tcp connection is dead, but the
+# master process and its socket are still there, so the next ssh hangs until keepalives time out.
+# this listens for address/route changes (netlink, or polling /proc/net/route if that's not available),
+# then opens a session over each master with a short timeout and replaces the masters that don't answer.
+#
+#   python -m src.netwatch [--host cannon]      (or start-ssh --daemon --watch-network)
+
+import argparse
+import hashlib
+import logging
+import os
+import signal
+import socket
+import subprocess
+import time
+
+from src.constants import (
+    DEFAULT_LOG_FORMAT,
+    NETWATCH_CHECK_TIMEOUT_SECONDS,
+    NETWATCH_POLL_SECONDS,
+    NETWATCH_SETTLE_SECONDS,
+)
+from src.inventory import get_host
+from src.start_ssh import start_ssh_tunnel
+from src.test_connection import MuxProtocolError, mux_alive_check
+from src.tunnel_lock import TunnelLockTimeout, tunnel_lock
+from src.tunnel_manager import TunnelManager
+
+# multicast groups from linux/rtnetlink.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+PROC_ROUTE_FILES = ["/proc/net/route", "/proc/net/ipv6_route"]
+
+
+class NetworkWatcher:
+    """wait_for_change(timeout) returns True once the network changed (and has settled)"""
+
+    def __init__(self, poll_interval=NETWATCH_POLL_SECONDS):
+        self.poll_interval = poll_interval
+        self.sock = None
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE
+            )
+            self.sock.bind(
+                (
+                    0,
+                    RTMGRP_LINK
+                    | RTMGRP_IPV4_IFADDR
+                    | RTMGRP_IPV4_ROUTE
+                    | RTMGRP_IPV6_IFADDR
+                    | RTMGRP_IPV6_ROUTE,
+                )
+            )
+            logging.info("Watching network changes with netlink")
+        except (AttributeError, OSError) as e:
+            # AttributeError: no AF_NETLINK outside linux
+            self.sock = None
+            logging.info(f"Netlink not available ({e}). Polling the routing table")
+        self.routes = self._routes_digest()
+        if self.sock is None and self.routes is None:
+            logging.warning(
+                "Unable to watch network changes on this system (linux only)"
+            )
+
+    def _routes_digest(self):
+        digest = hashlib.sha1()
+        found = False
+        for path in PROC_ROUTE_FILES:
+            try:
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+                found = True
+            except OSError:
+                pass
+        return digest.hexdigest() if found else None
+
+    def _netlink_event(self, timeout):
+        """True if a netlink message arrived within timeout (drains what's queued)"""
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.recv(65536)
+        except socket.timeout:
+            return False
+        self.sock.setblocking(False)
+        try:
+            while self.sock.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def _poll_event(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            routes = self._routes_digest()
+            if routes != self.routes:
+                self.routes = routes
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def _event(self, timeout):
+        if self.sock is not None:
+            return self._netlink_event(timeout)
+        if self.routes is not None:
+            return self._poll_event(timeout)
+        time.sleep(timeout)
+        return False
+
+    def wait_for_change(self, timeout, settle=NETWATCH_SETTLE_SECONDS):
+        if not self._event(timeout):
+            return False
+        # an interface coming up sends a burst of messages (link, address, routes). wait until it's quiet
+        while self._event(settle):
+            pass
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+def has_default_route():
+    """False if we know there is no default route (no network yet). True if there is or we can't tell"""
+    found_file = False
+    for path in PROC_ROUTE_FILES:
+        try:
+            with open(path, "rt") as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        found_file = True
+        for line in lines:
+            fields = line.split()
+            # ipv4: destination and mask are the 2nd and 8th columns. ipv6: ::/0 is 32 zeros, prefix 00
+            if (
+                path.endswith("/route")
+                and len(fields) > 7
+                and fields[1] == "00000000"
+                and fields[7] == "00000000"
+            ):
+                return True
+            if (
+                path.endswith("ipv6_route")
+                and len(fields) > 9
+                and fields[0] == "0" * 32
+                and fields[1] == "00"
+                and fields[9] != "lo"
+            ):
+                return True
+    return not found_file
+
+
+def is_master_responsive(socket_path, timeout=NETWATCH_CHECK_TIMEOUT_SECONDS):
+    """Open a session over the master (needs a round trip to the server). False if it doesn't work in time"""
+    try:
+        completed = subprocess.run(
+            [
+                "ssh",
+                "-o",
+                f"ControlPath={socket_path}",
+                "-o",
+                "ControlMaster=no",
+                "-T",
+                "dummy_arg",
+                "true",
+            ],
+            capture_output=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return False
+    return completed.returncode == 0
+
+
+def stop_dead_master(socket_path, timeout=NETWATCH_CHECK_TIMEOUT_SECONDS):
+    """Make the master at socket_path exit, and make sure its socket is gone. Call with the tunnel lock held,
+    so the socket isn't one a concurrent start-ssh just made"""
+    try:
+        pid = mux_alive_check(socket_path, timeout=timeout)
+    except MuxProtocolError:
+        pid = None
+    if pid is not None:
+        try:
+            # ssh removes its socket when it gets SIGTERM
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + timeout
+        while os.path.exists(socket_path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+
+def _socket_id(socket_path):
+    """(device, inode) of the socket file, None if there is none"""
+    try:
+        path_stat = os.stat(socket_path)
+    except FileNotFoundError:
+        return None
+    return path_stat.st_dev, path_stat.st_ino
+
+
+def check_and_repair(host):
+    """After a network change: replace the master of host if it doesn't answer. Return True if the tunnel works"""
+    manager = TunnelManager(host)
+    socket_path = manager.socket_path
+    if not os.path.exists(socket_path):
+        # nothing to repair (the supervisor opens tunnels that aren't there)
+        return start_ssh_tunnel(host)
+    start = time.monotonic()
+    checked_socket = _socket_id(socket_path)
+    if is_master_responsive(socket_path):
+        logging.info(f"Master for {host.name} survived the network change")
+        return True
+    logging.warning(
+        f"Master for {host.name} is dead after the network change. Reconnecting"
+    )
+    try:
+        with tunnel_lock(
+            ssh_dest=manager.ssh_dest,
+            ssh_port=host.port,
+            socket_suffix=host.control_suffix,
+        ):
+            # a start-ssh may have replaced the master while we checked
+            if _socket_id(socket_path) == checked_socket:
+                stop_dead_master(socket_path)
+    except TunnelLockTimeout as e:
+        logging.error(f"Unable to replace master for {host.name}: {e}")
+        return False
+    is_open = start_ssh_tunnel(host)
+    if is_open:
+        logging.warning(
+            f"Reconnected {host.name} {time.monotonic() - start:.1f}s after the network change settled"
+        )
+    return is_open
+
+
+def watch_network(hosts):
+    """Run forever: check (and repair) the tunnels of hosts whenever the network changes"""
+    watcher = NetworkWatcher()
+    logging.warning(
+        f"Watching network changes for {', '.join(host.name for host in hosts)}. Press Ctrl-C to stop."
+    )
+    try:
+        while True:
+            if not watcher.wait_for_change(timeout=3600):
+                continue
+            if not has_default_route():
+                logging.info("Network changed, but there is no default route yet")
+                continue
+            logging.info("Network changed. Checking tunnels")
+            for host in hosts:
+                check_and_repair(host)
+    except KeyboardInterrupt:
+        logging.warning("Stopping network watcher")
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+    watch_network([get_host(args.host)])
@@ -0,0 +1,138 @@
+# PICK THE FASTEST LOGIN NODE BEHIND A ROUND-ROBIN DNS NAME (OR FROM A LIST OF NODE NAMES)
+
+import argparse
+import json
+import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    DEFAULT_LOG_FORMAT,
+    NODE_PROBE_CACHE_SECONDS,
+    NODE_PROBE_TIMEOUT_SECONDS,
+)
+
+NODE_PROBES_FILE = f"{APP_STATE_FOLDER}/node_probes.json"
+
+
+def resolve_candidates(host):
+    """Login nodes to probe: the host's `nodes` from the inventory, or every address its hostname resolves to"""
+    if host.nodes:
+        return list(host.nodes)
+    addresses = []
+    for *_, sockaddr in socket.getaddrinfo(
+        host.hostname, host.port, type=socket.SOCK_STREAM
+    ):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
+
+
+def probe_node(node, port=22, timeout=NODE_PROBE_TIMEOUT_SECONDS):
+    """Time the tcp connect and the ssh banner of one login node"""
+    result = {"node": node, "connect_ms": None, "banner_ms": None, "error": None}
+    start = time.monotonic()
+    try:
+        with socket.create_connection((node, port), timeout=timeout) as sock:
+            result["connect_ms"] = (time.monotonic() - start) * 1000
+            banner = b""
+            while b"\n" not in banner and len(banner) < 1024:
+                chunk = sock.recv(256)
+                if not chunk:
+                    break
+                banner += chunk
+            if not banner.startswith(b"SSH-"):
+                raise OSError(f"Not an ssh server (banner: {banner[:40]!r})")
+            result["banner_ms"] = (time.monotonic() - start) * 1000
+    except OSError as e:
+        result["error"] = str(e)
+    return result
+
+
+def probe_nodes(nodes, port=22, timeout=NODE_PROBE_TIMEOUT_SECONDS):
+    """Probe all nodes in parallel. Return results sorted fastest first (failed probes last)"""
+    with ThreadPoolExecutor(max_workers=max(1, len(nodes))) as executor:
+        results = list(
+            executor.map(lambda node: probe_node(node, port, timeout), nodes)
+        )
+    return sorted(
+        results,
+        key=lambda r: (r["banner_ms"] is None, r["banner_ms"] or 0),
+    )
+
+
+def _load_probes(probes_file=NODE_PROBES_FILE):
+    try:
+        return json.loads(Path(probes_file).expanduser().read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_probes(probes, probes_file=NODE_PROBES_FILE):
+    probes_file_full = Path(probes_file).expanduser()
+    probes_file_full.parent.mkdir(parents=True, exist_ok=True)
+    probes_file_full.write_text(json.dumps(probes, indent=1))
+
+
+def forget_node_probes(host, probes_file=NODE_PROBES_FILE):
+    """Drop the saved probe results of host, so the next login probes again (e.g. after a failed login)"""
+    probes = _load_probes(probes_file)
+    if probes.pop(host.alias, None) is not None:
+        logging.info(f"Dropped saved login node probes for {host.alias}")
+        _save_probes(probes, probes_file)
+
+
+def select_fastest_node(
+    host, max_age=NODE_PROBE_CACHE_SECONDS, probes_file=NODE_PROBES_FILE
+):
+    """Return the login node (address or node name) of `host` with the fastest ssh banner.
+    Uses saved probe results if they are younger than max_age seconds. None if no node answered
+    """
+    probes = _load_probes(probes_file)
+    cached = probes.get(host.alias)
+    if cached and time.time() - cached["probed_at"] < max_age:
+        results = cached["results"]
+        logging.info(
+            f"Using login node probes for {host.alias} from {time.time() - cached['probed_at']:.0f}s ago"
+        )
+    else:
+        try:
+            candidates = resolve_candidates(host)
+        except OSError as e:
+            logging.warning(f"Unable to resolve login nodes of {host.alias}: {e}")
+            return None
+        logging.info(f"Probing {len(candidates)} login node(s) for {host.alias}")
+        results = probe_nodes(candidates, host.port)
+        probes[host.alias] = {"probed_at": time.time(), "results": results}
+        _save_probes(probes, probes_file)
+
+    for r in results:
+        if r["error"]:
+            logging.info(f"  {r['node']}: {r['error']}")
+        else:
+            logging.info(
+                f"  {r['node']}: connect {r['connect_ms']:.1f}ms, banner {r['banner_ms']:.1f}ms"
+            )
+    if not results or results[0]["error"]:
+        logging.warning(f"No login node of {host.alias} answered the probe")
+        return None
+    return results[0]["node"]
+
+
+if __name__ == "__main__":
+    from src.inventory import get_host
+
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    args = parser.parse_args()
+
+    # always probe again when run by hand
+    fastest = select_fastest_node(get_host(args.host), max_age=0)
+    logging.warning(f"Fastest login node: {fastest}")
@@ -1,42 +1,183 @@
 import getpass
+import json
 import logging
+import os
+import time
 
 import keyring
 from keyring.errors import PasswordDeleteError
 import pyotp
+from src.clock_skew import get_clock_offset
 from src.constants import (
+    APP_KEYCHAIN_PREFIX,
     PASSWORD_SERVICE_NAME,
     SECRET_TOKEN_SERVICE_NAME,
+    SECRETS_FILE_ENV_VAR,
     SSH_USER_SERVICE_NAME,
+    TOTP_MIN_REMAINING_SECONDS,
+    TOTP_SEND_NEXT_WINDOW,
 )
+from src.secrets_agent import query_agent, stop_agent
+from src.totp_steps import reserve_step
 
 username = getpass.getuser()
 
+SECRET_SERVICE_NAMES = [
+    SECRET_TOKEN_SERVICE_NAME,
+    PASSWORD_SERVICE_NAME,
+    SSH_USER_SERVICE_NAME,
+]
+
+
+def service_name(default_service_name, keychain_prefix=APP_KEYCHAIN_PREFIX):
+    """Keyring service name in the credential namespace `keychain_prefix`
+    e.g. service_name(PASSWORD_SERVICE_NAME, "python-totp-ssh.otherlab") -> "python-totp-ssh.otherlab.ssh-password"
+    """
+    return keychain_prefix + default_service_name.removeprefix(APP_KEYCHAIN_PREFIX)
+
+
+def read_secret_store(keychain_prefixes=(APP_KEYCHAIN_PREFIX,)):
+    """Read all secrets from the keyring (or from the TOTP_SECRETS_FILE json file if set).
+    Return {service name: secret or None}"""
+    names = [
+        service_name(name, prefix)
+        for prefix in keychain_prefixes
+        for name in SECRET_SERVICE_NAMES
+    ]
+    secrets_file = os.environ.get(SECRETS_FILE_ENV_VAR)
+    if secrets_file:
+        with open(secrets_file, "rt") as f:
+            stored = json.load(f)
+        return {name: stored.get(name) for name in names}
+    return {name: keyring.get_password(name, username) for name in names}
+
+
+def _get_secret(name):
+    """Get one secret: from the secrets agent if one is running, otherwise from the store"""
+    agent_secrets = query_agent()
+    if agent_secrets is not None and name in agent_secrets:
+        return agent_secrets[name]
+
+    secrets_file = os.environ.get(SECRETS_FILE_ENV_VAR)
+    if secrets_file:
+        with open(secrets_file, "rt") as f:
+            return json.load(f).get(name)
+    return keyring.get_password(name, username)
 
-def get_totp_code():
-    return keyring.get_password(SECRET_TOKEN_SERVICE_NAME, username)
 
+def get_totp_code(keychain_prefix=APP_KEYCHAIN_PREFIX):
+    return _get_secret(service_name(SECRET_TOKEN_SERVICE_NAME, keychain_prefix))
 
-def get_rc_password():
-    return keyring.get_password(PASSWORD_SERVICE_NAME, username)
 
+def get_rc_password(keychain_prefix=APP_KEYCHAIN_PREFIX):
+    return _get_secret(service_name(PASSWORD_SERVICE_NAME, keychain_prefix))
 
-def get_ssh_user():
-    return keyring.get_password(SSH_USER_SERVICE_NAME, username)
 
+def get_ssh_user(keychain_prefix=APP_KEYCHAIN_PREFIX):
+    return _get_secret(service_name(SSH_USER_SERVICE_NAME, keychain_prefix))
 
-def generate_otp():
-    SECRET_totp_code = get_totp_code()
+
+def stop_secrets_agent():
+    """Stop the secrets agent (if running) so it doesn't keep serving old passwords"""
+    if stop_agent():
+        logging.info("Stopped secrets agent so it doesn't serve old passwords")
+
+
+def _server_totp(keychain_prefix):
+    """(pyotp.TOTP, clock offset), or (None, offset) if the totp secret is missing"""
+    SECRET_totp_code = get_totp_code(keychain_prefix)
+    clock_offset = get_clock_offset()
     if SECRET_totp_code is None:
+        return None, clock_offset
+    return pyotp.TOTP(SECRET_totp_code), clock_offset
+
+
+def reserve_otp_step(
+    min_remaining_seconds=TOTP_MIN_REMAINING_SECONDS,
+    send_next_window=TOTP_SEND_NEXT_WINDOW,
+    keychain_prefix=APP_KEYCHAIN_PREFIX,
+):
+    """Reserve the totp window of the next code to send and sleep until it can be sent. Return its step
+    (None if the totp secret is missing).
+
+    If fewer than min_remaining_seconds are left in the totp window, use the next window. If the code
+    of that window was already sent (see src/totp_steps.py), use the first window after it whose code
+    wasn't. Sleeps until that window starts, or (send_next_window=True) until the window before it.
+    Uses the local clock corrected by the last measured clock skew (see src/clock_skew.py).
+    """
+    totp, clock_offset = _server_totp(keychain_prefix)
+    if totp is None:
         return None
 
-    return pyotp.TOTP(SECRET_totp_code).now()
+    if clock_offset:
+        logging.info(f"Correcting local clock by {clock_offset:+.3f}s")
+    now = time.time() + clock_offset
+    step = int(now // totp.interval)
+    remaining = totp.interval - now % totp.interval
+    if remaining < min_remaining_seconds:
+        logging.info(
+            f"Only {remaining:.2f}s left in totp window (< {min_remaining_seconds}s). Using code for the next window"
+        )
+        step += 1
+
+    reserved = reserve_step(keychain_prefix, step)
+    if reserved != step:
+        logging.info(
+            f"The code for this window was already sent. Using the code {reserved - step} window(s) later"
+        )
+    # the code of a window is accepted from the window before it if the server allows the adjacent window
+    send_from_step = reserved - 1 if send_next_window else reserved
+    wait = send_from_step * totp.interval - (time.time() + clock_offset)
+    if wait > 0:
+        logging.info(f"Waiting {wait:.2f}s for the totp window to start")
+        time.sleep(wait)
+    return reserved
+
+
+def otp_for_step(
+    step,
+    min_remaining_seconds=TOTP_MIN_REMAINING_SECONDS,
+    send_next_window=TOTP_SEND_NEXT_WINDOW,
+    keychain_prefix=APP_KEYCHAIN_PREFIX,
+):
+    """The code of a window reserved with reserve_otp_step. If fewer than min_remaining_seconds are left
+    in it by now (the login took longer than expected), generate_otp a new one instead
+    """
+    totp, clock_offset = _server_totp(keychain_prefix)
+    if totp is None:
+        return None
+    remaining = (step + 1) * totp.interval - (time.time() + clock_offset)
+    if remaining < min_remaining_seconds:
+        logging.info(
+            f"Only {remaining:.2f}s left in the reserved totp window {step}. Reserving another one"
+        )
+        return generate_otp(min_remaining_seconds, send_next_window, keychain_prefix)
+    logging.info(f"Using totp code of window {step}")
+    return totp.at(step * totp.interval)
+
+
+def generate_otp(
+    min_remaining_seconds=TOTP_MIN_REMAINING_SECONDS,
+    send_next_window=TOTP_SEND_NEXT_WINDOW,
+    keychain_prefix=APP_KEYCHAIN_PREFIX,
+):
+    """Generate a 6-digit code that was never sent before and is not about to expire (reserve_otp_step,
+    then otp_for_step). Sleeps until it can be sent"""
+    step = reserve_otp_step(min_remaining_seconds, send_next_window, keychain_prefix)
+    if step is None:
+        return None
+    return otp_for_step(step, min_remaining_seconds, send_next_window, keychain_prefix)
 
 
-def prompt_and_store_passwords(override_username=None):
+def prompt_and_store_passwords(
+    override_username=None, keychain_prefix=APP_KEYCHAIN_PREFIX
+):
     """Prompt user for passwords and store them in keychain. Return true if all passwords are set successfully"""
 
     local_username = getpass.getuser()
+    password_service = service_name(PASSWORD_SERVICE_NAME, keychain_prefix)
+    token_service = service_name(SECRET_TOKEN_SERVICE_NAME, keychain_prefix)
+    user_service = service_name(SSH_USER_SERVICE_NAME, keychain_prefix)
 
     if override_username:
         user_input_ssh_uname = override_username
@@ -71,61 +212,62 @@ def prompt_and_store_passwords(override_username=None):
 
     # Save all passwords to keyring
     try:
-        keyring.set_password(PASSWORD_SERVICE_NAME, local_username, user_input_pass)
-        keyring.set_password(
-            SECRET_TOKEN_SERVICE_NAME, local_username, user_input_token
-        )
-        keyring.set_password(
-            SSH_USER_SERVICE_NAME, local_username, user_input_ssh_uname
-        )
+        keyring.set_password(password_service, local_username, user_input_pass)
+        keyring.set_password(token_service, local_username, user_input_token)
+        keyring.set_password(user_service, local_username, user_input_ssh_uname)
 
     except Exception:
         raise Exception("Unable to save all passwords to keyring. Exiting script.")
 
     logging.info("Saved passwords to keyring successfully. Done!")
+    stop_secrets_agent()
 
     # check that all passwords are set successfully
-    return are_all_passwords_set()
+    return are_all_passwords_set(keychain_prefix)
 
 
-def remove_passwords():
+def remove_passwords(keychain_prefix=APP_KEYCHAIN_PREFIX):
     local_username = getpass.getuser()
+    password_service = service_name(PASSWORD_SERVICE_NAME, keychain_prefix)
+    token_service = service_name(SECRET_TOKEN_SERVICE_NAME, keychain_prefix)
+    user_service = service_name(SSH_USER_SERVICE_NAME, keychain_prefix)
+    stop_secrets_agent()
 
     del_errors = 0
 
     try:
-        keyring.delete_password(PASSWORD_SERVICE_NAME, local_username)
+        keyring.delete_password(password_service, local_username)
     except PasswordDeleteError as e:
         del_errors += 1
-        logging.warning(str([*e.args, PASSWORD_SERVICE_NAME, local_username]))
+        logging.warning(str([*e.args, password_service, local_username]))
     try:
-        keyring.delete_password(SECRET_TOKEN_SERVICE_NAME, local_username)
+        keyring.delete_password(token_service, local_username)
     except PasswordDeleteError as e:
         del_errors += 1
-        logging.warning(str([*e.args, SECRET_TOKEN_SERVICE_NAME, local_username]))
+        logging.warning(str([*e.args, token_service, local_username]))
     try:
-        keyring.delete_password(SSH_USER_SERVICE_NAME, local_username)
+        keyring.delete_password(user_service, local_username)
     except PasswordDeleteError as e:
         del_errors += 1
-        logging.warning(str([*e.args, SSH_USER_SERVICE_NAME, local_username]))
+        logging.warning(str([*e.args, user_service, local_username]))
 
     if del_errors > 0:
         logging.warning(
             "At least one error removing passwords from keychain. This could mean they have already been deleted. If you are concerned, open the keychain app and manually delete them."
         )
         logging.warning(
-            f"Look for the following service names in the keychain app: \n\t- {PASSWORD_SERVICE_NAME}\n\t- {SSH_USER_SERVICE_NAME}\n\t- {SECRET_TOKEN_SERVICE_NAME}"
+            f"Look for the following service names in the keychain app: \n\t- {password_service}\n\t- {user_service}\n\t- {token_service}"
         )
 
     else:
         logging.info("Keyring passwords removed successfully.")
 
 
-def are_all_passwords_set():
+def are_all_passwords_set(keychain_prefix=APP_KEYCHAIN_PREFIX):
     """Check if all passwords are set. Return TRUE if any password is not set"""
     attempts = [
-        get_totp_code() is not None,
-        get_rc_password() is not None,
-        get_ssh_user() is not None,
+        get_totp_code(keychain_prefix) is not None,
+        get_rc_password(keychain_prefix) is not None,
+        get_ssh_user(keychain_prefix) is not None,
     ]
     return all(attempts)
@@ -0,0 +1,150 @@
+# SPREAD NEW SSH SESSIONS OVER THE POOL OF MASTERS OPENED BY `start-ssh --pool N`
+#
+# usage from a shell:
+#   ssh "$(python -m src.pool next)" some-command
+#   rsync -a data/ "$(python -m src.pool next)":data/
+
+import argparse
+import fcntl
+import glob
+import logging
+import re
+import sys
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    DEFAULT_LOG_FORMAT,
+    SSH_CONTROLMASTERS_FOLDER,
+)
+from src.inventory import get_host
+from src.ssh_config import read_ssh_user_from_config
+from src.test_connection import MuxProtocolError, mux_alive_check
+
+POOL_COUNTER_FOLDER = f"{APP_STATE_FOLDER}/pool"
+
+# listening sockets have the __SO_ACCEPTCON flag in /proc/net/unix, accepted connections don't
+UNIX_SOCKET_ACCEPTCON_FLAGS = "00010000"
+
+
+def live_pool_members(host, ssh_user, controlmaster_path=SSH_CONTROLMASTERS_FOLDER):
+    """Return {pool member alias: control socket path} of the pool masters of host that are alive"""
+    prefix = Path(controlmaster_path).expanduser() / (
+        f"{ssh_user}@{host.hostname}:{host.port}.{host.alias}-pool-"
+    )
+    members = {}
+    for socket_path in glob.glob(f"{glob.escape(str(prefix))}*"):
+        if not re.fullmatch(r"\d+", socket_path[len(str(prefix)) :]):
+            # lock files etc.
+            continue
+        try:
+            if mux_alive_check(socket_path) is None:
+                continue
+        except MuxProtocolError:
+            # something answers, assume it's a master speaking a newer protocol
+            pass
+        member_alias = f"{host.alias}-pool-{socket_path[len(str(prefix)):]}"
+        members[member_alias] = socket_path
+    return members
+
+
+def session_aliases(host):
+    """ssh aliases to spread parallel sessions over: the live pool masters, or just the host alias"""
+    ssh_user = host.user or read_ssh_user_from_config(alias=host.alias)
+    aliases = sorted(live_pool_members(host, ssh_user)) if ssh_user else []
+    return aliases or [host.alias]
+
+
+def count_sessions(socket_paths):
+    """Number of clients connected to each control socket (linux only). None if unknown
+
+    ssh masters bind to "<ControlPath>.<16 random chars>" and then rename it, so /proc/net/unix
+    lists the connections under that temporary name
+    """
+    try:
+        with open("/proc/net/unix", "rt") as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+
+    counts = {path: 0 for path in socket_paths}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 8 or fields[3] == UNIX_SOCKET_ACCEPTCON_FLAGS:
+            continue
+        bound_path = fields[7]
+        for path in socket_paths:
+            if bound_path == path or re.fullmatch(
+                rf"{re.escape(path)}\.\w{{16}}", bound_path
+            ):
+                counts[path] += 1
+    return counts
+
+
+def _next_round_robin(host, size, counter_folder=POOL_COUNTER_FOLDER):
+    """Shared counter (across processes) for round-robin placement"""
+    counter_file = Path(counter_folder).expanduser() / f"{host.alias}.counter"
+    counter_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(counter_file, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        counter = int(f.read().strip() or 0)
+        f.seek(0)
+        f.truncate()
+        f.write(str(counter + 1))
+    return counter % size
+
+
+def pick_pool_member(host):
+    """ssh alias to use for the next session: the least loaded live pool master,
+    round-robin if the load is unknown, or the plain host alias if no pool master is open
+    """
+    ssh_user = host.user or read_ssh_user_from_config(alias=host.alias)
+    if ssh_user is None:
+        from src.passwords import get_ssh_user
+
+        ssh_user = get_ssh_user(host.keychain_prefix)
+
+    members = live_pool_members(host, ssh_user)
+    if not members:
+        logging.info(f"No pool masters open for {host.alias}. Using {host.alias}")
+        return host.alias
+
+    aliases = sorted(members)
+    sessions = count_sessions(list(members.values()))
+    if sessions is not None:
+        least = min(sessions.values())
+        aliases = [alias for alias in aliases if sessions[members[alias]] == least]
+        logging.info(
+            f"Pool sessions: { {alias: sessions[path] for alias, path in members.items()} }"
+        )
+    # round-robin among the (least loaded) candidates
+    return aliases[_next_round_robin(host, len(aliases))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", help='"next" (print the ssh alias to use) or "list"')
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    host = get_host(args.host)
+    match args.action.lower():
+        case "next":
+            print(pick_pool_member(host))
+        case "list":
+            ssh_user = host.user or read_ssh_user_from_config(alias=host.alias)
+            members = live_pool_members(host, ssh_user)
+            sessions = count_sessions(list(members.values())) or {}
+            for alias, path in sorted(members.items()):
+                print(f"{alias}\t{sessions.get(path, '?')} session(s)")
+        case _:
+            logging.error(f"Action arg is not defined: {args.action}")
+            sys.exit(1)
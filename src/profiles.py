@@ -0,0 +1,276 @@
+# MEASURE CONNECTION PROFILES (CIPHER, COMPRESSION, X11) AND KEEP THE FASTEST
+#
+# logs in once per candidate profile with a throwaway master (each login waits for its own totp window,
+# since a code can't be used twice, see src/totp_steps.py) and measures:
+#   - handshake: from starting ssh until the login is done
+#   - rtt: median time for a line to come back from `cat` in an open session
+#   - throughput: MB/s copying a random file from the cluster
+# the fastest profile is saved and used by start-ssh and the generated ssh config from then on.
+#
+#   python -m src.profiles benchmark [--x11]     (4 logins, 8 with --x11 off/on; takes a few minutes)
+#   python -m src.profiles show
+
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from itertools import product
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    DEFAULT_LOG_FORMAT,
+    MAX_TIMEOUT_CHECK_TUNNEL,
+    PROFILE_BENCH_TRANSFER_MB,
+)
+
+PROFILES_FILE = f"{APP_STATE_FOLDER}/profiles.json"
+
+CIPHERS = {
+    "aes-gcm": "aes128-gcm@openssh.com",
+    "chacha20": "chacha20-poly1305@openssh.com",
+}
+
+# round trips measured per profile
+RTT_SAMPLES = 20
+
+# profiles with throughput within this fraction of the best count as equally fast (then lower rtt wins)
+THROUGHPUT_TOLERANCE = 0.05
+
+
+def candidate_profiles(include_x11_off=False):
+    """{profile name: ssh options}"""
+    profiles = {}
+    x11_choices = ["yes", "no"] if include_x11_off else ["yes"]
+    for (cipher_name, cipher), compression, x11 in product(
+        CIPHERS.items(), ["no", "yes"], x11_choices
+    ):
+        name = f"{cipher_name}-compression-{compression}"
+        if include_x11_off:
+            name += f"-x11-{x11}"
+        profiles[name] = {
+            "Ciphers": cipher,
+            "Compression": compression,
+            "ForwardX11": x11,
+        }
+    return profiles
+
+
+def load_profiles(profiles_file=PROFILES_FILE):
+    """{alias: {"name", "options", "measured", "results"}}"""
+    try:
+        with open(Path(profiles_file).expanduser(), "rt") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def load_profile_options(alias, profiles_file=PROFILES_FILE):
+    """ssh options of the saved profile for alias ({} if it was never measured)"""
+    return load_profiles(profiles_file).get(alias, {}).get("options", {})
+
+
+def save_profile(alias, profile, profiles_file=PROFILES_FILE):
+    profiles = load_profiles(profiles_file)
+    profiles[alias] = profile
+    path = Path(profiles_file).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(profiles, indent=2))
+    tmp_path.replace(path)
+
+
+def _session_command(socket_path, remote_command):
+    return [
+        "ssh",
+        "-o",
+        f"ControlPath={socket_path}",
+        "-o",
+        "ControlMaster=no",
+        "-T",
+        "dummy_arg",
+        remote_command,
+    ]
+
+
+def measure_rtt(socket_path, samples=RTT_SAMPLES):
+    """Median seconds for a line to come back through `cat` on the cluster"""
+    process = subprocess.Popen(
+        _session_command(socket_path, "cat"),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        times = []
+        for i in range(samples):
+            start = time.perf_counter()
+            process.stdin.write(f"{i}\n".encode())
+            process.stdin.flush()
+            process.stdout.readline()
+            times.append(time.perf_counter() - start)
+    finally:
+        process.stdin.close()
+        process.wait(MAX_TIMEOUT_CHECK_TUNNEL)
+    return statistics.median(times)
+
+
+def measure_throughput(socket_path, remote_file):
+    """MB/s copying remote_file to this machine"""
+    start = time.perf_counter()
+    completed = subprocess.run(
+        _session_command(socket_path, f"cat {remote_file}"),
+        capture_output=True,
+        check=True,
+    )
+    seconds = time.perf_counter() - start
+    return len(completed.stdout) / 1024 / 1024 / seconds
+
+
+def benchmark_profiles(host, include_x11_off=False):
+    """Log in with every candidate profile and measure it. Return [result dict] (failed profiles have "error")"""
+    # imported here since start_ssh uses load_profile_options from this module
+    from src.start_ssh import (
+        TunnelError,
+        login_ssh_tunnel,
+        read_credentials,
+        reserve_code,
+    )
+    from src.test_connection import control_socket_path
+    from src.timings import PhaseTimer
+
+    ssh_user, SECRET_rc_password = read_credentials(host)
+    ssh_dest = f"{ssh_user}@{host.hostname}"
+    remote_file = f"/tmp/totp-profile-bench-{ssh_user}"
+    results = []
+    for name, options in candidate_profiles(include_x11_off).items():
+        control_suffix = f".profile-{name}"
+        socket_path = control_socket_path(
+            ssh_dest, ssh_port=host.port, socket_suffix=control_suffix
+        )
+        timer = PhaseTimer(enabled=False)
+        result = {"name": name, "options": options}
+        # each login needs its own totp window: wait for it before the handshake is timed
+        code = reserve_code(host, timer)
+        start = time.perf_counter()
+        try:
+            login_ssh_tunnel(
+                ssh_dest,
+                SECRET_rc_password,
+                timer,
+                host,
+                options={**options, **host.options},
+                control_suffix=control_suffix,
+                code=code,
+            )
+            result["handshake_seconds"] = time.perf_counter() - start
+            result["rtt_seconds"] = measure_rtt(socket_path)
+            # random data, so compression can't make it look faster than it is
+            subprocess.run(
+                _session_command(
+                    socket_path,
+                    f"head -c {PROFILE_BENCH_TRANSFER_MB}M /dev/urandom > {remote_file}",
+                ),
+                check=True,
+            )
+            try:
+                result["throughput_mb_per_second"] = measure_throughput(
+                    socket_path, remote_file
+                )
+            finally:
+                subprocess.run(_session_command(socket_path, f"rm -f {remote_file}"))
+        except (TunnelError, subprocess.SubprocessError, OSError) as e:
+            result["error"] = str(e)
+        finally:
+            subprocess.run(
+                ["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "dummy_arg"],
+                capture_output=True,
+            )
+        logging.info(f"Profile {name}: {result}")
+        results.append(result)
+        if "error" in result and "handshake_seconds" not in result:
+            # a failed login; don't burn more codes
+            logging.error(f"Login with profile {name} failed: {result['error']}")
+            break
+    return results
+
+
+def pick_best(results):
+    """Fastest throughput (within THROUGHPUT_TOLERANCE), then lowest rtt, then fastest handshake"""
+    measured = [r for r in results if "error" not in r]
+    if not measured:
+        return None
+    best_throughput = max(r["throughput_mb_per_second"] for r in measured)
+    fast = [
+        r
+        for r in measured
+        if r["throughput_mb_per_second"] >= best_throughput * (1 - THROUGHPUT_TOLERANCE)
+    ]
+    return min(fast, key=lambda r: (r["rtt_seconds"], r["handshake_seconds"]))
+
+
+def print_results(results, best=None):
+    print(f"{'profile':<36} {'handshake':>10} {'rtt':>9} {'MB/s':>8}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['name']:<36} error: {r['error']}")
+            continue
+        marker = " *" if best is not None and r["name"] == best["name"] else ""
+        print(
+            f"{r['name']:<36} {r['handshake_seconds']:>9.2f}s {r['rtt_seconds'] * 1000:>7.1f}ms"
+            f" {r['throughput_mb_per_second']:>8.1f}{marker}"
+        )
+
+
+if __name__ == "__main__":
+    from src.inventory import get_host
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", help='"benchmark" or "show"')
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument(
+        "--x11",
+        action="store_true",
+        help="also try profiles without X11 forwarding (the winner may then turn it off)",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    host = get_host(args.host)
+    match args.action.lower():
+        case "benchmark":
+            results = benchmark_profiles(host, include_x11_off=args.x11)
+            best = pick_best(results)
+            print_results(results, best)
+            if best is None:
+                logging.error("No profile could be measured. Nothing saved")
+                sys.exit(1)
+            save_profile(
+                host.alias,
+                {
+                    "name": best["name"],
+                    "options": best["options"],
+                    "measured": time.time(),
+                    "results": results,
+                },
+            )
+            print(
+                f"Saved {best['name']} for {host.alias}. Re-run the ssh config step of ./scripts/install to use it in the ssh config too"
+            )
+        case "show":
+            profile = load_profiles().get(host.alias)
+            if profile is None:
+                print(f"No profile measured for {host.alias} (using ssh defaults)")
+            else:
+                print_results(profile["results"], profile)
+        case _:
+            logging.error(f"Action arg is not defined: {args.action}")
+            sys.exit(1)
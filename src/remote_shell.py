@@ -0,0 +1,231 @@
+# POOL OF LONG-LIVED REMOTE SHELLS OVER THE AUTHENTICATED MASTER(S)
+#
+# `ssh cannon cmd` opens a new session and starts a new remote shell every time, which is slow on a busy
+# login node. this keeps a few remote shells open and feeds commands to them, reading each command's
+# output up to a unique end marker.
+#
+#   with ShellPool(get_host()) as pool:
+#       result = pool.run("squeue --me")
+#
+#   python -m src.remote_shell "squeue --me" "sacct -X"      (or one command per line on stdin)
+
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import selectors
+import shlex
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+
+from src.constants import (
+    DEFAULT_LOG_FORMAT,
+    REMOTE_SHELL_COMMAND,
+    REMOTE_SHELL_DEFAULT_SIZE,
+    REMOTE_SHELL_TIMEOUT_SECONDS,
+)
+from src.inventory import get_host
+from src.pool import session_aliases
+
+
+class RemoteShellError(Exception):
+    pass
+
+
+@dataclass
+class CommandResult:
+    command: str
+    returncode: int
+    stdout: str
+    stderr: str
+    seconds: float
+
+
+class RemoteShell:
+    """One remote shell on a session of the existing master (never starts a new login)"""
+
+    def __init__(self, alias, shell_command=REMOTE_SHELL_COMMAND):
+        self.alias = alias
+        self.process = subprocess.Popen(
+            [
+                "ssh",
+                "-T",
+                "-o",
+                "ControlMaster=no",
+                "-o",
+                "BatchMode=yes",
+                alias,
+                shell_command,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # skip whatever the login scripts print
+        self.run(":", timeout=REMOTE_SHELL_TIMEOUT_SECONDS)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def run(self, command, timeout=REMOTE_SHELL_TIMEOUT_SECONDS):
+        """Run command in a subshell (so exit, cd or syntax errors don't affect later commands)"""
+        marker = f"__TOTP_END_{uuid.uuid4().hex}__".encode()
+        script = (
+            f"( eval {shlex.quote(command)} ) </dev/null; "
+            f"printf '\\n%s %d\\n' {marker.decode()} $?; printf '\\n%s\\n' {marker.decode()} >&2\n"
+        )
+        start = time.monotonic()
+        try:
+            self.process.stdin.write(script.encode())
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.close()
+            raise RemoteShellError(f"Remote shell on {self.alias} is gone")
+
+        outputs = {self.process.stdout: b"", self.process.stderr: b""}
+        # stdout ends with the marker and the exit status, stderr with the marker. a read may stop anywhere
+        # in them, so only a complete line counts
+        end_patterns = {
+            self.process.stdout: re.compile(b"\n" + marker + rb" (\d+)\n"),
+            self.process.stderr: re.compile(b"\n" + marker + b"\n"),
+        }
+        ends = {}
+        with selectors.DefaultSelector() as selector:
+            for stream in outputs:
+                selector.register(stream, selectors.EVENT_READ)
+            while len(ends) < len(outputs):
+                remaining = timeout - (time.monotonic() - start)
+                events = selector.select(remaining) if remaining > 0 else []
+                if not events:
+                    self.close()
+                    raise RemoteShellError(f"Timed out after {timeout}s: {command}")
+                for key, _ in events:
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        self.close()
+                        raise RemoteShellError(f"Remote shell on {self.alias} is gone")
+                    output = outputs[key.fileobj] + data
+                    outputs[key.fileobj] = output
+                    # only the new data (and the bytes before it) can complete the end line
+                    search_from = max(0, len(output) - len(data) - len(marker) - 32)
+                    match = end_patterns[key.fileobj].search(output, search_from)
+                    if match:
+                        ends[key.fileobj] = match
+                        selector.unregister(key.fileobj)
+
+        stdout_end = ends[self.process.stdout]
+        stdout = outputs[self.process.stdout][: stdout_end.start()]
+        stderr = outputs[self.process.stderr][: ends[self.process.stderr].start()]
+        return CommandResult(
+            command=command,
+            returncode=int(stdout_end.group(1)),
+            stdout=stdout.decode(errors="replace"),
+            stderr=stderr.decode(errors="replace"),
+            seconds=time.monotonic() - start,
+        )
+
+    def close(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                # unflushed input to a dead shell
+                pass
+
+
+class ShellPool:
+    """Up to `size` remote shells, spread over the pool masters if there are any.
+    At most `size` commands run at once; shells are opened when first needed and reopened if they die
+    """
+
+    def __init__(
+        self,
+        host=None,
+        size=REMOTE_SHELL_DEFAULT_SIZE,
+        shell_command=REMOTE_SHELL_COMMAND,
+    ):
+        self.host = host if host is not None else get_host()
+        self.size = size
+        self.shell_command = shell_command
+        self.aliases = session_aliases(self.host)
+        self.shells = []
+        # None: slot without an open shell yet
+        self.idle = queue.Queue()
+        for i in range(size):
+            self.idle.put((i, None))
+
+    def run(self, command, timeout=REMOTE_SHELL_TIMEOUT_SECONDS):
+        slot, shell = self.idle.get()
+        try:
+            if shell is None or not shell.is_alive():
+                if shell is not None:
+                    self.shells.remove(shell)
+                    shell.close()
+                alias = self.aliases[slot % len(self.aliases)]
+                logging.info(f"Opening remote shell {slot} on {alias}")
+                shell = RemoteShell(alias, self.shell_command)
+                self.shells.append(shell)
+            result = shell.run(command, timeout)
+            logging.info(f"{result.seconds * 1000:.1f} ms (shell {slot}): {command}")
+            return result
+        finally:
+            self.idle.put((slot, shell))
+
+    def run_many(self, commands, timeout=REMOTE_SHELL_TIMEOUT_SECONDS):
+        """Run commands concurrently (up to the pool size). Results are in the order of commands"""
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(
+                executor.map(lambda command: self.run(command, timeout), commands)
+            )
+
+    def close(self):
+        for shell in self.shells:
+            shell.close()
+        self.shells = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "commands", nargs="*", help="commands to run (default: one per line from stdin)"
+    )
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=REMOTE_SHELL_DEFAULT_SIZE)
+    parser.add_argument("--timeout", type=float, default=REMOTE_SHELL_TIMEOUT_SECONDS)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    commands = args.commands or [
+        line.rstrip("\n") for line in sys.stdin if line.strip()
+    ]
+    try:
+        with ShellPool(get_host(args.host), size=args.jobs) as pool:
+            results = pool.run_many(commands, timeout=args.timeout)
+    except RemoteShellError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    # one json line per command, with its latency
+    for result in results:
+        print(json.dumps(asdict(result)))
+    sys.exit(1 if any(result.returncode for result in results) else 0)
@@ -0,0 +1,127 @@
+# RETRY FAILED LOGINS WITHOUT EVER RE-SENDING A 2FA CODE
+#
+# transient failures (timeout, connection dropped during the login) are retried right away, as long as the code
+# of the current totp window wasn't sent yet. otherwise the retry waits exactly until the next window starts,
+# since the server rejects a code that was already used. credentials rejected after the code was sent are
+# retried at most RETRY_MAX_REJECTED times (the code may have been stale). anything else (a password rejected
+# before the code was sent, missing or locked credentials, unknown prompts, a stuck lock) stops right away
+
+import logging
+import time
+
+from src.constants import (
+    RETRY_MAX_ATTEMPTS,
+    RETRY_MAX_ATTEMPTS_PER_STEP,
+    RETRY_MAX_REJECTED,
+)
+from src.start_ssh import (
+    CredentialsRejectedError,
+    LoginError,
+    LoginTimeoutError,
+    UnexpectedPromptError,
+    ensure_ssh_tunnel,
+)
+from src.totp_steps import current_step, last_sent_step, seconds_until_step
+
+
+def is_transient(error):
+    """Failures that have nothing to do with the credentials"""
+    return isinstance(error, (LoginTimeoutError, LoginError)) and not isinstance(
+        error, UnexpectedPromptError
+    )
+
+
+class RetryPolicy:
+    """The rules above, for one ensure call: start_attempt() before each login, delay_after(error) after a
+    failed one"""
+
+    def __init__(
+        self,
+        host,
+        max_attempts=RETRY_MAX_ATTEMPTS,
+        max_attempts_per_step=RETRY_MAX_ATTEMPTS_PER_STEP,
+        max_rejected=RETRY_MAX_REJECTED,
+    ):
+        self.host = host
+        self.max_attempts = max_attempts
+        self.max_attempts_per_step = max_attempts_per_step
+        self.max_rejected = max_rejected
+        self.attempt = 0
+        self.rejected = 0
+        self.attempts_in_step = {}
+
+    def start_attempt(self):
+        self.attempt += 1
+        step = current_step()
+        self.attempts_in_step[step] = self.attempts_in_step.get(step, 0) + 1
+
+    def delay_after(self, error):
+        """Seconds to wait before the next attempt, or None if error should not be retried"""
+        if isinstance(error, CredentialsRejectedError):
+            self.rejected += 1
+            if self.rejected > self.max_rejected:
+                return None
+        elif not is_transient(error):
+            return None
+        if self.attempt >= self.max_attempts:
+            return None
+
+        step = current_step()
+        last_sent = last_sent_step(self.host.keychain_prefix)
+        code_sent = last_sent is not None and last_sent >= step
+        if (
+            code_sent
+            or self.attempts_in_step.get(step, 0) >= self.max_attempts_per_step
+        ):
+            delay = max(0.0, seconds_until_step(step + 1))
+        else:
+            delay = 0.0
+        logging.warning(
+            f"Login to {self.host.name} failed: {error} Retrying in {delay:.1f}s (attempt {self.attempt + 1} of {self.max_attempts})"
+        )
+        return delay
+
+
+def ensure_with_retry(
+    host,
+    timer=None,
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    max_attempts_per_step=RETRY_MAX_ATTEMPTS_PER_STEP,
+    max_rejected=RETRY_MAX_REJECTED,
+):
+    """ensure_ssh_tunnel, retried as described above. Return True if we logged in, False if the tunnel was
+    already open. Raises the last TunnelError if it can't be opened"""
+    policy = RetryPolicy(host, max_attempts, max_attempts_per_step, max_rejected)
+    while True:
+        policy.start_attempt()
+        try:
+            return ensure_ssh_tunnel(host, timer)
+        except (CredentialsRejectedError, LoginTimeoutError, LoginError) as e:
+            delay = policy.delay_after(e)
+            if delay is None:
+                raise
+        time.sleep(delay)
+
+
+async def ensure_with_retry_async(
+    host,
+    login,
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    max_attempts_per_step=RETRY_MAX_ATTEMPTS_PER_STEP,
+    max_rejected=RETRY_MAX_REJECTED,
+):
+    """ensure_with_retry for asyncio: login is the coroutine function to retry"""
+    # imported here since start-ssh imports this module on every run
+    import asyncio
+
+    policy = RetryPolicy(host, max_attempts, max_attempts_per_step, max_rejected)
+    while True:
+        policy.start_attempt()
+        try:
+            return await login()
+        except (CredentialsRejectedError, LoginTimeoutError, LoginError) as e:
+            # reads the sent steps file under an flock
+            delay = await asyncio.to_thread(policy.delay_after, e)
+            if delay is None:
+                raise
+        await asyncio.sleep(delay)
@@ -0,0 +1,230 @@
+# OPTIONAL SECRETS AGENT (SIMILAR TO SSH-AGENT)
+# reads the passwords from the keyring once and serves them over a unix socket only this user can access,
+# so repeated logins (and supervisor reconnects) don't have to go to the keychain every time
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from src.constants import (
+    DEFAULT_LOG_FORMAT,
+    SECRETS_AGENT_SOCKET,
+    SECRETS_AGENT_TTL_SECONDS,
+)
+
+# mlockall flags (same values on linux and macos)
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# max time in seconds a client waits for the agent
+AGENT_CLIENT_TIMEOUT_SECONDS = 2
+
+
+def _lock_memory():
+    """Best effort: keep the agent's memory out of swap and core dumps"""
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        logging.info("Locked agent memory (mlockall)")
+    except (OSError, AttributeError) as e:
+        logging.warning(
+            f"Unable to lock agent memory, secrets could be swapped to disk: {e}"
+        )
+
+
+def _peer_uid(conn):
+    """uid of the process on the other end of the socket (linux only, None elsewhere)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    _pid, uid, _gid = struct.unpack("3i", creds)
+    return uid
+
+
+def run_agent(ttl=SECRETS_AGENT_TTL_SECONDS, socket_path=SECRETS_AGENT_SOCKET):
+    """Load the secrets and serve them until the ttl expires (or the agent is stopped)"""
+    from src.inventory import load_inventory
+    from src.passwords import read_secret_store
+
+    _lock_memory()
+    # serve the credentials of every host in the inventory
+    keychain_prefixes = sorted(
+        {host.keychain_prefix for host in load_inventory().values()}
+    )
+    secrets = {
+        name: secret
+        for name, secret in read_secret_store(keychain_prefixes).items()
+        if secret is not None
+    }
+    if not secrets:
+        logging.error("No passwords found in keyring")
+        logging.error("Run ./scripts/install to set up totp app")
+        return False
+
+    socket_path_full = Path(socket_path).expanduser()
+    socket_path_full.parent.mkdir(parents=True, exist_ok=True)
+    socket_path_full.parent.chmod(0o700)
+    socket_path_full.unlink(missing_ok=True)
+
+    deadline = time.monotonic() + ttl
+    # make sure the socket file is never accessible by other users, even before the chmod
+    old_umask = os.umask(0o177)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(str(socket_path_full))
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    server.settimeout(1)
+    logging.info(f"Secrets agent listening on {socket_path_full} for {ttl}s")
+
+    try:
+        while time.monotonic() < deadline:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.settimeout(AGENT_CLIENT_TIMEOUT_SECONDS)
+                peer_uid = _peer_uid(conn)
+                if peer_uid is not None and peer_uid != os.getuid():
+                    logging.warning(
+                        f"Refusing secrets agent request from uid {peer_uid}"
+                    )
+                    continue
+                try:
+                    request = conn.recv(64).strip()
+                    if request == b"GET":
+                        conn.sendall(json.dumps(secrets).encode() + b"\n")
+                    elif request == b"PING":
+                        expires_in = deadline - time.monotonic()
+                        conn.sendall(
+                            json.dumps({"expires_in": expires_in}).encode() + b"\n"
+                        )
+                    elif request == b"STOP":
+                        conn.sendall(b"{}\n")
+                        logging.info("Secrets agent stopped by request")
+                        break
+                except OSError as e:
+                    logging.info(f"Secrets agent client error: {e}")
+        else:
+            logging.info("Secrets agent ttl expired")
+    finally:
+        server.close()
+        socket_path_full.unlink(missing_ok=True)
+        secrets.clear()
+    return True
+
+
+def _agent_request(request, socket_path=SECRETS_AGENT_SOCKET):
+    """Send a request to the agent and return the decoded json reply, or None if no agent is running"""
+    socket_path_full = os.path.expanduser(socket_path)
+    if not os.path.exists(socket_path_full):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(AGENT_CLIENT_TIMEOUT_SECONDS)
+        try:
+            sock.connect(socket_path_full)
+            sock.sendall(request + b"\n")
+            reply = b""
+            while not reply.endswith(b"\n"):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                reply += chunk
+        except OSError as e:
+            logging.info(f"Secrets agent not reachable at {socket_path_full}: {e}")
+            return None
+    try:
+        return json.loads(reply)
+    except json.JSONDecodeError:
+        return None
+
+
+def query_agent(socket_path=SECRETS_AGENT_SOCKET):
+    """Get {service name: secret} from the agent, or None if no agent is running"""
+    return _agent_request(b"GET", socket_path)
+
+
+def stop_agent(socket_path=SECRETS_AGENT_SOCKET):
+    """Stop the agent if it is running. Return True if an agent was stopped"""
+    return _agent_request(b"STOP", socket_path) is not None
+
+
+def start_agent_background(
+    ttl=SECRETS_AGENT_TTL_SECONDS, socket_path=SECRETS_AGENT_SOCKET
+):
+    """Start the agent as a background process and wait until it answers"""
+    if _agent_request(b"PING", socket_path) is not None:
+        logging.info("Secrets agent is already running")
+        return True
+    process = subprocess.Popen(
+        [sys.executable, "-m", "src.secrets_agent", "run", "--ttl", str(ttl)],
+        cwd=Path(__file__).resolve().parent.parent,
+        start_new_session=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # loading secrets can take a while if the keychain asks to be unlocked
+    while process.poll() is None:
+        if _agent_request(b"PING", socket_path) is not None:
+            logging.info(f"Started secrets agent (pid {process.pid})")
+            return True
+        time.sleep(0.1)
+    logging.error(
+        "Secrets agent exited during startup. Run `python -m src.secrets_agent run` to see why"
+    )
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "action",
+        help='"start" (in the background), "run" (in the foreground), "stop", or "status"',
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=SECRETS_AGENT_TTL_SECONDS,
+        help=f"seconds to keep the secrets in memory (default {SECRETS_AGENT_TTL_SECONDS})",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=logging.INFO)
+
+    match args.action.lower():
+        case "start":
+            sys.exit(0 if start_agent_background(ttl=args.ttl) else 1)
+        case "run":
+            # exit cleanly (removing the socket) on kill
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            sys.exit(0 if run_agent(ttl=args.ttl) else 1)
+        case "stop":
+            if not stop_agent():
+                logging.warning("No secrets agent running")
+        case "status":
+            reply = _agent_request(b"PING")
+            if reply is None:
+                logging.warning("No secrets agent running")
+                sys.exit(1)
+            logging.warning(
+                f"Secrets agent running, expires in {reply['expires_in']:.0f}s"
+            )
+        case _:
+            raise Exception(f"Action arg is not defined: {args.action}")
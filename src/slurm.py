@@ -0,0 +1,420 @@
+# BATCHED SLURM SUBMISSION AND STATUS POLLING OVER THE SHARED CONNECTION
+#
+# submissions made close together are sent as one remote script running several sbatch calls, and the
+# state of all tracked jobs is polled with one squeue + sacct call per interval. states are kept in a
+# local cache (also written to a file) that can be read without touching the network.
+# a batch gets more time the more jobs it has, and tags its jobs with an sbatch --comment so that after a
+# failed batch the jobs it did submit are found with squeue instead of being submitted twice.
+#
+#   with SlurmClient(get_host()) as slurm:
+#       job_ids = [future.result() for future in slurm.submit_many(scripts)]
+#       slurm.wait(job_ids)
+#
+#   python -m src.slurm submit job1.sh job2.sh     (prints the job ids)
+#   python -m src.slurm watch 123 124               (polls until the jobs are done)
+#   python -m src.slurm status                      (from the cache, no network)
+
+import argparse
+import json
+import logging
+import math
+import shlex
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    DEFAULT_LOG_FORMAT,
+    REMOTE_SHELL_TIMEOUT_SECONDS,
+    SLURM_BATCH_MAX_JOBS,
+    SLURM_BATCH_WINDOW_SECONDS,
+    SLURM_POLL_SECONDS,
+    SLURM_SUBMIT_SECONDS_PER_JOB,
+)
+from src.inventory import get_host
+from src.remote_shell import ShellPool
+
+SLURM_CACHE_FOLDER = f"{APP_STATE_FOLDER}/slurm"
+
+# states after which a job doesn't change any more
+TERMINAL_STATES = {
+    "BOOT_FAIL",
+    "CANCELLED",
+    "COMPLETED",
+    "DEADLINE",
+    "FAILED",
+    "NODE_FAIL",
+    "OUT_OF_MEMORY",
+    "PREEMPTED",
+    "TIMEOUT",
+    # not from slurm: neither squeue nor sacct knows the job (wrong id, or purged from accounting)
+    "UNKNOWN",
+}
+# last line of the poll output when sacct worked, so jobs it doesn't list really don't exist
+SACCT_OK = "@@sacct ok"
+
+
+class SlurmError(Exception):
+    pass
+
+
+def cache_file(host):
+    return Path(SLURM_CACHE_FOLDER).expanduser() / f"{host.alias}.json"
+
+
+def load_job_cache(host):
+    """{job id: {"state": ..., "updated": unix time}} as last seen by any client for host"""
+    try:
+        with open(cache_file(host), "rt") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def batch_submit_command(submissions, tag=None, seconds=None):
+    """Remote script running sbatch for each (script text, sbatch args), one output line each:
+    <index> <sbatch exit code> <output>, or <index> skipped once `seconds` have passed.
+    tag: submit job <index> with --comment=<tag>-<index> (see find_submitted_command)"""
+    lines = []
+    if seconds is not None:
+        lines.append(f"end=$(( $(date +%s) + {math.ceil(seconds)} ))")
+    for i, (script, sbatch_args) in enumerate(submissions):
+        marker = f"TOTP_SCRIPT_{uuid.uuid4().hex}"
+        # an explicit --comment in sbatch_args comes last and wins
+        comment = [f"--comment={tag}-{i}"] if tag else []
+        args = " ".join(shlex.quote(arg) for arg in [*comment, *sbatch_args])
+        submit = (
+            f"out=$(sbatch --parsable {args} 2>&1 <<'{marker}'\n{script.rstrip()}\n{marker}\n)\n"
+            f"printf '%d %d %s\\n' {i} $? \"$(printf '%s' \"$out\" | tr '\\n' ' ')\""
+        )
+        if seconds is not None:
+            submit = f'if [ "$(date +%s)" -lt "$end" ]; then\n{submit}\nelse echo "{i} skipped"; fi'
+        lines.append(submit)
+    return "\n".join(lines)
+
+
+def parse_batch_submit_output(output, count):
+    """[job id or SlurmError] for each submission"""
+    results = [SlurmError("No answer from sbatch") for _ in range(count)]
+    for line in output.splitlines():
+        index, returncode, text = (line.split(" ", 2) + ["", ""])[:3]
+        if not index.isdigit() or int(index) >= count:
+            continue
+        text = text.strip()
+        if returncode == "skipped":
+            results[int(index)] = SlurmError(
+                "Not submitted: the sbatch calls before it used up the time of the batch"
+            )
+        elif returncode == "0" and text:
+            # --parsable prints "jobid" or "jobid;cluster"
+            results[int(index)] = text.split()[-1].split(";")[0]
+        else:
+            results[int(index)] = SlurmError(f"sbatch failed: {text}")
+    return results
+
+
+def find_submitted_command(tag):
+    """Remote command listing the queued jobs submitted with batch_submit_command(..., tag)"""
+    return f"squeue -h -u \"$USER\" -o '%i|%k' 2>/dev/null | grep -F '|{tag}-'"
+
+
+def parse_submitted_output(output, tag):
+    """{submission index: job id}"""
+    found = {}
+    for line in output.splitlines():
+        job_id, _, comment = line.strip().partition("|")
+        index = comment.removeprefix(f"{tag}-")
+        if comment.startswith(f"{tag}-") and index.isdigit():
+            found[int(index)] = job_id
+    return found
+
+
+def poll_command(job_ids):
+    ids = ",".join(job_ids)
+    return (
+        f"squeue -h -o '%i|%T' -j {ids} 2>/dev/null; echo '@@'; "
+        f"sacct -n -P -X -o JobID,State -j {ids} 2>/dev/null && echo '{SACCT_OK}'"
+    )
+
+
+def parse_poll_output(output):
+    """{job id: state}. squeue (live) wins over sacct (accounting, may lag)"""
+    queued, accounted = output.split("@@", 1) if "@@" in output else (output, "")
+    states = {}
+    for text in (accounted, queued):
+        for line in text.splitlines():
+            if "|" in line:
+                job_id, state = line.split("|", 1)
+                # sacct says e.g. "CANCELLED by 1234"
+                if state.split():
+                    states[job_id.strip()] = state.split()[0].rstrip("+")
+    return states
+
+
+class SlurmClient:
+    """Submits and tracks slurm jobs on host through a ShellPool. Call start() (or use `with`) to
+    run the background batching and polling threads; without them call flush() and refresh() yourself
+    """
+
+    def __init__(
+        self,
+        host=None,
+        pool=None,
+        poll_interval=SLURM_POLL_SECONDS,
+        batch_window=SLURM_BATCH_WINDOW_SECONDS,
+        batch_max_jobs=SLURM_BATCH_MAX_JOBS,
+        submit_timeout=REMOTE_SHELL_TIMEOUT_SECONDS,
+        submit_seconds_per_job=SLURM_SUBMIT_SECONDS_PER_JOB,
+    ):
+        self.host = host if host is not None else get_host()
+        self.pool = pool if pool is not None else ShellPool(self.host, size=2)
+        self.own_pool = pool is None
+        self.poll_interval = poll_interval
+        self.batch_window = batch_window
+        self.batch_max_jobs = batch_max_jobs
+        self.submit_timeout = submit_timeout
+        self.submit_seconds_per_job = submit_seconds_per_job
+        self.lock = threading.Condition()
+        self.pending = []
+        self.jobs = load_job_cache(self.host)
+        self.tracked = set()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    # submission
+
+    def submit(self, script, sbatch_args=()):
+        """Queue a job (script text). The returned future resolves to its job id"""
+        future = Future()
+        with self.lock:
+            self.pending.append((script, list(sbatch_args), future))
+            self.lock.notify_all()
+        return future
+
+    def submit_many(self, scripts, sbatch_args=()):
+        return [self.submit(script, sbatch_args) for script in scripts]
+
+    def flush(self):
+        """Send the queued submissions now, in batches of at most batch_max_jobs"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for start in range(0, len(pending), self.batch_max_jobs):
+            batch = pending[start : start + self.batch_max_jobs]
+            tag = f"totp-{uuid.uuid4().hex[:12]}"
+            # the remote script stops starting sbatch calls after submit_seconds, so a slow slurm
+            # controller leaves the rest unsubmitted instead of timing out the whole batch
+            submit_seconds = len(batch) * self.submit_seconds_per_job
+            command = batch_submit_command(
+                [(script, args) for script, args, _ in batch], tag, submit_seconds
+            )
+            try:
+                result = self.pool.run(
+                    command, timeout=self.submit_timeout + submit_seconds
+                )
+                job_ids = parse_batch_submit_output(result.stdout, len(batch))
+            except Exception as e:
+                job_ids = self._find_submitted(tag, len(batch), e)
+            logging.info(f"Submitted {len(batch)} job(s) in one call")
+            for (_, _, future), job_id in zip(batch, job_ids):
+                if isinstance(job_id, Exception):
+                    future.set_exception(job_id)
+                else:
+                    self._update({job_id: "PENDING"}, keep_newer=True)
+                    self.tracked.add(job_id)
+                    future.set_result(job_id)
+
+    def _find_submitted(self, tag, count, error):
+        """After a failed batch: the ids of its jobs that squeue lists, an error for the others"""
+        try:
+            found = parse_submitted_output(
+                self.pool.run(find_submitted_command(tag)).stdout, tag
+            )
+        except Exception as e:
+            logging.warning(f"Could not look for the jobs of the failed batch: {e}")
+            found = {}
+        # remote shell errors end with the whole command
+        reason = str(error).splitlines()[0] if str(error) else repr(error)
+        logging.warning(
+            f"Submitting a batch failed ({reason}). {len(found)} of its {count} job(s) were submitted"
+        )
+        return [
+            found.get(
+                i,
+                SlurmError(
+                    f"{reason}. squeue has no job with --comment={tag}-{i} (not submitted, or already finished)"
+                ),
+            )
+            for i in range(count)
+        ]
+
+    def _batch_loop(self):
+        while not self.stopping.is_set():
+            with self.lock:
+                while not self.pending and not self.stopping.is_set():
+                    self.lock.wait()
+            # give other submissions a moment to join the batch
+            self.stopping.wait(self.batch_window)
+            self.flush()
+
+    # status
+
+    def track(self, job_ids):
+        """Also poll jobs that weren't submitted through this client"""
+        self.tracked.update(str(job_id) for job_id in job_ids)
+
+    def state(self, job_id):
+        """Last known state of job_id from the cache (None if unknown). No network"""
+        job = self.jobs.get(str(job_id))
+        return job["state"] if job else None
+
+    def refresh(self):
+        """Poll the state of every tracked job that isn't finished, in one remote call"""
+        active = sorted(
+            job_id
+            for job_id in self.tracked
+            if self.state(job_id) not in TERMINAL_STATES
+        )
+        if not active:
+            return {}
+        result = self.pool.run(poll_command(active))
+        states = parse_poll_output(result.stdout)
+        if SACCT_OK in result.stdout:
+            # (squeue fails for ids it doesn't know, so only sacct can tell)
+            missing = [job_id for job_id in active if job_id not in states]
+            if missing:
+                logging.warning(
+                    f"Neither squeue nor sacct knows job(s) {', '.join(missing)}. Marking them UNKNOWN"
+                )
+                states.update(dict.fromkeys(missing, "UNKNOWN"))
+        self._update(states)
+        logging.info(f"Polled {len(active)} job(s): {states}")
+        return states
+
+    def _poll_loop(self):
+        while not self.stopping.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.warning(f"Polling slurm failed: {e}")
+
+    def _update(self, states, keep_newer=False):
+        with self.lock:
+            now = time.time()
+            for job_id, state in states.items():
+                if keep_newer and job_id in self.jobs:
+                    continue
+                self.jobs[job_id] = {"state": state, "updated": now}
+            self.lock.notify_all()
+            path = cache_file(self.host)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wt") as f:
+                json.dump(self.jobs, f)
+            tmp_path.replace(path)
+
+    def wait(self, job_ids, timeout=None):
+        """Block until all job_ids are in a terminal state (UNKNOWN for ids slurm doesn't know).
+        Returns {job id: state}"""
+        job_ids = [str(job_id) for job_id in job_ids]
+        self.track(job_ids)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while any(self.state(job_id) not in TERMINAL_STATES for job_id in job_ids):
+                if not self.threads:
+                    # nobody polls in the background
+                    self.lock.release()
+                    try:
+                        self.refresh()
+                    finally:
+                        self.lock.acquire()
+                    if all(self.state(job_id) in TERMINAL_STATES for job_id in job_ids):
+                        break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise SlurmError(f"Timed out waiting for jobs {job_ids}")
+                wait_time = (
+                    self.poll_interval
+                    if remaining is None
+                    else min(remaining, self.poll_interval)
+                )
+                self.lock.wait(wait_time)
+        return {job_id: self.state(job_id) for job_id in job_ids}
+
+    # lifetime
+
+    def start(self):
+        for target in (self._batch_loop, self._poll_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def close(self):
+        self.stopping.set()
+        with self.lock:
+            self.lock.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.flush()
+        if self.own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", help='"submit", "watch" or "status"')
+    parser.add_argument(
+        "args", nargs="*", help="job scripts (submit) or job ids (watch, status)"
+    )
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument(
+        "--sbatch-args", default="", help='extra sbatch arguments, e.g. "-p test"'
+    )
+    parser.add_argument("--interval", type=float, default=SLURM_POLL_SECONDS)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_intermixed_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    host = get_host(args.host)
+    match args.action.lower():
+        case "submit":
+            scripts = [Path(path).read_text() for path in args.args]
+            with SlurmClient(host) as slurm:
+                futures = slurm.submit_many(scripts, shlex.split(args.sbatch_args))
+                failed = False
+                for path, future in zip(args.args, futures):
+                    try:
+                        print(future.result())
+                    except Exception as e:
+                        logging.error(f"{path}: {e}")
+                        failed = True
+            sys.exit(1 if failed else 0)
+        case "watch":
+            with SlurmClient(host, poll_interval=args.interval) as slurm:
+                states = slurm.wait(args.args)
+            for job_id, state in states.items():
+                print(f"{job_id}\t{state}")
+            sys.exit(0 if all(state == "COMPLETED" for state in states.values()) else 1)
+        case "status":
+            jobs = load_job_cache(host)
+            for job_id in args.args or sorted(jobs):
+                print(f"{job_id}\t{jobs.get(job_id, {}).get('state', 'UNKNOWN')}")
+        case _:
+            logging.error(f"Action arg is not defined: {args.action}")
+            sys.exit(1)
@@ -8,20 +8,27 @@ from pathlib import Path
 
 from src.constants import (
     DEFAULT_LOG_FORMAT,
+    JUMP_CONTROL_PERSIST,
+    JUMP_KEY_FILE,
     LOGIN_HOST_ALIAS,
-    LOGIN_SSH_HOST,
     SSH_CONFIG_FILE,
     SSH_CONTROLMASTERS_FOLDER,
     TOTP_BLOCK_END,
     TOTP_BLOCK_START,
     SSH_FOLDER,
 )
-from src.passwords import get_ssh_user
+from src.inventory import load_inventory
+from src.profiles import load_profile_options
 
 # aliases useful for f-strings (left, right brace)
 LBRACE = "{"
 RBRACE = "}"
 
+
+class SshConfigError(Exception):
+    pass
+
+
 #  String templates for ssh files
 
 
@@ -37,22 +44,91 @@ Host *
 """
 
 
-def template_ssh_include_config(ssh_user):
+def template_ssh_include_config(host_users):
+    """host_users: list of (HostConfig, ssh username), one Host block each"""
+    host_blocks = "".join(
+        template_ssh_host_block(host, ssh_user) for host, ssh_user in host_users
+    )
     return f"""# SSH config file auto-generated by totp app
 # this should be included the main ssh config file
 # to uninstall, run "uninstall-totp-app"
 
-Host {LOGIN_HOST_ALIAS}
+{host_blocks}"""
+
+
+def template_ssh_host_block(host, ssh_user):
+    # ssh uses the first value it finds for an option, so per-host options go before the defaults
+    port_option = f"    Port {host.port}\n" if host.port != 22 else ""
+    # the measured connection profile (src/profiles.py) comes after the inventory options so those win.
+    # X11 forwarding is left to each ssh command
+    profile_options = {
+        key: val
+        for key, val in load_profile_options(host.alias).items()
+        if key != "ForwardX11" and key not in host.options
+    }
+    extra_options = "".join(
+        f"    {key} {val}\n" for key, val in {**host.options, **profile_options}.items()
+    )
+    # <alias>-pool-<i> reaches the i-th master opened by start-ssh --pool (one socket per pool member, %n = alias used)
+    return (
+        "".join(
+            f"""Host {host_pattern}
     User {ssh_user}
-    HostName {LOGIN_SSH_HOST}
-    IdentitiesOnly yes
+    HostName {host.hostname}
+{port_option}{extra_options}    IdentitiesOnly yes
     ServerAliveInterval 60
     TCPKeepAlive no
     ControlMaster auto
-    ControlPath {SSH_CONTROLMASTERS_FOLDER}/%r@%h:%p
+    ControlPath {control_path}
     ControlPersist yes
 
 """
+            for host_pattern, control_path in [
+                (host.alias, f"{SSH_CONTROLMASTERS_FOLDER}/%r@%h:%p"),
+                (f"{host.alias}-pool-*", f"{SSH_CONTROLMASTERS_FOLDER}/%r@%h:%p.%n"),
+            ]
+        )
+        + template_ssh_jump_block(host, ssh_user)
+    )
+
+
+def template_ssh_jump_block(host, ssh_user):
+    """Nodes matching host.jump_hosts are reached through the master of host (no extra login).
+    The first ssh to a node becomes a master for that node, so later ones reuse it"""
+    if not host.jump_hosts:
+        return ""
+    return f"""Host {" ".join(host.jump_hosts)}
+    User {ssh_user}
+    ProxyJump {host.alias}
+    IdentityFile {JUMP_KEY_FILE}
+    IdentitiesOnly yes
+    StrictHostKeyChecking accept-new
+    ControlMaster auto
+    ControlPath {SSH_CONTROLMASTERS_FOLDER}/%r@%h:%p
+    ControlPersist {JUMP_CONTROL_PERSIST}
+
+"""
+
+
+def include_config_file(config_file=SSH_CONFIG_FILE):
+    """Path of the include config written by this app (next to the main ssh config)"""
+    config_file_full = Path(config_file).expanduser()
+    return Path(config_file_full.parent, "config.d", "cannon-totp")
+
+
+def read_ssh_user_from_config(config_file=SSH_CONFIG_FILE, alias=LOGIN_HOST_ALIAS):
+    """Get the ssh username of host `alias` from the generated include config, without touching the keyring.
+    Return None if the include config doesn't exist or doesn't define the user"""
+    try:
+        include_text = include_config_file(config_file).read_text()
+    except OSError:
+        return None
+    m = re.search(
+        rf"^Host {re.escape(alias)}\n(?:[ \t]+.*\n)*?[ \t]+User (\S+)$",
+        include_text,
+        re.MULTILINE,
+    )
+    return m.group(1) if m else None
 
 
 def check_custom_block_main_config(filetext: str, delete_and_return=False):
@@ -74,41 +150,48 @@ def check_custom_block_main_config(filetext: str, delete_and_return=False):
     return subbed_text
 
 
-def check_host_already_defined(filetext):
+def check_host_already_defined(filetext, alias=LOGIN_HOST_ALIAS):
     """Check if there is already the host_name defined in the main ssh config"""
-    m = re.search(rf"^Host {LOGIN_HOST_ALIAS}", filetext, re.MULTILINE)
+    m = re.search(rf"^Host {re.escape(alias)}(?=\s|$)", filetext, re.MULTILINE)
     return bool(m)
 
 
 def add_ssh_config_section(config_file=SSH_CONFIG_FILE):
     config_file_full = Path(config_file).expanduser()
+    inventory = load_inventory()
 
     with open(config_file_full, "rt") as f:
         main_config_text = f.read()
 
-    is_host_defined = check_host_already_defined(filetext=main_config_text)
-    if is_host_defined:
-        logging.error(
-            f"There already exists an entry in your ssh config file ({str(config_file)}) with the Host {LOGIN_HOST_ALIAS}."
+    for alias in inventory:
+        is_host_defined = check_host_already_defined(
+            filetext=main_config_text, alias=alias
         )
-        logging.error("Exiting without making changes")
-        sys.exit(1)
+        if is_host_defined:
+            raise SshConfigError(
+                f"There already exists an entry in your ssh config file ({str(config_file)}) with the Host {alias}. Exiting without making changes"
+            )
 
     is_section_defined = check_custom_block_main_config(filetext=main_config_text)
     if is_section_defined:
-        logging.error(f"""TOTP section already in ssh config file
+        raise SshConfigError(f"""TOTP section already in ssh config file
 If this is an error, remove text from your config file including and between: {TOTP_BLOCK_START} ... {TOTP_BLOCK_END}
 Exiting without making changes\n""")
-        sys.exit(1)
 
-    ssh_user = get_ssh_user()
-    include_config_text = template_ssh_include_config(ssh_user=ssh_user)
-    include_config_dir = Path(config_file_full.parent, "config.d")
+    # imported here so that reading the config (e.g. from start-ssh) doesn't load keyring
+    from src.passwords import get_ssh_user
+
+    host_users = [
+        (host, host.user or get_ssh_user(host.keychain_prefix))
+        for host in inventory.values()
+    ]
+    include_config_text = template_ssh_include_config(host_users=host_users)
+    include_config_path = include_config_file(config_file)
+    include_config_dir = include_config_path.parent
     logging.info(
         f"Making ssh include config folder (if not exists): {str(include_config_dir)}"
     )
     include_config_dir.mkdir(exist_ok=True)
-    include_config_path = Path(include_config_dir, "cannon-totp")
     include_config_path.write_text(data=include_config_text)
     logging.info(f"Writing TOTP config to file: {str(include_config_path)}")
 
@@ -121,8 +204,8 @@ Exiting without making changes\n""")
 
 def remove_ssh_config_section(config_file=SSH_CONFIG_FILE):
     config_file_full = Path(config_file).expanduser()
-    include_config_dir = Path(config_file_full.parent, "config.d")
-    include_config_path = Path(include_config_dir, "cannon-totp")
+    include_config_path = include_config_file(config_file)
+    include_config_dir = include_config_path.parent
 
     main_text = config_file_full.read_text()
 
@@ -209,6 +292,7 @@ if __name__ == "__main__":
             try:
                 add_ssh_config_section()
             except Exception as e:
+                logging.error(str(e))
                 sys.exit(1)
         case "remove":
             try:
@@ -1,24 +1,35 @@
 import argparse
+import ipaddress
 import logging
+import re
 import sys
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
 from io import StringIO
+from pathlib import Path
 
-import pexpect
-
+from src.auth_dialog import UNKNOWN_PROMPT, host_dialog
+from src.clock_skew import refresh_clock_offset
 from src.constants import (
+    AUTH_DIALOG_QUIET_SECONDS,
+    AUTH_DIALOG_SEARCH_WINDOW,
     DEFAULT_LOG_FORMAT,
     DEFAULT_LOG_LEVEL,
-    LOGIN_SSH_HOST,
     PEXPECT_TIMEOUT_SECONDS,
-    SSH_CONTROLMASTERS_FOLDER,
-)
-from src.passwords import (
-    generate_otp,
-    get_rc_password,
-    get_ssh_user,
-    get_totp_code,
+    TOTP_MIN_REMAINING_SECONDS,
+    TOTP_PROMPT_DELAY_SECONDS,
 )
-from src.test_connection import is_controlmaster_open
+from src.forwards import restore_forwards
+from src.inventory import InventoryError, get_host, load_inventory, pool_members
+from src.node_selection import forget_node_probes, select_fastest_node
+from src.profiles import load_profile_options
+from src.ssh_config import read_ssh_user_from_config
+from src.test_connection import control_socket_path, is_controlmaster_open
+from src.timings import PhaseTimer, print_timings_summary
+from src.totp_steps import release_step
+from src.tunnel_lock import TunnelLockTimeout, tunnel_lock
 
 
 def init_logging(log_level=DEFAULT_LOG_LEVEL):
@@ -26,25 +37,45 @@ def init_logging(log_level=DEFAULT_LOG_LEVEL):
     logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=log_level)
 
 
-def build_ssh_options(ssh_dest):
-    """Make argument list for the ssh command to create a tunnel"""
+def build_ssh_options(
+    ssh_dest, ssh_port=22, extra_options=None, connect_node=None, control_suffix=""
+):
+    """Make argument list for the ssh command to create a tunnel
+
+    connect_node: connect to this login node (name or address) instead of the host in ssh_dest.
+    The control socket is still named after ssh_dest so `ssh <alias>` finds it.
+    control_suffix: added to the control socket name (for pool members)
+    """
     ssh_config_dict = {
         "TCPKeepAlive": "no",  # Use ServerKeepAlive instead
         "ServerAliveInterval": "60",  # prevent dropped connections by sending a ping every X seconds
         "IdentitiesOnly": "yes",  # Don't attempt key-based ssh auth (connection cannot use identies anyways)
         "ControlMaster": "yes",  # Use single control socket for SSH
-        "ControlPath": f"{SSH_CONTROLMASTERS_FOLDER}/%r@%h:%p",  # Path to ssh control sockets
         "ControlPersist": "yes",  # Keep master connection open in the background
         "StrictHostKeyChecking": "accept-new",  # accept new ssh host, but DO NOT accept existing hosts where key has changed
         "NumberOfPasswordPrompts": "1",
+        "Port": str(ssh_port),
+        "ForwardX11": "yes",  # enable X11 forwarding (if you want to run graphical applicaitons over tunnel connection)
     }
+    if connect_node is not None:
+        ssh_host = ssh_dest.split("@", 1)[1]
+        ssh_config_dict["HostName"] = connect_node
+        if _is_ip_address(connect_node):
+            # an address behind the round-robin name: check its key against the name's known_hosts entry
+            ssh_config_dict["HostKeyAlias"] = ssh_host
+    # options from the connection profile and the inventory override the defaults
+    ssh_config_dict.update(extra_options or {})
+    # the same path the checks use (not %h, which would expand to connect_node). set last, so nothing
+    # can point several masters (pool members) at one socket
+    ssh_config_dict["ControlPath"] = control_socket_path(
+        ssh_dest, ssh_port=ssh_port, socket_suffix=control_suffix
+    )
 
     ssh_positional_options = [
         "-F",
         "none",  # Do not read from SSH config file (config_file = None)
-        "-X",  # enable X11 forwarding (if you want to run graphical applicaitons over tunnel connection)
         "-N",  # do not execute remote commands (just open tunnel)
-        # "-C",  # not sure if compression helps - since file is encrypted and connection is likely very fast
+        # compression and ciphers come from the measured connection profile, if any (see src/profiles.py)
     ]
     ssh_config_options_as_list = []
     for key in ssh_config_dict:
@@ -61,11 +92,206 @@ def build_ssh_options(ssh_dest):
     return subprocess_options
 
 
-def start_ssh_tunnel():
+# any output at all (zero width, so nothing is consumed)
+_MORE_OUTPUT = re.compile(r"(?=.)", re.DOTALL)
+
+
+def _is_ip_address(address):
+    try:
+        ipaddress.ip_address(address)
+        return True
+    except ValueError:
+        return False
+
+
+class TunnelError(Exception):
+    """The tunnel could not be opened"""
+
+
+class MissingCredentialsError(TunnelError):
+    pass
+
+
+class AuthenticationError(TunnelError):
+    """The server rejected the password or verification code"""
+
+
+class CredentialsRejectedError(AuthenticationError):
+    """The server refused the answers (password or code). A retry with a new code may work"""
+
+
+class PasswordRejectedError(AuthenticationError):
+    """The server refused the password before the code was sent. Not retried: it would be refused again"""
+
+
+class LoginTimeoutError(TunnelError):
+    pass
+
+
+class LoginError(TunnelError):
+    """ssh exited during the login"""
+
+
+class UnexpectedPromptError(LoginError):
+    """The server showed a prompt that no dialog rule knows"""
+
+
+class TunnelBusyError(TunnelError):
+    """Another process holds the login lock for too long"""
+
+
+def start_ssh_tunnel(host=None, record_timings=None, retry=True):
+    """Make sure the ssh tunnel is open, logging in if needed. Return True if the tunnel is open
+
+    host: HostConfig from the inventory (default: the main login host)
+    record_timings: append the time spent in each phase to the timings file.
+    None (default) means only if the TOTP_RECORD_TIMINGS environment variable is set.
+    retry: retry failed logins that may work with a new code (see src/retry.py)
+    """
+    # imported here since the retry module imports this one
+    from src.retry import ensure_with_retry
+
+    if host is None:
+        host = get_host()
+    timer = PhaseTimer(enabled=record_timings)
+    is_open = False
+    try:
+        if retry:
+            ensure_with_retry(host, timer)
+        else:
+            ensure_ssh_tunnel(host, timer)
+        is_open = True
+    except TunnelError as e:
+        logging.error(str(e))
+    finally:
+        timer.save(result="open" if is_open else "failed", host=host.name)
+    return is_open
+
+
+def start_all_ssh_tunnels(hosts, record_timings=None, retry=True):
+    """Open tunnels to all hosts concurrently. Return {alias: True if the tunnel is open}"""
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        futures = {
+            host.name: executor.submit(start_ssh_tunnel, host, record_timings, retry)
+            for host in hosts
+        }
+    results = {alias: future.result() for alias, future in futures.items()}
+    for alias, is_open in results.items():
+        if not is_open:
+            logging.error(f"Unable to open ssh tunnel for {alias}")
+    return results
+
+
+def ensure_ssh_tunnel(host, timer=None):
+    """Make sure the tunnel to host is open. Return True if we logged in, False if it was already open.
+    Raises a TunnelError if it can't be opened"""
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+
+    # fast path: the ssh username is in the inventory or the generated ssh config, so an open
+    # tunnel can be detected without loading keyring/pexpect/pyotp or touching the keychain
+    known_ssh_user = host.user or read_ssh_user_from_config(alias=host.alias)
+    if known_ssh_user is not None:
+        running = is_controlmaster_open(
+            ssh_dest=f"{known_ssh_user}@{host.hostname}",
+            ssh_port=host.port,
+            socket_suffix=host.control_suffix,
+        )
+        timer.mark("check_tunnel_fast")
+        if running:
+            logging.info(f"Tunnel for {host.name} is open. Doing nothing and exiting")
+            return False
+
+    SECRET_ssh_user, SECRET_rc_password = read_credentials(host, timer)
+    ssh_dest = f"{SECRET_ssh_user}@{host.hostname}"
+
+    # test if controlmaster is alrady running (already done above if the username was known)
+    if SECRET_ssh_user != known_ssh_user:
+        running = is_controlmaster_open(
+            ssh_dest=ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+        )
+        timer.mark("check_tunnel")
+        if running:
+            logging.info(f"Tunnel for {host.name} is open. Doing nothing and exiting")
+            return False
+
+    # only one process logs in at a time. everyone else waits here for it to finish
+    try:
+        with tunnel_lock(
+            ssh_dest=ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+        ):
+            timer.mark("lock_wait")
+            if not needs_login(ssh_dest, host, timer):
+                return False
+            logging.info(f"Creating new ssh tunnel for {host.name}")
+            login_ssh_tunnel(
+                ssh_dest=ssh_dest,
+                SECRET_rc_password=SECRET_rc_password,
+                timer=timer,
+                host=host,
+            )
+    except TunnelLockTimeout as e:
+        raise lock_busy_error(e)
+
+    tunnel_opened(host, ssh_dest, SECRET_ssh_user)
+    return True
+
+
+def needs_login(ssh_dest, host, timer):
+    """Call with the tunnel lock held. False if another process created the tunnel while we were
+    waiting on the lock, otherwise clears the way for a new master and returns True"""
+    is_open_now = is_controlmaster_open(
+        ssh_dest=ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+    )
+    timer.mark("recheck_tunnel")
+    if is_open_now:
+        logging.info("Tunnel was created by another process. Doing nothing and exiting")
+        return False
+    remove_stale_socket(ssh_dest, host)
+    return True
+
+
+def lock_busy_error(e):
+    return TunnelBusyError(
+        f"{e}. Another start-ssh process is stuck creating the tunnel. Try again or kill it."
+    )
+
+
+def tunnel_opened(host, ssh_dest, ssh_user):
+    """After a login: put back the port forwards, which lived on the old master"""
+    logging.info(f"Successfully created SSH tunnel for {ssh_dest}")
+    restore_forwards(host, ssh_user=ssh_user)
+
+
+def remove_stale_socket(ssh_dest, host):
+    """Remove the control socket of a master that is gone. Call with the tunnel lock held, after
+    checking that no master answers. A master that was killed leaves its socket file behind, and
+    ssh won't start a new master over it ("ControlSocket ... already exists, disabling multiplexing")
+    """
+    socket_path = Path(
+        control_socket_path(
+            ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+        )
+    )
+    if socket_path.exists():
+        logging.info(f"Removing stale control socket {socket_path}")
+        socket_path.unlink(missing_ok=True)
+
+
+def read_credentials(host, timer=None):
+    """(ssh user, password) for host from the keychain (or agent / secrets file)"""
+    # these are slow to import, and only needed when we actually have to log in
+    from src.passwords import get_rc_password, get_ssh_user, get_totp_code
+
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+    timer.mark("import")
+
     # get passwords from MacOS Keychain
-    SECRET_totp_code = get_totp_code()
-    SECRET_rc_password = get_rc_password()
-    SECRET_ssh_user = get_ssh_user()
+    SECRET_totp_code = get_totp_code(host.keychain_prefix)
+    SECRET_rc_password = get_rc_password(host.keychain_prefix)
+    SECRET_ssh_user = host.user or get_ssh_user(host.keychain_prefix)
+    timer.mark("keyring")
 
     # if at least one of the secrets is missing then offer to initilaize them
     if (
@@ -73,65 +299,334 @@ def start_ssh_tunnel():
         or SECRET_rc_password is None
         or SECRET_ssh_user is None
     ):
-        logging.error("At least one required password is missing from keyring")
-        logging.error("Run ./scripts/install to set up totp app")
-        sys.exit(1)
+        raise MissingCredentialsError(
+            f"At least one required password for {host.name} is missing from keyring. Run ./scripts/install to set up totp app"
+        )
+    return SECRET_ssh_user, SECRET_rc_password
 
-    ssh_dest = f"{SECRET_ssh_user}@{LOGIN_SSH_HOST}"
 
-    # test if controlmaster is alrady running
+def spawn_ssh_master(ssh_dest, host, timer, options=None, control_suffix=None):
+    """Start the ssh process for the master of host (not logged in yet)
 
-    running = is_controlmaster_open(ssh_dest=ssh_dest)
-    if running:
-        logging.info("Doing nothing and exiting")
-        sys.exit(0)
-    else:
-        logging.info("Creating new ssh tunnel")
+    options: ssh options to use instead of the saved connection profile + the host's options
+    control_suffix: instead of the host's (e.g. for throwaway masters)
+    """
+    import pexpect
 
-    # generated 6-digit one-time authentication token
-    totp_otp = generate_otp()
+    connect_node = None
+    if host.select_fastest:
+        connect_node = select_fastest_node(host)
+        timer.mark("select_node")
+        if connect_node is not None:
+            logging.info(f"Connecting {host.name} through login node {connect_node}")
 
-    subprocess_options = build_ssh_options(ssh_dest=ssh_dest)
+    if options is None:
+        options = {**load_profile_options(host.alias), **host.options}
+    subprocess_options = build_ssh_options(
+        ssh_dest=ssh_dest,
+        ssh_port=host.port,
+        extra_options=options,
+        connect_node=connect_node,
+        control_suffix=(
+            host.control_suffix if control_suffix is None else control_suffix
+        ),
+    )
 
     logging.info(
         f"Connecting to ssh with the following command: ssh {subprocess_options}"
     )
+    # ignore_sighup: the master that ssh forks into the background (ControlPersist) is still in the
+    # pty's session, and on linux it gets a SIGHUP and dies when the ssh we spawned exits
     child = pexpect.spawn(
-        "ssh", subprocess_options, encoding="UTF-8", timeout=PEXPECT_TIMEOUT_SECONDS
+        "ssh",
+        subprocess_options,
+        encoding="UTF-8",
+        timeout=PEXPECT_TIMEOUT_SECONDS,
+        ignore_sighup=True,
     )
-    try:
-        logfile_read = StringIO()
-        child.logfile_read = logfile_read
-        child.expect(r".+ Password: ")
-        child.sendline(SECRET_rc_password)
-        child.expect(r".+ VerificationCode: ")
-        child.sendline(totp_otp)
-        idx = child.expect([pexpect.EOF, r".+ Permission denied"])
-        if idx == 1:
-            logging.error(
-                "Permission denied by ssh server. Double check passwords and try again. Run ./scripts/install to update passwords."
+    timer.mark("spawn")
+    child.logfile_read = StringIO()
+    return child
+
+
+def _last_line(child):
+    """The line of ssh output the last pattern matched in"""
+    lines = (child.before + child.after).strip().splitlines()
+    return lines[-1] if lines else ""
+
+
+@dataclass
+class ReservedCode:
+    """generate_code for login_dialog: the code of the totp window reserved before ssh started"""
+
+    keychain_prefix: str
+    step: int
+    sent: bool = False
+
+    def __call__(self):
+        from src.passwords import otp_for_step
+
+        self.sent = True
+        return otp_for_step(self.step, keychain_prefix=self.keychain_prefix)
+
+    def release(self):
+        """Give the window back if its code was never sent (the login failed before the code prompt)"""
+        if not self.sent:
+            release_step(self.keychain_prefix, self.step)
+
+
+def reserve_code(host, timer):
+    """Before spawning ssh: reserve the totp window of the code and wait until it can be sent, so the wait
+    doesn't happen at the server's code prompt (where its LoginGraceTime runs, e.g. for --pool members that
+    each need their own window). Return a ReservedCode for login_dialog (None for the default)
+    """
+    from src.passwords import reserve_otp_step
+
+    # make sure the clock skew used for the totp code is recent (no-op if it was measured recently)
+    refresh_clock_offset()
+    timer.mark("clock_skew")
+    if not any(rule.action == "totp" for rule in host_dialog(host)):
+        return None
+    step = reserve_otp_step(
+        min_remaining_seconds=TOTP_MIN_REMAINING_SECONDS + TOTP_PROMPT_DELAY_SECONDS,
+        keychain_prefix=host.keychain_prefix,
+    )
+    timer.mark("totp_wait")
+    if step is None:
+        return None
+    return ReservedCode(host.keychain_prefix, step)
+
+
+@dataclass
+class CodeRequest:
+    """Yielded by login_dialog at the verification code prompt: the driver sends back generate().
+    It may read the keychain and sleep until the code's window starts, so the async driver calls it in a thread
+    """
+
+    generate: Callable[[], str]
+
+
+def login_dialog(child, SECRET_rc_password, host, timer, generate_code=None):
+    """The login as a state machine over the host's dialog rules (see src/auth_dialog.py).
+
+    A generator: yields (patterns, timeout) to expect next and is sent the index of the pattern that
+    matched, or yields a CodeRequest and is sent the code. Drive it with run_login_dialog (or its async
+    version). Done when ssh exits after the verification code was sent (the master went to the
+    background). Fails right away when a fail rule matches, when a prompt comes back (its answer was
+    rejected) or when the server shows a prompt no rule knows.
+
+    generate_code: returns the verification code (default: generate_otp for the host's keychain). See
+    reserve_code
+    """
+    import pexpect
+
+    if generate_code is None:
+        from src.passwords import generate_otp
+
+        generate_code = partial(generate_otp, keychain_prefix=host.keychain_prefix)
+
+    rules = host_dialog(host)
+    patterns = [pexpect.EOF, *(rule.pattern for rule in rules), UNKNOWN_PROMPT]
+    quiet_patterns = [_MORE_OUTPUT, pexpect.TIMEOUT, pexpect.EOF]
+    answered = set()
+    answered_actions = set()
+    while True:
+        idx = yield patterns, -1
+
+        if idx == len(patterns) - 1:
+            prompt = _last_line(child)
+            # may be a line that is still being written (e.g. "Note:" of a banner): only a prompt if ssh waits
+            quiet_idx = yield quiet_patterns, AUTH_DIALOG_QUIET_SECONDS
+            if quiet_idx == 1:
+                raise UnexpectedPromptError(
+                    f"Unexpected prompt from the server: {prompt!r}. If it is expected, add a rule for it to the dialog of {host.alias} in the inventory file"
+                )
+            if quiet_idx == 0:
+                continue
+            idx = 0
+
+        if idx == 0:
+            timer.mark("eof")
+            if "totp" not in answered_actions:
+                raise LoginError(
+                    "SSH process exited before asking for the verification code. Try again with --verbose for more information."
+                )
+            return
+
+        rule = rules[idx - 1]
+        if rule.action == "ignore":
+            continue
+        # before the code was sent only the password can have been rejected, and a new code won't help
+        rejected_error = (
+            CredentialsRejectedError
+            if "totp" in answered_actions
+            else PasswordRejectedError
+        )
+        if rule.action in ("reject", "fail"):
+            error = rejected_error if rule.action == "reject" else AuthenticationError
+            raise error(
+                rule.message or f"Login failed. The server said: {_last_line(child)}"
             )
-            sys.exit(1)
+        if idx in answered:
+            # never send the same password or code twice: the server rejected it
+            raise rejected_error(
+                f"The server asked again for {_last_line(child)!r}, so it rejected the answer. Double check passwords and try again. Run ./scripts/install to update passwords."
+            )
+        answered.add(idx)
+        answered_actions.add(rule.action)
+        match rule.action:
+            case "password":
+                timer.mark("password_prompt")
+                child.sendline(SECRET_rc_password)
+            case "totp":
+                timer.mark("verification_prompt")
+                # the window was reserved before ssh started. the code is only made now so it's checked
+                # against the clock right before it's sent
+                totp_otp = yield CodeRequest(generate_code)
+                timer.mark("generate_otp")
+                child.sendline(totp_otp)
+            case "send":
+                timer.mark("prompt")
+                child.sendline(rule.text)
+
 
-    except pexpect.TIMEOUT as e:
-        logging.error(
+def _dialog_error(child, e):
+    """TunnelError for a pexpect TIMEOUT/EOF during the dialog"""
+    import pexpect
+
+    logging.info("Output from ssh process:\n\n{}".format(child.logfile_read.getvalue()))
+    logging.info("FULL ERROR TEXT:\n\n{}".format(e))
+    if isinstance(e, pexpect.TIMEOUT):
+        return LoginTimeoutError(
             "Timed out waitings for specific ssh response. Try again with --verbose for more information."
         )
-        logging.info("STDOUT from ssh process:\n\n{}".format(logfile_read.getvalue()))
-        logging.info("FULL ERROR TEXT:\n\n{}".format(e))
-        sys.exit(1)
-    except pexpect.EOF as e:
-        logging.error(
-            "SSH process unexpectedly exited. Try again with --verbose for more information."
+    return LoginError(
+        "SSH process unexpectedly exited. Try again with --verbose for more information."
+    )
+
+
+def run_login_dialog(child, dialog):
+    import pexpect
+
+    try:
+        request = next(dialog)
+        while True:
+            if isinstance(request, CodeRequest):
+                request = dialog.send(request.generate())
+                continue
+            patterns, timeout = request
+            idx = child.expect(
+                patterns, timeout=timeout, searchwindowsize=AUTH_DIALOG_SEARCH_WINDOW
+            )
+            request = dialog.send(idx)
+    except StopIteration:
+        pass
+    except (pexpect.TIMEOUT, pexpect.EOF) as e:
+        raise _dialog_error(child, e)
+
+
+async def run_login_dialog_async(child, dialog):
+    import asyncio
+
+    import pexpect
+
+    # sendline() sleeps delaybeforesend before writing, which would block the event loop. wait here instead
+    delay, child.delaybeforesend = child.delaybeforesend, None
+    try:
+        request = next(dialog)
+        while True:
+            if isinstance(request, CodeRequest):
+                request = dialog.send(await asyncio.to_thread(request.generate))
+                continue
+            patterns, timeout = request
+            idx = await child.expect(
+                patterns,
+                timeout=timeout,
+                searchwindowsize=AUTH_DIALOG_SEARCH_WINDOW,
+                async_=True,
+            )
+            if delay:
+                await asyncio.sleep(delay)
+            request = dialog.send(idx)
+    except StopIteration:
+        pass
+    except (pexpect.TIMEOUT, pexpect.EOF) as e:
+        raise _dialog_error(child, e)
+
+
+def _abort_login(child, host, code):
+    # don't leave a half logged-in ssh behind (e.g. stuck at a prompt after a timeout)
+    child.close(force=True)
+    if code is not None:
+        code.release()
+    if host.select_fastest:
+        # the node that answered the probe fastest may be the one that is broken
+        forget_node_probes(host)
+
+
+def login_ssh_tunnel(
+    ssh_dest,
+    SECRET_rc_password,
+    timer=None,
+    host=None,
+    options=None,
+    control_suffix=None,
+    code=None,
+):
+    """Spawn the ssh master for ssh_dest and answer the password + 2FA prompts. Raises a TunnelError on failure
+
+    options, control_suffix: see spawn_ssh_master
+    code: from reserve_code, if the caller waited for the totp window before something else (default: reserve
+    it here)
+    """
+    if host is None:
+        host = get_host()
+    if timer is None:
+        timer = PhaseTimer(enabled=False)
+
+    generate_code = reserve_code(host, timer) if code is None else code
+    child = spawn_ssh_master(ssh_dest, host, timer, options, control_suffix)
+    try:
+        run_login_dialog(
+            child, login_dialog(child, SECRET_rc_password, host, timer, generate_code)
         )
-        logging.info("Output from ssh process:\n\n{}".format(logfile_read.getvalue()))
-        logging.info("FULL ERROR TEXT:\n\n{}".format(e))
-        sys.exit(1)
+    except TunnelError:
+        _abort_login(child, host, generate_code)
+        raise
 
-    logging.info(f"Successfully created SSH tunnel for {ssh_dest}")
+
+async def login_ssh_tunnel_async(
+    ssh_dest, SECRET_rc_password, timer, host, options=None, control_suffix=None
+):
+    """login_ssh_tunnel for asyncio: the dialog runs on the event loop, the blocking steps in threads"""
+    import asyncio
+
+    generate_code = await asyncio.to_thread(reserve_code, host, timer)
+    child = await asyncio.to_thread(
+        spawn_ssh_master, ssh_dest, host, timer, options, control_suffix
+    )
+    try:
+        await run_login_dialog_async(
+            child,
+            login_dialog(child, SECRET_rc_password, host, timer, generate_code),
+        )
+    except asyncio.CancelledError:
+        child.close(force=True)
+        if generate_code is not None:
+            generate_code.release()
+        raise
+    except TunnelError:
+        _abort_login(child, host, generate_code)
+        raise
 
 
 if __name__ == "__main__":
+    # `start-ssh forward add/remove/list` manages port forwards on the open master
+    if sys.argv[1:2] == ["forward"]:
+        from src.forwards import forward_cli
+
+        sys.exit(forward_cli(sys.argv[2:]))
+
     # optionally specify verbose logging
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -141,6 +636,63 @@ if __name__ == "__main__":
         action="store_true",
         dest="verbose",
     )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        help="keep running and re-open the tunnel whenever it drops",
+        action="store_true",
+        dest="daemon",
+    )
+    parser.add_argument(
+        "--watch-network",
+        help="with --daemon: also check the tunnel as soon as the network changes, e.g. after sleep or a wifi/vpn switch (linux)",
+        action="store_true",
+        dest="watch_network",
+    )
+    parser.add_argument(
+        "--host",
+        help="alias of the host (from the inventory file) to open a tunnel to. default: the main login host",
+        dest="host",
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        help="open tunnels to all hosts in the inventory file at the same time",
+        action="store_true",
+        dest="all",
+    )
+    parser.add_argument(
+        "--fastest",
+        help="connect to the login node with the lowest latency (probes all nodes of the host)",
+        action="store_true",
+        dest="fastest",
+    )
+    parser.add_argument(
+        "--pool",
+        help="also open N extra masters per host (reach them with `ssh <alias>-pool-<i>` or `python -m src.pool next`)",
+        type=int,
+        metavar="N",
+        dest="pool",
+    )
+    parser.add_argument(
+        "--no-retry",
+        help="don't retry a failed login (by default transient failures and a rejected code are retried, waiting for a new 2FA code when needed)",
+        action="store_false",
+        dest="retry",
+    )
+    parser.add_argument(
+        "--record-timings",
+        help="append the time spent in each phase to the timings file (or set TOTP_RECORD_TIMINGS=1)",
+        action="store_true",
+        default=None,
+        dest="record_timings",
+    )
+    parser.add_argument(
+        "--timings",
+        help="show p50/p95 time per phase of past recorded runs and exit",
+        action="store_true",
+        dest="timings",
+    )
     args = parser.parse_args()
 
     if args.verbose:
@@ -149,4 +701,40 @@ if __name__ == "__main__":
     else:
         init_logging()
 
-    start_ssh_tunnel()
+    if args.timings:
+        print_timings_summary()
+        sys.exit(0)
+
+    try:
+        if args.all:
+            hosts = list(load_inventory().values())
+        else:
+            hosts = [get_host(args.host)]
+    except InventoryError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    if args.fastest:
+        hosts = [replace(host, select_fastest=True) for host in hosts]
+    if args.pool:
+        hosts = [
+            member
+            for host in hosts
+            for member in (host, *pool_members(host, args.pool))
+        ]
+
+    if args.daemon:
+        # imported here since the supervisor module imports this one
+        from src.supervisor import supervise_tunnels
+
+        sys.exit(0 if supervise_tunnels(hosts, watch_network=args.watch_network) else 1)
+
+    if len(hosts) > 1:
+        results = start_all_ssh_tunnels(
+            hosts, record_timings=args.record_timings, retry=args.retry
+        )
+        sys.exit(0 if all(results.values()) else 1)
+
+    is_open = start_ssh_tunnel(
+        hosts[0], record_timings=args.record_timings, retry=args.retry
+    )
+    sys.exit(0 if is_open else 1)
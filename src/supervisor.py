@@ -0,0 +1,97 @@
+# KEEP THE SSH TUNNELS OPEN: RE-LOGIN AS SOON AS A CONTROLMASTER GOES AWAY
+
+import logging
+import time
+
+from src.constants import (
+    SUPERVISOR_BACKOFF_INITIAL_SECONDS,
+    SUPERVISOR_BACKOFF_MAX_SECONDS,
+    SUPERVISOR_POLL_SECONDS,
+)
+from src.netwatch import NetworkWatcher, check_and_repair, has_default_route
+from src.passwords import are_all_passwords_set, get_ssh_user
+from src.start_ssh import start_ssh_tunnel
+from src.test_connection import is_controlmaster_open
+
+
+def backoff_seconds(
+    failures,
+    initial=SUPERVISOR_BACKOFF_INITIAL_SECONDS,
+    maximum=SUPERVISOR_BACKOFF_MAX_SECONDS,
+):
+    """Wait time after `failures` failed logins in a row (exponential, capped)"""
+    return min(maximum, initial * 2 ** (failures - 1))
+
+
+def supervise_tunnels(
+    hosts, poll_interval=SUPERVISOR_POLL_SECONDS, watch_network=False
+):
+    """Run forever, re-creating the ssh tunnel of each host whenever its controlmaster is not open
+
+    watch_network: also check the tunnels right after the network changes (linux), replacing
+    masters whose connection died with the old network
+    """
+    ssh_dests = {}
+    for host in hosts:
+        if not are_all_passwords_set(host.keychain_prefix):
+            logging.error(
+                f"At least one required password for {host.alias} is missing from keyring"
+            )
+            logging.error("Run ./scripts/install to set up totp app")
+            return False
+        ssh_user = host.user or get_ssh_user(host.keychain_prefix)
+        ssh_dests[host.name] = f"{ssh_user}@{host.hostname}"
+
+    logging.warning(
+        f"Supervising ssh tunnels for {', '.join(ssh_dests.values())} (checking every {poll_interval}s). Press Ctrl-C to stop."
+    )
+
+    failures = {host.name: 0 for host in hosts}
+    next_attempt = {host.name: 0.0 for host in hosts}
+    watcher = NetworkWatcher() if watch_network else None
+    try:
+        while True:
+            for host in hosts:
+                ssh_dest = ssh_dests[host.name]
+                if time.monotonic() < next_attempt[host.name]:
+                    # still backing off after a failed login
+                    continue
+                if is_controlmaster_open(
+                    ssh_dest=ssh_dest,
+                    ssh_port=host.port,
+                    socket_suffix=host.control_suffix,
+                ):
+                    continue
+
+                logging.warning(f"SSH tunnel for {ssh_dest} is down. Reconnecting")
+                if start_ssh_tunnel(host):
+                    if failures[host.name] > 0:
+                        logging.warning(
+                            f"Reconnected {ssh_dest} after {failures[host.name]} failed attempt(s)"
+                        )
+                    failures[host.name] = 0
+                else:
+                    failures[host.name] += 1
+                    delay = backoff_seconds(failures[host.name])
+                    next_attempt[host.name] = time.monotonic() + delay
+                    logging.warning(
+                        f"Reconnect attempt {failures[host.name]} for {ssh_dest} failed. Trying again in {delay}s"
+                    )
+            if watcher is None:
+                time.sleep(poll_interval)
+                continue
+            if watcher.wait_for_change(timeout=poll_interval) and has_default_route():
+                logging.warning("Network changed. Checking tunnels")
+                for host in hosts:
+                    # the new network may work where the old one didn't: no more backing off
+                    failures[host.name] = 0
+                    next_attempt[host.name] = 0.0
+                    check_and_repair(host)
+    except KeyboardInterrupt:
+        logging.warning(
+            "Stopping tunnel supervisor (the tunnels themselves are left open)"
+        )
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return True
@@ -1,5 +1,7 @@
 import logging
 import os
+import socket
+import struct
 import subprocess
 from pathlib import Path
 
@@ -9,22 +11,132 @@ from src.constants import (
     MAX_TIMEOUT_CHECK_TUNNEL,
     SSH_CONTROLMASTERS_FOLDER,
 )
-from src.passwords import get_ssh_user
+
+# openssh controlmaster ("mux") protocol, see PROTOCOL.mux in the openssh source
+MUX_PROTOCOL_VERSION = 4
+MUX_MSG_HELLO = 0x00000001
+MUX_C_ALIVE_CHECK = 0x10000004
+MUX_S_ALIVE = 0x80000005
+MUX_MAX_PACKET_SIZE = 256 * 1024
+
+
+class MuxProtocolError(Exception):
+    pass
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise MuxProtocolError("Controlmaster closed the connection")
+        data += chunk
+    return data
+
+
+def _send_mux_packet(sock, payload):
+    sock.sendall(struct.pack(">I", len(payload)) + payload)
+
+
+def _recv_mux_packet(sock):
+    (length,) = struct.unpack(">I", _recv_exact(sock, 4))
+    if length < 4 or length > MUX_MAX_PACKET_SIZE:
+        raise MuxProtocolError(f"Unexpected mux packet length: {length}")
+    return _recv_exact(sock, length)
+
+
+def mux_alive_check(socket_path, timeout=MAX_TIMEOUT_CHECK_TUNNEL):
+    """Ask the controlmaster listening at socket_path if it is alive, without spawning ssh.
+
+    Speaks the openssh mux protocol directly: hello exchange, then an alive check.
+    Return the pid of the master if it is alive, or None if no master is listening.
+    Raise MuxProtocolError if the master answers with something unexpected.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError as e:
+            # no socket file, a stale socket file left behind by a master that died, or something we can't
+            # connect to (not a socket, another user's, half torn down)
+            logging.info(f"No controlmaster listening at {socket_path}: {e}")
+            return None
+
+        try:
+            _send_mux_packet(
+                sock, struct.pack(">II", MUX_MSG_HELLO, MUX_PROTOCOL_VERSION)
+            )
+            msg_type, version = struct.unpack(">II", _recv_mux_packet(sock)[:8])
+            if msg_type != MUX_MSG_HELLO or version != MUX_PROTOCOL_VERSION:
+                raise MuxProtocolError(
+                    f"Unexpected mux hello (type={msg_type:#x}, version={version})"
+                )
+
+            request_id = os.getpid() & 0xFFFFFFFF
+            _send_mux_packet(sock, struct.pack(">II", MUX_C_ALIVE_CHECK, request_id))
+            reply = _recv_mux_packet(sock)
+        except socket.timeout:
+            logging.warning(
+                f"Controlmaster at {socket_path} did not answer in under {timeout} seconds"
+            )
+            return None
+        except OSError as e:
+            logging.info(f"Controlmaster at {socket_path} closed the connection: {e}")
+            return None
+
+    if len(reply) < 12:
+        raise MuxProtocolError(f"Unexpected mux alive reply length: {len(reply)}")
+    msg_type, reply_id, master_pid = struct.unpack(">III", reply[:12])
+    if msg_type != MUX_S_ALIVE or reply_id != request_id:
+        raise MuxProtocolError(
+            f"Unexpected mux alive reply (type={msg_type:#x}, request id={reply_id})"
+        )
+    return master_pid
+
+
+def control_socket_path(
+    ssh_dest,
+    controlmaster_path=SSH_CONTROLMASTERS_FOLDER,
+    ssh_port=22,
+    socket_suffix="",
+):
+    """Full path of the control socket of the master for ssh_dest. The only place that decides it:
+    start-ssh passes it to ssh as ControlPath, and the checks, locks and wrappers use it too
+    """
+    return str(
+        Path(controlmaster_path).expanduser() / f"{ssh_dest}:{ssh_port}{socket_suffix}"
+    )
 
 
 def is_controlmaster_open(
-    ssh_dest, controlmaster_path=SSH_CONTROLMASTERS_FOLDER, ssh_port=22
+    ssh_dest,
+    controlmaster_path=SSH_CONTROLMASTERS_FOLDER,
+    ssh_port=22,
+    socket_suffix="",
 ):
     """Test if controlmaster tunnel is open"""
 
-    socket_filename = f"{ssh_dest}:{ssh_port}"
     controlmaster_path_full = Path(controlmaster_path).expanduser()
     if not controlmaster_path_full.is_dir():
         raise Exception(
             f"Controlmaster folder does not exist. Try creating a folder at: {SSH_CONTROLMASTERS_FOLDER}"
         )
-    socket_path = os.path.join(controlmaster_path, socket_filename)
+    socket_path = control_socket_path(
+        ssh_dest, controlmaster_path, ssh_port=ssh_port, socket_suffix=socket_suffix
+    )
     logging.info("checking ssh tunnel at: {}".format(socket_path))
+
+    # fast path: talk to the control socket directly (no ssh process needed)
+    try:
+        master_pid = mux_alive_check(socket_path)
+        if master_pid is None:
+            logging.info("Tunnel is not open")
+            return False
+        logging.info(f"Tunnel is open (controlmaster pid {master_pid})")
+        return True
+    except MuxProtocolError as e:
+        logging.info(f"{e}. Falling back to ssh -O check")
+
     args = [
         "ssh",
         "-o",
@@ -34,7 +146,9 @@ def is_controlmaster_open(
         "dummy_arg",  # needs a dummy arg or else this fails
     ]
     try:
-        completed_process = subprocess.run(args, timeout=10, capture_output=True)
+        completed_process = subprocess.run(
+            args, timeout=MAX_TIMEOUT_CHECK_TUNNEL, capture_output=True
+        )
         completed_process.stderr
         out = str(completed_process.stdout)
         err = str(completed_process.stderr)
@@ -44,6 +158,7 @@ def is_controlmaster_open(
         logging.warning(
             f"Timeout expired. Unable to verify tunnel exists in under {MAX_TIMEOUT_CHECK_TUNNEL} seconds"
         )
+        return False
     if completed_process.returncode == 0:
         # code 0 means success
         logging.info("Tunnel is open")
@@ -55,6 +170,8 @@ def is_controlmaster_open(
 
 
 if __name__ == "__main__":
+    from src.passwords import get_ssh_user
+
     logging.basicConfig(format=DEFAULT_LOG_FORMAT, level=logging.INFO)
     ssh_user = get_ssh_user()
     ret_val = is_controlmaster_open(f"{ssh_user}@{LOGIN_SSH_HOST}")
@@ -0,0 +1,96 @@
+# RECORD HOW LONG EACH PHASE OF START-SSH TAKES, AND SUMMARIZE PAST RUNS
+
+import json
+import logging
+import math
+import os
+import time
+from pathlib import Path
+
+from src.constants import APP_STATE_FOLDER, RECORD_TIMINGS_ENV_VAR
+
+TIMINGS_FILE = f"{APP_STATE_FOLDER}/timings.jsonl"
+
+
+def timings_enabled_by_env():
+    return os.environ.get(RECORD_TIMINGS_ENV_VAR, "").lower() in ("1", "true", "yes")
+
+
+class PhaseTimer:
+    """Monotonic stopwatch: mark(phase) records the time since the previous mark under that phase name"""
+
+    def __init__(self, enabled=None):
+        self.enabled = timings_enabled_by_env() if enabled is None else enabled
+        self.started_at = time.time()
+        self.start = time.monotonic()
+        self.last = self.start
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def save(self, result, host=None, timings_file=TIMINGS_FILE):
+        """Append this run as one json line to the timings file (only if timings are enabled)"""
+        if not self.enabled:
+            return
+        record = {
+            "time": self.started_at,
+            "pid": os.getpid(),
+            "host": host,
+            "result": result,
+            "total": time.monotonic() - self.start,
+            "phases": self.phases,
+        }
+        line = json.dumps(record)
+        logging.info(f"Phase timings: {line}")
+        timings_file_full = Path(timings_file).expanduser()
+        timings_file_full.parent.mkdir(parents=True, exist_ok=True)
+        with open(timings_file_full, "at") as f:
+            f.write(line + "\n")
+
+
+def load_timings(timings_file=TIMINGS_FILE):
+    timings_file_full = Path(timings_file).expanduser()
+    if not timings_file_full.exists():
+        return []
+    records = []
+    with open(timings_file_full, "rt") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # ignore lines half-written by a process that was killed
+                continue
+    return records
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def print_timings_summary(timings_file=TIMINGS_FILE):
+    records = load_timings(timings_file)
+    if not records:
+        print(
+            f"No timings recorded yet. Run start-ssh with --record-timings or set {RECORD_TIMINGS_ENV_VAR}=1"
+        )
+        return
+
+    # keep phases in the order they happen
+    per_phase = {}
+    for record in records:
+        for phase, seconds in record["phases"].items():
+            per_phase.setdefault(phase, []).append(seconds)
+    per_phase["total"] = [record["total"] for record in records]
+
+    print(f"{len(records)} recorded runs ({timings_file})\n")
+    print(f"{'phase':<22} {'runs':>5} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    for phase, values in per_phase.items():
+        print(
+            f"{phase:<22} {len(values):>5} {percentile(values, 50) * 1000:>10.1f} {percentile(values, 95) * 1000:>10.1f}"
+        )
@@ -0,0 +1,76 @@
+# REMEMBER WHICH TOTP STEPS WERE ALREADY SENT, SO THE SAME 6-DIGIT CODE IS NEVER SENT TWICE
+#
+# totp servers reject a code that was already used for a login. every login reserves its step (window) here
+# per keychain_prefix, under a lock, so concurrent logins (--all, --pool, several terminals) each get their own
+
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.clock_skew import get_clock_offset
+from src.constants import APP_STATE_FOLDER, TOTP_INTERVAL_SECONDS
+
+TOTP_STEPS_FILE = f"{APP_STATE_FOLDER}/totp_steps.json"
+
+
+def server_time():
+    """Local time corrected by the last measured clock skew (see src/clock_skew.py)"""
+    return time.time() + get_clock_offset()
+
+
+def current_step(interval=TOTP_INTERVAL_SECONDS):
+    return int(server_time() // interval)
+
+
+def seconds_until_step(step, interval=TOTP_INTERVAL_SECONDS):
+    """Seconds until `step` starts (<= 0 if it already has)"""
+    return step * interval - server_time()
+
+
+@contextmanager
+def _locked_steps(steps_file):
+    """{keychain_prefix: last sent step}, saved on exit. Holds an flock while open"""
+    steps_file_full = Path(steps_file).expanduser()
+    steps_file_full.parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{steps_file_full}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            steps = json.loads(steps_file_full.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            steps = {}
+        before = dict(steps)
+        yield steps
+        if steps != before:
+            tmp = steps_file_full.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(steps))
+            os.replace(tmp, steps_file_full)
+
+
+def last_sent_step(keychain_prefix, steps_file=TOTP_STEPS_FILE):
+    """Step of the last code sent for keychain_prefix (None if none was)"""
+    with _locked_steps(steps_file) as steps:
+        return steps.get(keychain_prefix)
+
+
+def reserve_step(keychain_prefix, earliest_step, steps_file=TOTP_STEPS_FILE):
+    """Reserve the first step >= earliest_step whose code wasn't sent yet. Return it"""
+    with _locked_steps(steps_file) as steps:
+        step = max(earliest_step, steps.get(keychain_prefix, -1) + 1)
+        steps[keychain_prefix] = step
+    return step
+
+
+def release_step(keychain_prefix, step, steps_file=TOTP_STEPS_FILE):
+    """Undo reserve_step for a code that was never sent, unless a later step was reserved since"""
+    with _locked_steps(steps_file) as steps:
+        if steps.get(keychain_prefix) == step:
+            steps[keychain_prefix] = step - 1
+
+
+def forget_sent_steps(steps_file=TOTP_STEPS_FILE):
+    """Only for servers that accept a code more than once (e.g. the fake sshd in benchmarks/)"""
+    with _locked_steps(steps_file) as steps:
+        steps.clear()
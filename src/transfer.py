@@ -0,0 +1,362 @@
+# PARALLEL CHUNKED FILE TRANSFER OVER THE AUTHENTICATED MASTER(S)
+#
+# splits a file tree (and large files) into chunks and copies them over several ssh sessions at once.
+# every chunk is verified with sha256 on both ends, and finished chunks are streamed to a manifest
+# so an interrupted transfer picks up where it left off when run again.
+# uses the pool masters (start-ssh --pool N) if any are open, otherwise the host's master.
+#
+#   python -m src.transfer upload ./data remote/data
+#   python -m src.transfer download remote/data ./data
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from src.constants import (
+    APP_STATE_FOLDER,
+    DEFAULT_LOG_FORMAT,
+    TRANSFER_DEFAULT_CHUNK_MB,
+    TRANSFER_DEFAULT_JOBS,
+)
+from src.inventory import get_host
+from src.pool import session_aliases
+
+TRANSFER_MANIFEST_FOLDER = f"{APP_STATE_FOLDER}/transfers"
+
+# chunks start at multiples of this (dd seeks in blocks)
+BLOCK_SIZE = 1024 * 1024
+
+# attempts per chunk before the transfer fails
+CHUNK_ATTEMPTS = 3
+
+
+class TransferError(Exception):
+    pass
+
+
+def ssh_run(alias, remote_command, input_data=None):
+    """Run remote_command over the existing master of alias. Never starts a new login"""
+    completed = subprocess.run(
+        ["ssh", "-o", "ControlMaster=no", "-o", "BatchMode=yes", alias, remote_command],
+        input=input_data,
+        capture_output=True,
+    )
+    if completed.returncode != 0:
+        raise TransferError(
+            f"ssh {alias} failed ({completed.returncode}): {completed.stderr.decode(errors='replace').strip()}"
+        )
+    return completed.stdout
+
+
+def list_local_files(local_root):
+    """[(relative path, size, mtime)] of all files under local_root (or just local_root if it's a file)"""
+    root = Path(local_root)
+    if root.is_file():
+        stat = root.stat()
+        return [(root.name, stat.st_size, stat.st_mtime)]
+    files = []
+    for path in sorted(root.rglob("*")):
+        if path.is_file():
+            stat = path.stat()
+            files.append((str(path.relative_to(root)), stat.st_size, stat.st_mtime))
+    return files
+
+
+def list_remote_files(alias, remote_root):
+    """([(relative path, size, mtime)] of all files under remote_root, True if remote_root is a single file).
+    A single file is listed under its name, like list_local_files does"""
+    quoted_root = shlex.quote(remote_root)
+    # "F" or "D" first, then the files
+    output = ssh_run(
+        alias,
+        f"if [ -f {quoted_root} ]; then printf 'F\\0' && find {quoted_root} -maxdepth 0 -printf '%s\\t%T@\\t%f\\0';"
+        f" else printf 'D\\0' && cd {quoted_root} && find . -type f -printf '%s\\t%T@\\t%P\\0'; fi",
+    )
+    kind, *entries = output.decode().split("\0")
+    files = []
+    for entry in entries:
+        if entry:
+            size, mtime, path = entry.split("\t", 2)
+            files.append((path, int(size), float(mtime)))
+    return sorted(files), kind == "F"
+
+
+def make_chunks(files, chunk_size):
+    """Split files into chunks of at most chunk_size bytes (empty files get no chunk)"""
+    chunks = []
+    for path, size, mtime in files:
+        for offset in range(0, size, chunk_size):
+            chunks.append(
+                {
+                    "path": path,
+                    "offset": offset,
+                    "length": min(chunk_size, size - offset),
+                    "mtime": mtime,
+                }
+            )
+    return chunks
+
+
+def _chunk_key(chunk):
+    return (chunk["path"], chunk["offset"], chunk["length"], chunk["mtime"])
+
+
+def _remote_range(remote_path, offset, length):
+    """shell snippet printing `length` bytes of remote_path starting at offset"""
+    return f"tail -c +{offset + 1} {remote_path} | head -c {length}"
+
+
+def manifest_file(direction, alias, source, destination):
+    key = hashlib.sha1(
+        f"{direction}|{alias}|{source}|{destination}".encode()
+    ).hexdigest()[:16]
+    return Path(TRANSFER_MANIFEST_FOLDER).expanduser() / f"{key}.jsonl"
+
+
+class Manifest:
+    """Append-only record of finished chunks (one json line each), safe to use from several threads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if path.exists():
+            with open(path, "rt") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("type") == "chunk":
+                        self.done.add(_chunk_key(record))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "at")
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            if record.get("type") == "chunk":
+                self.done.add(_chunk_key(record))
+
+    def close(self):
+        self.file.close()
+
+
+def _upload_chunk(alias, local_root, remote_root, chunk, single_file):
+    local_path = Path(local_root) if single_file else Path(local_root, chunk["path"])
+    with open(local_path, "rb") as f:
+        f.seek(chunk["offset"])
+        data = f.read(chunk["length"])
+    digest = hashlib.sha256(data).hexdigest()
+    remote_path = shlex.quote(str(Path(remote_root, chunk["path"])))
+    remote_digest = (
+        ssh_run(
+            alias,
+            f"dd of={remote_path} bs={BLOCK_SIZE} seek={chunk['offset'] // BLOCK_SIZE} conv=notrunc status=none"
+            f" && {_remote_range(remote_path, chunk['offset'], chunk['length'])} | sha256sum",
+            input_data=data,
+        )
+        .split()[0]
+        .decode()
+    )
+    if remote_digest != digest:
+        raise TransferError(
+            f"Checksum mismatch for {chunk['path']} @ {chunk['offset']}"
+        )
+    return digest
+
+
+def _download_chunk(alias, remote_root, local_root, chunk, single_file):
+    remote_path = shlex.quote(
+        remote_root if single_file else str(Path(remote_root, chunk["path"]))
+    )
+    remote_range = _remote_range(remote_path, chunk["offset"], chunk["length"])
+    # data first, then the remote checksum of the same range
+    output = ssh_run(alias, f"{remote_range}; {remote_range} | sha256sum")
+    data, remote_digest = output[: chunk["length"]], output[chunk["length"] :].split()
+    digest = hashlib.sha256(data).hexdigest()
+    if (
+        len(data) != chunk["length"]
+        or not remote_digest
+        or remote_digest[0].decode() != digest
+    ):
+        raise TransferError(
+            f"Checksum mismatch for {chunk['path']} @ {chunk['offset']}"
+        )
+    fd = os.open(Path(local_root, chunk["path"]), os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, chunk["offset"])
+    finally:
+        os.close(fd)
+    return digest
+
+
+def _prepare_remote(alias, remote_root, files):
+    """Create remote folders and size the remote files so chunks can be written in any order"""
+    commands = [f"mkdir -p {shlex.quote(remote_root)}"]
+    for path, size, _ in files:
+        remote_path = Path(remote_root, path)
+        commands.append(
+            f"mkdir -p {shlex.quote(str(remote_path.parent))} && truncate -s {size} {shlex.quote(str(remote_path))}"
+        )
+    ssh_run(alias, "sh -s", input_data="\n".join(commands).encode() + b"\n")
+
+
+def _prepare_local(local_root, files):
+    for path, size, _ in files:
+        local_path = Path(local_root, path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(local_path, "ab") as f:
+            f.truncate(size)
+
+
+def transfer(
+    direction,
+    source,
+    destination,
+    host=None,
+    jobs=TRANSFER_DEFAULT_JOBS,
+    chunk_mb=TRANSFER_DEFAULT_CHUNK_MB,
+    restart=False,
+):
+    """Copy source to destination ("upload": local -> remote, "download": remote -> local).
+    Return a dict with the throughput report"""
+    if host is None:
+        host = get_host()
+    chunk_size = max(1, chunk_mb) * BLOCK_SIZE
+
+    # spread the chunks over the pool masters, if there are any
+    aliases = session_aliases(host)
+    logging.info(
+        f"Transferring over {', '.join(aliases)} with {jobs} parallel channels"
+    )
+
+    # a single file goes into the destination folder
+    if direction == "upload":
+        single_file = Path(source).is_file()
+        files = list_local_files(source)
+        _prepare_remote(aliases[0], destination, files)
+    elif direction == "download":
+        files, single_file = list_remote_files(aliases[0], source)
+        _prepare_local(destination, files)
+    else:
+        raise TransferError(f"Unknown direction: {direction}")
+
+    manifest_path = manifest_file(direction, host.alias, source, destination)
+    if restart:
+        manifest_path.unlink(missing_ok=True)
+    manifest = Manifest(manifest_path)
+    chunks = make_chunks(files, chunk_size)
+    todo = [chunk for chunk in chunks if _chunk_key(chunk) not in manifest.done]
+    logging.info(
+        f"{len(files)} files, {len(chunks)} chunks ({len(chunks) - len(todo)} already done, manifest: {manifest_path})"
+    )
+    manifest.write(
+        {
+            "type": "start",
+            "time": time.time(),
+            "files": len(files),
+            "chunks": len(chunks),
+        }
+    )
+
+    def run_chunk(index, chunk):
+        alias = aliases[index % len(aliases)]
+        for attempt in range(1, CHUNK_ATTEMPTS + 1):
+            try:
+                if direction == "upload":
+                    digest = _upload_chunk(
+                        alias, source, destination, chunk, single_file
+                    )
+                else:
+                    digest = _download_chunk(
+                        alias, source, destination, chunk, single_file
+                    )
+                break
+            except (TransferError, OSError) as e:
+                if attempt == CHUNK_ATTEMPTS:
+                    raise
+                logging.warning(f"{e}. Retrying (attempt {attempt + 1})")
+        manifest.write({"type": "chunk", **chunk, "sha256": digest})
+        return chunk["length"]
+
+    start = time.monotonic()
+    transferred = 0
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(run_chunk, i, chunk) for i, chunk in enumerate(todo)
+            ]
+            for future in as_completed(futures):
+                try:
+                    transferred += future.result()
+                except (TransferError, OSError) as e:
+                    failed += 1
+                    logging.error(str(e))
+    finally:
+        elapsed = time.monotonic() - start
+        report = {
+            "direction": direction,
+            "files": len(files),
+            "chunks": len(chunks),
+            "chunks_skipped": len(chunks) - len(todo),
+            "chunks_failed": failed,
+            "bytes": transferred,
+            "seconds": elapsed,
+            "mb_per_second": transferred / BLOCK_SIZE / elapsed if elapsed > 0 else 0.0,
+            "channels": jobs,
+            "masters": len(aliases),
+        }
+        manifest.write({"type": "end", "time": time.time(), **report})
+        manifest.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("direction", help='"upload" (local -> remote) or "download"')
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    parser.add_argument(
+        "--host", help="host alias from the inventory (default: main login host)"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=TRANSFER_DEFAULT_JOBS)
+    parser.add_argument("--chunk-mb", type=int, default=TRANSFER_DEFAULT_CHUNK_MB)
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore chunks finished by an earlier run",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format=DEFAULT_LOG_FORMAT,
+        level=logging.INFO if args.verbose else logging.WARNING,
+    )
+
+    try:
+        report = transfer(
+            args.direction,
+            args.source,
+            args.destination,
+            host=get_host(args.host),
+            jobs=args.jobs,
+            chunk_mb=args.chunk_mb,
+            restart=args.restart,
+        )
+    except TransferError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    print(json.dumps(report))
+    sys.exit(1 if report["chunks_failed"] else 0)
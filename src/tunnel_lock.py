@@ -0,0 +1,99 @@
+# LOCK SO THAT ONLY ONE PROCESS AT A TIME CREATES A GIVEN SSH TUNNEL
+
+import fcntl
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.constants import (
+    LOCK_POLL_SECONDS,
+    LOCK_WAIT_TIMEOUT_SECONDS,
+    SSH_CONTROLMASTERS_FOLDER,
+)
+
+
+class TunnelLockTimeout(Exception):
+    pass
+
+
+def lock_file_path(
+    ssh_dest,
+    controlmaster_path=SSH_CONTROLMASTERS_FOLDER,
+    ssh_port=22,
+    socket_suffix="",
+):
+    """Lock file lives next to the control socket: <controlmasters>/<user>@<host>:<port>.lock"""
+    return (
+        Path(controlmaster_path).expanduser()
+        / f"{ssh_dest}:{ssh_port}{socket_suffix}.lock"
+    )
+
+
+def _read_lock_holder(lock_path):
+    try:
+        return lock_path.read_text().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+@contextmanager
+def tunnel_lock(
+    ssh_dest,
+    controlmaster_path=SSH_CONTROLMASTERS_FOLDER,
+    ssh_port=22,
+    timeout=LOCK_WAIT_TIMEOUT_SECONDS,
+    socket_suffix="",
+):
+    """Hold an exclusive lock while creating the tunnel for ssh_dest.
+
+    Uses flock on a lock file, so the kernel drops the lock if the holder dies. A lock file left over
+    from a crashed process is therefore never stale - the next caller just locks it again.
+    Raises TunnelLockTimeout if the lock can't be taken within `timeout` seconds.
+    """
+    lock_path = lock_file_path(ssh_dest, controlmaster_path, ssh_port, socket_suffix)
+    deadline = time.monotonic() + timeout
+    logged_wait = False
+
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            if not logged_wait:
+                logging.info(
+                    f"Another process (pid {_read_lock_holder(lock_path)}) is creating the tunnel. Waiting for it to finish"
+                )
+                logged_wait = True
+            if time.monotonic() > deadline:
+                raise TunnelLockTimeout(
+                    f"Timed out after {timeout} seconds waiting for tunnel lock: {lock_path}"
+                )
+            time.sleep(LOCK_POLL_SECONDS)
+            continue
+
+        # the file may have been removed/replaced between open and flock. if so our lock is on an
+        # orphaned inode that nobody else will see, so try again with the file that is there now
+        try:
+            path_stat = os.stat(lock_path)
+            fd_stat = os.fstat(fd)
+            same_file = (path_stat.st_dev, path_stat.st_ino) == (
+                fd_stat.st_dev,
+                fd_stat.st_ino,
+            )
+        except FileNotFoundError:
+            same_file = False
+        if not same_file:
+            os.close(fd)
+            continue
+        break
+
+    try:
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        logging.info(f"Acquired tunnel lock: {lock_path}")
+        yield lock_path
+    finally:
+        os.close(fd)
@@ -0,0 +1,219 @@
+# LIBRARY API FOR KEEPING A TUNNEL OPEN FROM LONG-RUNNING PYTHON PROCESSES
+#
+# keep one manager around and call ensure() before using the connection: when the master is up that's a
+# single round trip on its control socket, and only a miss loads the keychain and logs in.
+# failures raise a TunnelError subclass (see src.start_ssh) instead of exiting.
+#
+#   manager = TunnelManager(get_host("cannon"))
+#   manager.ensure()                  # EnsureResult(host="cannon", logged_in=False, seconds=0.0002)
+#   manager.status().is_open
+#
+#   manager = AsyncTunnelManager()
+#   await manager.ensure(retry=True)     # retries like start-ssh (see src/retry.py)
+
+import asyncio
+import logging
+import subprocess
+import time
+from dataclasses import dataclass
+
+from src.constants import MAX_TIMEOUT_CHECK_TUNNEL
+from src.inventory import get_host
+from src.retry import ensure_with_retry, ensure_with_retry_async
+from src.ssh_config import read_ssh_user_from_config
+from src.start_ssh import (
+    MissingCredentialsError,
+    ensure_ssh_tunnel,
+    lock_busy_error,
+    login_ssh_tunnel_async,
+    needs_login,
+    read_credentials,
+    tunnel_opened,
+)
+from src.test_connection import (
+    MuxProtocolError,
+    control_socket_path,
+    is_controlmaster_open,
+    mux_alive_check,
+)
+from src.timings import PhaseTimer
+from src.tunnel_lock import TunnelLockTimeout, tunnel_lock
+
+
+@dataclass
+class TunnelStatus:
+    host: str
+    is_open: bool
+    socket_path: str
+    # None if closed or the master didn't say
+    master_pid: int | None
+    seconds: float
+
+
+@dataclass
+class EnsureResult:
+    host: str
+    # False if the tunnel was already open
+    logged_in: bool
+    seconds: float
+
+
+class TunnelManager:
+    def __init__(self, host=None, record_timings=None):
+        self.host = host if host is not None else get_host()
+        self.record_timings = record_timings
+        self._ssh_user = None
+
+    @property
+    def ssh_user(self):
+        if self._ssh_user is None:
+            self._ssh_user = self.host.user or read_ssh_user_from_config(
+                alias=self.host.alias
+            )
+        if self._ssh_user is None:
+            # not in the inventory or ssh config, so it has to come from the keychain
+            from src.passwords import get_ssh_user
+
+            self._ssh_user = get_ssh_user(self.host.keychain_prefix)
+        if self._ssh_user is None:
+            raise MissingCredentialsError(
+                f"No ssh username for {self.host.name}. Run ./scripts/install to set up totp app"
+            )
+        return self._ssh_user
+
+    @property
+    def ssh_dest(self):
+        return f"{self.ssh_user}@{self.host.hostname}"
+
+    @property
+    def socket_path(self):
+        return control_socket_path(
+            self.ssh_dest,
+            ssh_port=self.host.port,
+            socket_suffix=self.host.control_suffix,
+        )
+
+    def status(self):
+        """Is the master up? Asks the control socket directly (no ssh process, no keychain)"""
+        start = time.monotonic()
+        socket_path = self.socket_path
+        try:
+            master_pid = mux_alive_check(socket_path)
+            is_open = master_pid is not None
+        except MuxProtocolError as e:
+            logging.info(f"{e}. Falling back to ssh -O check")
+            master_pid = None
+            is_open = is_controlmaster_open(
+                self.ssh_dest,
+                ssh_port=self.host.port,
+                socket_suffix=self.host.control_suffix,
+            )
+        return TunnelStatus(
+            host=self.host.name,
+            is_open=is_open,
+            socket_path=socket_path,
+            master_pid=master_pid,
+            seconds=time.monotonic() - start,
+        )
+
+    def ensure(self, retry=False):
+        """Make sure the tunnel is open, logging in if needed. Raises a TunnelError if it can't
+
+        retry: retry failed logins that may work with a new code (see src/retry.py)
+        """
+        start = time.monotonic()
+        if self.status().is_open:
+            return EnsureResult(self.host.name, False, time.monotonic() - start)
+        timer = PhaseTimer(enabled=self.record_timings)
+        logged_in = None
+        try:
+            if retry:
+                logged_in = ensure_with_retry(self.host, timer)
+            else:
+                logged_in = ensure_ssh_tunnel(self.host, timer)
+        finally:
+            timer.save(
+                result="failed" if logged_in is None else "open", host=self.host.name
+            )
+        return EnsureResult(self.host.name, logged_in, time.monotonic() - start)
+
+    def close(self):
+        """Stop the master. Return True if one was running"""
+        completed = subprocess.run(
+            ["ssh", "-o", f"ControlPath={self.socket_path}", "-O", "exit", "dummy_arg"],
+            capture_output=True,
+            timeout=MAX_TIMEOUT_CHECK_TUNNEL,
+        )
+        return completed.returncode == 0
+
+
+async def _acquire(lock):
+    """Enter the lock (a tunnel_lock) in a thread. If the caller is cancelled while it waits, the lock is
+    released as soon as the thread gets it instead of staying held"""
+    acquire = asyncio.ensure_future(asyncio.to_thread(lock.__enter__))
+    try:
+        # the thread can't be stopped, so don't let the cancellation lose track of it
+        return await asyncio.shield(acquire)
+    except asyncio.CancelledError:
+
+        def release(acquire):
+            if not acquire.cancelled() and acquire.exception() is None:
+                lock.__exit__(None, None, None)
+
+        acquire.add_done_callback(release)
+        raise
+
+
+class AsyncTunnelManager(TunnelManager):
+    """Same as TunnelManager, but the login runs on the event loop (pexpect's async expect)
+    and blocking calls run in threads"""
+
+    async def status(self):
+        return await asyncio.to_thread(super().status)
+
+    async def ensure(self, retry=False):
+        start = time.monotonic()
+        if (await self.status()).is_open:
+            return EnsureResult(self.host.name, False, time.monotonic() - start)
+        timer = PhaseTimer(enabled=self.record_timings)
+        logged_in = None
+        try:
+            if retry:
+                logged_in = await ensure_with_retry_async(
+                    self.host, lambda: self._login(timer)
+                )
+            else:
+                logged_in = await self._login(timer)
+        finally:
+            timer.save(
+                result="failed" if logged_in is None else "open", host=self.host.name
+            )
+        return EnsureResult(self.host.name, logged_in, time.monotonic() - start)
+
+    async def _login(self, timer):
+        """ensure_ssh_tunnel past the fast check"""
+        host = self.host
+        ssh_user, SECRET_rc_password = await asyncio.to_thread(
+            read_credentials, host, timer
+        )
+        ssh_dest = f"{ssh_user}@{host.hostname}"
+        lock = tunnel_lock(
+            ssh_dest=ssh_dest, ssh_port=host.port, socket_suffix=host.control_suffix
+        )
+        try:
+            await _acquire(lock)
+        except TunnelLockTimeout as e:
+            raise lock_busy_error(e)
+        try:
+            timer.mark("lock_wait")
+            if not await asyncio.to_thread(needs_login, ssh_dest, host, timer):
+                return False
+            logging.info(f"Creating new ssh tunnel for {host.name}")
+            await login_ssh_tunnel_async(ssh_dest, SECRET_rc_password, timer, host)
+        finally:
+            lock.__exit__(None, None, None)
+        await asyncio.to_thread(tunnel_opened, host, ssh_dest, ssh_user)
+        return True
+
+    async def close(self):
+        return await asyncio.to_thread(super().close)